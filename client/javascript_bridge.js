@@ -52,6 +52,14 @@ var Channel; // Unique constant that could be defined by assignment pre-pended t
 if (typeof Channel === 'undefined') { // ... but if not assigned, use a debugging value
     Channel = 1
 }
+var CommandWindow; // Most Cytoscape commands to execute at once ... could be defined by assignment pre-pended to this file
+if (typeof CommandWindow === 'undefined') { // ... but if not assigned, execute one command at a time
+    CommandWindow = 1
+}
+var UseWebSocket; // Whether to try a WebSocket before long polling ... could be defined by assignment pre-pended to this file
+if (typeof UseWebSocket === 'undefined') { // ... but if not assigned, only long poll, which every Jupyter bridge serves
+    UseWebSocket = false
+}
 
 
 var httpR = new XMLHttpRequest(); // for sending reply to Jupyter-bridge
@@ -61,9 +69,39 @@ var httpJ = new XMLHttpRequest(); // for fetching request from Jupyter-bridge
 
 const HTTP_OK = 200
 const HTTP_SYS_ERR = 500
+const HTTP_NOT_FOUND = 404
 const HTTP_TIMEOUT = 408
 const HTTP_TOO_MANY = 429
 
+const COMPRESS_MIN_LENGTH = 16384 // Replies at least this long are compressed (if the browser can)
+const FRAMED_REPLY_TYPE = 'application/x-cytoscape-reply' // Content type of a reply sent as a status line and Cytoscape's response as it came
+const SOCKET_SHUTDOWN = 4429 // WebSocket close code meaning stop listening (as HTTP_TOO_MANY does for dequeue_request)
+const SOCKET_TRY_AGAIN = 1013 // WebSocket close code meaning listen by long polling instead
+const SOCKET_INTERNAL_ERROR = 1011 // WebSocket close code meaning Jupyter bridge failed to push requests ... listen by long polling instead
+const SOCKET_RECONNECT_MILLIS = 1000
+const SOCKET_MAX_RECONNECTS = 3 // Most times a lost WebSocket is reopened before falling back to long polling
+
+var replyAndWaitSupported = true // Assume Jupyter-bridge can accept a reply and return the next request in one call
+var requestId = '' // Correlation ID of the request being executed ... its reply carries the same ID
+var requestFramed = false // Whether the request being executed asked for a framed reply
+var ackId = '' // Message ID of the last request received ... the next dequeue acknowledges it, so it isn't delivered again
+var heldIds = [] // Message IDs of the requests received in the concurrency window or on the WebSocket and not yet replied to ... each reply acknowledges its request
+
+// State of the concurrency window (used only when CommandWindow > 1). Read-only (GET) commands execute together,
+// and any other command executes alone, after the commands ahead of it finish and before the commands behind it start.
+var windowCommands = 0 // Number of commands executing
+var windowExclusive = false // Whether the executing command must execute alone
+var windowBarrier = null // Command waiting for the executing commands to finish
+var windowFetching = false // Whether a dequeue_request is outstanding
+
+// State of the WebSocket to Jupyter bridge. Once it has opened, requests are pushed on it instead of being fetched by
+// dequeue_request, and they wait in the backlog until the concurrency window admits them. Replies are sent on it
+// while it's open.
+var socketMode = false // Whether requests arrive on the WebSocket
+var bridgeSocket = null // The WebSocket, while it's open
+var socketBacklog = [] // Requests pushed on the WebSocket and not yet executing
+var socketReconnectsLeft = 0 // Reopens left before falling back to long polling (none until a WebSocket has opened)
+
 
  /* This function is useful if we want to rewrite the incoming URL to resolve just to our local one.
     Doing this stops the Jupyter component from abusing this client to call out to endpoints other
@@ -95,24 +133,51 @@ function parseURL(url) {
 }
 */
 
-function replyCytoscape(replyStatus, replyStatusText, replyText) {
+function replyBody(replyStatus, replyStatusText, replyText, framed) {
+    // A framed reply is a status line followed by Cytoscape's response as it came, so a JSON response isn't escaped
+    // into a string that the notebook must decode before decoding the response itself. The notebook asks for one by
+    // setting framed in its request ... otherwise, the reply is a JSON envelope around the response.
+    if (framed) {
+        return replyStatus + ' ' + String(replyStatusText).replace(/\n/g, ' ') + '\n' + replyText
+    }
+    return JSON.stringify({'status': replyStatus, 'reason': replyStatusText, 'text': replyText})
+}
+
+function replyCytoscape(replyStatus, replyStatusText, replyText, replyId, http, httpE, framed, messageId) {
+    // By default, reply to the request being executed, using the shared XMLHttpRequests. A reply to a request with a
+    // message ID acknowledges it.
+    if (replyId === undefined) {
+        replyId = requestId
+        framed = requestFramed
+    }
+    http = http || httpR
+    httpE = httpE || httpRE
 
     // Clean up after Jupyter bridge accepts reply
-    httpR.onreadystatechange = function() {
-        if (httpR.readyState === 4) {
+    http.onreadystatechange = function() {
+        if (http.readyState === 4) {
             if (showDebug) {
-                console.log(' status from queue_reply: ' + httpR.status + ', reply: ' + httpR.responseText)
+                console.log(' status from queue_reply: ' + http.status + ', reply: ' + http.responseText)
+            }
+            if (http.status === HTTP_TOO_MANY && http.getResponseHeader('Retry-After')) {
+                // The channel's reply queue is full or calls are being limited ... send the same reply again after waiting
+                setTimeout(function() {
+                    sendJupyterBridgeReply(http, jupyterBridgeURL, reply, framed)
+                }, retryAfterMillis(http))
+            } else if (http.status !== 0) { // Status 0 means a network error, which onerror handles
+                releaseRequest(messageId)
             }
         }
     }
 
-    httpR.onerror = function() {
+    http.onerror = function() {
         // Clean up after Jupyter bridge accepts backup reply
-        httpRE.onreadystatechange = function() {
-            if (httpRE.readyState === 4) {
+        httpE.onreadystatechange = function() {
+            if (httpE.readyState === 4) {
                 if (showDebug) {
-                    console.log(' status from backup queue_reply: ' + httpRE.status + ', reply: ' + httpRE.responseText)
+                    console.log(' status from backup queue_reply: ' + httpE.status + ', reply: ' + httpE.responseText)
                 }
+                releaseRequest(messageId)
             }
         }
 
@@ -120,30 +185,43 @@ function replyCytoscape(replyStatus, replyStatusText, replyText) {
             console.log(' error from queue_reply -- could be Jupyter-Bridge server reject')
         }
         var errReply = {'status': HTTP_SYS_ERR, 'reason': 'Jupyter-Bridge rejected reply', 'text': 'Possibly reply is too long for Jupyter-Bridge server'}
-        httpRE.open('POST', jupyterBridgeURL, true)
-        httpRE.setRequestHeader('Content-Type', 'text/plain')
-        httpRE.send(JSON.stringify(errReply))
+        httpE.open('POST', jupyterBridgeURL, true)
+        httpE.setRequestHeader('Content-Type', 'text/plain')
+        httpE.send(JSON.stringify(errReply))
     }
 
-    var reply = {'status': replyStatus, 'reason': replyStatusText, 'text': replyText}
+    var reply = replyBody(replyStatus, replyStatusText, replyText, framed)
+
+    // Send reply on the WebSocket if it's open ... a framed reply goes in a binary frame
+    if (bridgeSocket) {
+        if (showDebug) {
+            console.log('Sending reply on WebSocket: ' + replyId)
+        }
+        var header = messageId ? replyId + ' ' + messageId : replyId
+        bridgeSocket.send(framed ? new TextEncoder().encode(header + '\n' + reply) : header + '\n' + reply)
+        releaseRequest(messageId)
+        return
+    }
 
     // Send reply to Jupyter bridge
-    var jupyterBridgeURL = JupyterBridge + '/queue_reply?channel=' + Channel
+    var jupyterBridgeURL = JupyterBridge + '/queue_reply?channel=' + Channel + requestIdParam(replyId) + (messageId ? '&ack=' + messageId : '')
     if (showDebug) {
         console.log('Starting queue to Jupyter bridge: ' + jupyterBridgeURL)
     }
-    httpR.open('POST', jupyterBridgeURL, true)
-    httpR.setRequestHeader('Content-Type', 'text/plain')
-    httpR.send(JSON.stringify(reply))
+    sendJupyterBridgeReply(http, jupyterBridgeURL, reply, framed)
 }
 
 function callCytoscape(callSpec) {
+    sendCytoscapeCommand(httpC, callSpec, replyCytoscapeAndWaitOnJupyterBridge)
+}
+
+function sendCytoscapeCommand(http, callSpec, onReply) {
 
     // Captures Cytoscape reply and sends it on
-    httpC.onreadystatechange = function() {
-        if (httpC.readyState === 4) {
+    http.onreadystatechange = function() {
+        if (http.readyState === 4) {
             if (showDebug) {
-                console.log(' status from CyREST: ' + httpC.status + ', statusText: ' + httpC.statusText + ', reply: ' + httpC.responseText)
+                console.log(' status from CyREST: ' + http.status + ', statusText: ' + http.statusText + ', reply: ' + http.responseText)
             }
             // Note that httpC.status is 0 if the URL can't be reached *OR* there is a CORS violation.
             // I wish I could tell the difference because for a CORS violation, I'd return a 404,
@@ -152,8 +230,7 @@ function callCytoscape(callSpec) {
             // returns different exceptions, depending on wither this module is doing the
             // HTTP operation or the native Python requests package is. This is minor, but
             // messes up tests that verify the exception type.
-            replyCytoscape(httpC.status, httpC.statusText, httpC.responseText)
-            waitOnJupyterBridge()
+            onReply(http.status, http.statusText, http.responseText)
         }
     }
 
@@ -176,15 +253,27 @@ function callCytoscape(callSpec) {
 
     if (callSpec.command === 'webbrowser') {
         if (window.open(callSpec.url)) {
-            replyCytoscape(HTTP_OK, 'OK', '')
+            onReply(HTTP_OK, 'OK', '')
         } else {
-            replyCytoscape(HTTP_SYS_ERR, 'BAD BROWSER OPEN', '')
+            onReply(HTTP_SYS_ERR, 'BAD BROWSER OPEN', '')
         }
-        waitOnJupyterBridge()
+    } else if (callSpec.command === 'batch') {
+        // Execute the calls in order, and return all of their replies as a JSON array in a single reply
+        var batchReplies = []
+        var sendNextCall = function() {
+            if (batchReplies.length < callSpec.calls.length) {
+                sendCytoscapeCommand(http, callSpec.calls[batchReplies.length], function(callStatus, callStatusText, callText) {
+                    batchReplies.push({'status': callStatus, 'reason': callStatusText, 'text': callText})
+                    sendNextCall()
+                })
+            } else {
+                onReply(HTTP_OK, 'OK', JSON.stringify(batchReplies))
+            }
+        }
+        sendNextCall()
     } else if (callSpec.command === 'version') {
-        replyCytoscape(HTTP_OK, 'OK',
+        onReply(HTTP_OK, 'OK',
             JSON.stringify({"jupyterBridgeVersion": VERSION}))
-        waitOnJupyterBridge()
     } else {
         var joiner = '?'
         for (let param in callSpec.params) {
@@ -192,50 +281,216 @@ function callCytoscape(callSpec) {
             joiner = '&'
         }
 
-        httpC.open(callSpec.command, localURL, true)
+        http.open(callSpec.command, localURL, true)
         for (let header in callSpec.headers) {
-            httpC.setRequestHeader(header, callSpec.headers[header])
+            http.setRequestHeader(header, callSpec.headers[header])
         }
 
         // Send request to Cytoscape ... reply goes to onreadystatechange handler
-        httpC.send(JSON.stringify(callSpec.data))
+        http.send(JSON.stringify(callSpec.data))
     }
 }
 
-function waitOnJupyterBridge() {
+function replyCytoscapeAndWaitOnJupyterBridge(replyStatus, replyStatusText, replyText) {
 
-    // Captures request from Jupyter bridge
+    // An older Jupyter bridge can't accept a reply and return the next request in one call ... use separate calls
+    if (!replyAndWaitSupported) {
+        replyCytoscape(replyStatus, replyStatusText, replyText)
+        waitOnJupyterBridge()
+        return
+    }
+
+    // Captures request from Jupyter bridge, or falls back to separate calls if the bridge doesn't have the route
     httpJ.onreadystatechange = function() {
         if (httpJ.readyState === 4) {
+            if (httpJ.status === HTTP_NOT_FOUND) {
+                if (showDebug) {
+                    console.log(' queue_reply_and_dequeue_request not available ... using queue_reply and dequeue_request')
+                }
+                replyAndWaitSupported = false
+                replyCytoscapeAndWaitOnJupyterBridge(replyStatus, replyStatusText, replyText)
+            } else if (httpJ.status === HTTP_TOO_MANY && httpJ.getResponseHeader('Retry-After')) {
+                // The channel's reply queue is full or calls are being limited ... send the same reply again after waiting
+                setTimeout(function() {
+                    replyCytoscapeAndWaitOnJupyterBridge(replyStatus, replyStatusText, replyText)
+                }, retryAfterMillis(httpJ))
+            } else if (httpJ.status !== 0) { // Status 0 means a network error, which onerror handles
+                receiveJupyterBridgeRequest('queue_reply_and_dequeue_request')
+            }
+        }
+    }
+
+    // A network error can come after the reply was queued (e.g., while waiting for the next request), so the error
+    // reply is sent only if the reply itself didn't get through. Watching the upload costs a CORS preflight, so only
+    // a reply long enough to be rejected is watched ... a short reply's network error just starts a new wait.
+    var replyData = replyBody(replyStatus, replyStatusText, replyText, requestFramed)
+    var replyWatched = replyData.length >= COMPRESS_MIN_LENGTH
+    var replyUploaded = false
+    httpJ.upload.onload = replyWatched ? function() { replyUploaded = true } : null
+
+    httpJ.onerror = function() {
+        if (!replyWatched || replyUploaded) {
             if (showDebug) {
-                console.log(' status from dequeue_request: ' + httpJ.status + ', reply: ' + httpJ.responseText)
+                console.log(' error from queue_reply_and_dequeue_request after reply was sent')
             }
-            try {
-                if (httpJ.status == HTTP_TOO_MANY) {
-                    // Nothing more to do ... the browser has created too many listeners,
-                    // and it's time to stop listening because the server saw a listener
-                    // listening on this channel before we got there.
-                    console.log('  shutting down because of redundant reader on channel: ' + Channel)
-                } else {
-                    if (httpJ.status === HTTP_TIMEOUT) {
-                        waitOnJupyterBridge()
-                    } else {
-                        callCytoscape(JSON.parse(httpJ.responseText))
-                    }
-                }
-            } catch(err) {
+            waitOnJupyterBridge()
+            return
+        }
+
+        // Clean up after Jupyter bridge accepts backup reply
+        httpRE.onreadystatechange = function() {
+            if (httpRE.readyState === 4) {
                 if (showDebug) {
-                    console.log(' exception calling Cytoscape: ' + err)
+                    console.log(' status from backup queue_reply: ' + httpRE.status + ', reply: ' + httpRE.responseText)
                 }
-                // Bad responseText means something bad happened that we don't understand.
-                // Go wait on another request, as there's nothing to call Cytoscape with.
                 waitOnJupyterBridge()
             }
         }
+
+        if (showDebug) {
+            console.log(' error from queue_reply_and_dequeue_request -- could be Jupyter-Bridge server reject')
+        }
+        var errReply = {'status': HTTP_SYS_ERR, 'reason': 'Jupyter-Bridge rejected reply', 'text': 'Possibly reply is too long for Jupyter-Bridge server'}
+        httpRE.open('POST', JupyterBridge + '/queue_reply?channel=' + Channel + requestIdParam(requestId), true)
+        httpRE.setRequestHeader('Content-Type', 'text/plain')
+        httpRE.send(JSON.stringify(errReply))
+    }
+
+    // Send reply to Jupyter bridge and wait for the next request
+    var jupyterBridgeURL = JupyterBridge + '/queue_reply_and_dequeue_request?channel=' + Channel + requestIdParam(requestId) + ackParam()
+    if (showDebug) {
+        console.log('Starting queue and dequeue on Jupyter bridge: ' + jupyterBridgeURL)
+    }
+    sendJupyterBridgeReply(httpJ, jupyterBridgeURL, replyData, requestFramed)
+}
+
+function receiveJupyterBridgeRequest(route) {
+    if (showDebug) {
+        console.log(' status from ' + route + ': ' + httpJ.status + ', reply: ' + httpJ.responseText)
+    }
+    try {
+        if (httpJ.status === HTTP_TOO_MANY && httpJ.getResponseHeader('Retry-After')) {
+            // Jupyter-Bridge is limiting calls on this channel or from this address ... wait, then listen again
+            setTimeout(waitOnJupyterBridge, retryAfterMillis(httpJ))
+        } else if (httpJ.status == HTTP_TOO_MANY) {
+            // Nothing more to do ... the browser has created too many listeners,
+            // and it's time to stop listening because the server saw a listener
+            // listening on this channel before we got there.
+            console.log('  shutting down because of redundant reader on channel: ' + Channel)
+        } else {
+            if (httpJ.status === HTTP_TIMEOUT) {
+                waitOnJupyterBridge()
+            } else if (!acknowledgeRequest(httpJ)) {
+                waitOnJupyterBridge() // Already executed
+            } else {
+                requestId = httpJ.getResponseHeader('X-Correlation-Id') || ''
+                var callSpec = JSON.parse(httpJ.responseText)
+                requestFramed = Boolean(callSpec.framed)
+                callCytoscape(callSpec)
+            }
+        }
+    } catch(err) {
+        if (showDebug) {
+            console.log(' exception calling Cytoscape: ' + err)
+        }
+        // Bad responseText means something bad happened that we don't understand.
+        // Go wait on another request, as there's nothing to call Cytoscape with.
+        waitOnJupyterBridge()
+    }
+}
+
+function sendJupyterBridgeReply(http, jupyterBridgeURL, replyText, framed) {
+    // Compress a long reply if the browser can. Jupyter-bridge is told of the compression by the encoding argument
+    // and of a framed reply by the type argument, because a Content-Encoding header or a Content-Type other than
+    // text/plain would cost a CORS preflight.
+    if (framed) {
+        jupyterBridgeURL = jupyterBridgeURL + '&type=' + encodeURIComponent(FRAMED_REPLY_TYPE)
+    }
+    var sendReply = function(url, body) {
+        http.open('POST', url, true)
+        http.setRequestHeader('Content-Type', 'text/plain')
+        http.send(body)
+    }
+    if (replyText.length >= COMPRESS_MIN_LENGTH && typeof CompressionStream !== 'undefined') {
+        var compressed = new Blob([replyText]).stream().pipeThrough(new CompressionStream('gzip'))
+        new Response(compressed).arrayBuffer().then(function(body) {
+            sendReply(jupyterBridgeURL + '&encoding=gzip', body)
+        }, function(err) {
+            if (showDebug) {
+                console.log(' exception compressing reply: ' + err)
+            }
+            sendReply(jupyterBridgeURL, replyText)
+        })
+    } else {
+        sendReply(jupyterBridgeURL, replyText)
+    }
+}
+
+function requestIdParam(id) {
+    return id ? '&id=' + encodeURIComponent(id) : ''
+}
+
+function ackParam() {
+    // Asks Jupyter-bridge to keep each request until it's acknowledged, and not to deliver again the requests that
+    // are still executing
+    return '&ack=' + ackId + (heldIds.length > 0 ? '&held=' + heldIds.join(',') : '')
+}
+
+function acknowledgeRequest(http) {
+    // Returns false for a request that was received before ... Jupyter-bridge delivers a request again if it didn't
+    // get the acknowledgement
+    var messageId = http.getResponseHeader('X-Message-Id') || ''
+    if (messageId && messageId === ackId) {
+        if (showDebug) {
+            console.log(' skipping request already received: ' + messageId)
+        }
+        return false
+    }
+    ackId = messageId
+    return true
+}
+
+function holdRequest(http) {
+    // Returns false for a request that is already executing ... otherwise, keeps its message ID until its reply
+    // acknowledges it (see releaseRequest)
+    var messageId = http.getResponseHeader('X-Message-Id') || ''
+    if (messageId && heldIds.indexOf(messageId) >= 0) {
+        if (showDebug) {
+            console.log(' skipping request already received: ' + messageId)
+        }
+        return false
+    }
+    if (messageId) {
+        heldIds.push(messageId)
+    }
+    return true
+}
+
+function releaseRequest(messageId) {
+    // Forgets a request once its reply has been sent ... if the reply didn't get through, the request is delivered again
+    var index = messageId ? heldIds.indexOf(messageId) : -1
+    if (index >= 0) {
+        heldIds.splice(index, 1)
+    }
+}
+
+function retryAfterMillis(http) {
+    return (parseFloat(http.getResponseHeader('Retry-After')) || 1) * 1000
+}
+
+function waitOnJupyterBridge() {
+
+    // Captures request from Jupyter bridge
+    httpJ.onreadystatechange = function() {
+        if (httpJ.readyState === 4) {
+            receiveJupyterBridgeRequest('dequeue_request')
+        }
     }
+    httpJ.onerror = null
+    httpJ.upload.onload = null
 
     // Wait for request from Jupyter bridge
-    var jupyterBridgeURL = JupyterBridge + '/dequeue_request?channel=' + Channel
+    var jupyterBridgeURL = JupyterBridge + '/dequeue_request?channel=' + Channel + ackParam()
     if (showDebug) {
         console.log('Starting dequeue on Jupyter bridge: ' + jupyterBridgeURL)
     }
@@ -243,9 +498,173 @@ function waitOnJupyterBridge() {
     httpJ.send()
 }
 
-// This kicks off a loop that ends by calling waitOnJupyterBridge again. This first call
-// ejects any dead readers before we start a read
-waitOnJupyterBridge() // Wait for message from Jupyter bridge, execute it, and return reply
+function fetchIntoWindow() {
+    // Only one dequeue_request can wait on the channel at a time, so requests are fetched one after another until the
+    // window is full or a command must execute alone
+    if (windowExclusive || windowBarrier || windowCommands >= CommandWindow) {
+        return
+    }
+
+    // Requests pushed on the WebSocket are taken from the backlog instead
+    if (socketMode) {
+        if (socketBacklog.length > 0) {
+            var next = socketBacklog.shift()
+            executeInWindow(next.callSpec, next.id, next.messageId)
+            fetchIntoWindow()
+        }
+        return
+    }
+    if (windowFetching) {
+        return
+    }
+
+    // Captures request from Jupyter bridge and fetches the next one while it executes
+    httpJ.onreadystatechange = function() {
+        if (httpJ.readyState === 4) {
+            windowFetching = false
+            if (showDebug) {
+                console.log(' status from dequeue_request: ' + httpJ.status + ', reply: ' + httpJ.responseText)
+            }
+            if (httpJ.status === HTTP_TOO_MANY && httpJ.getResponseHeader('Retry-After')) {
+                // Jupyter-Bridge is limiting calls on this channel or from this address ... wait, then fetch again
+                windowFetching = true
+                setTimeout(function() {
+                    windowFetching = false
+                    fetchIntoWindow()
+                }, retryAfterMillis(httpJ))
+                return
+            }
+            if (httpJ.status === HTTP_TOO_MANY) {
+                console.log('  shutting down because of redundant reader on channel: ' + Channel)
+                return
+            }
+            if (httpJ.status === HTTP_OK && holdRequest(httpJ)) {
+                var messageId = httpJ.getResponseHeader('X-Message-Id') || ''
+                try {
+                    executeInWindow(JSON.parse(httpJ.responseText), httpJ.getResponseHeader('X-Correlation-Id') || '', messageId)
+                } catch(err) {
+                    if (showDebug) {
+                        console.log(' exception calling Cytoscape: ' + err)
+                    }
+                    releaseRequest(messageId)
+                }
+            }
+            fetchIntoWindow()
+        }
+    }
+    httpJ.onerror = null
+    httpJ.upload.onload = null
+
+    var jupyterBridgeURL = JupyterBridge + '/dequeue_request?channel=' + Channel + ackParam()
+    if (showDebug) {
+        console.log('Starting dequeue on Jupyter bridge: ' + jupyterBridgeURL + ' (' + windowCommands + ' executing)')
+    }
+    windowFetching = true
+    httpJ.open('GET', jupyterBridgeURL, true)
+    httpJ.send()
+}
+
+function executeInWindow(callSpec, id, messageId) {
+    var exclusive = callSpec.command !== 'GET'
+    if (exclusive && windowCommands > 0) {
+        windowBarrier = {'callSpec': callSpec, 'id': id, 'messageId': messageId} // Execute after the commands ahead of it finish
+        return
+    }
+
+    windowCommands++
+    windowExclusive = exclusive
+    sendCytoscapeCommand(new XMLHttpRequest(), callSpec, function(replyStatus, replyStatusText, replyText) {
+        replyCytoscape(replyStatus, replyStatusText, replyText, id, new XMLHttpRequest(), new XMLHttpRequest(), Boolean(callSpec.framed), messageId)
+        windowCommands--
+        windowExclusive = false
+        if (windowBarrier && windowCommands === 0) {
+            var barrier = windowBarrier
+            windowBarrier = null
+            executeInWindow(barrier.callSpec, barrier.id, barrier.messageId)
+        }
+        fetchIntoWindow()
+    })
+}
+
+function openJupyterBridgeSocket() {
+    // Jupyter bridge pushes requests on the WebSocket (up to CommandWindow at a time). Each frame is a correlation ID
+    // and message ID, a newline and the request, and replies are sent back the same way, which acknowledges them. A
+    // request pushed on a lost WebSocket is pushed again on the next one unless it's still executing. If the WebSocket
+    // can't be opened (e.g., the Jupyter bridge doesn't serve them), is refused, or is lost and can't be reopened,
+    // fall back to long polling.
+    var socketURL = JupyterBridge.replace(/^http/, 'ws') + '/websocket?channel=' + Channel + '&window=' + CommandWindow + ackParam()
+    if (showDebug) {
+        console.log('Opening WebSocket to Jupyter bridge: ' + socketURL)
+    }
+    var socket = new WebSocket(socketURL)
+    socket.onopen = function() {
+        socketMode = true
+        bridgeSocket = socket
+        socketReconnectsLeft = SOCKET_MAX_RECONNECTS
+    }
+    socket.onmessage = function(event) {
+        var split = event.data.indexOf('\n')
+        var header = event.data.substring(0, split).split(' ')
+        if (showDebug) {
+            console.log(' request from WebSocket: ' + event.data)
+        }
+        var messageId = header[1] || ''
+        if (messageId && heldIds.indexOf(messageId) >= 0) {
+            return // Already executing
+        }
+        try {
+            socketBacklog.push({'callSpec': JSON.parse(event.data.substring(split + 1)), 'id': header[0], 'messageId': messageId})
+            if (messageId) {
+                heldIds.push(messageId)
+            }
+        } catch(err) {
+            if (showDebug) {
+                console.log(' exception parsing request: ' + err)
+            }
+            return
+        }
+        fetchIntoWindow()
+    }
+    socket.onclose = function(event) {
+        bridgeSocket = null
+        if (event.code === SOCKET_SHUTDOWN) {
+            console.log('  shutting down because of redundant reader on channel: ' + Channel + ' (' + event.reason + ')')
+        } else if (event.code !== SOCKET_TRY_AGAIN && event.code !== SOCKET_INTERNAL_ERROR && socketReconnectsLeft > 0) {
+            // The connection was lost ... open another, still holding off dequeue_request so that there's one reader
+            socketReconnectsLeft--
+            setTimeout(openJupyterBridgeSocket, SOCKET_RECONNECT_MILLIS)
+        } else {
+            // Jupyter bridge can't take a WebSocket now or failed on this one, or the last ones couldn't be reopened ... long poll instead
+            socketMode = false
+            dropSocketBacklog()
+            listenOnJupyterBridge()
+        }
+    }
+}
+
+function dropSocketBacklog() {
+    // Forgets the requests pushed on the WebSocket that haven't started executing, so that Jupyter bridge delivers them
+    // again through dequeue_request ... they weren't acknowledged, so they're still kept for redelivery
+    while (socketBacklog.length > 0) {
+        releaseRequest(socketBacklog.shift().messageId)
+    }
+}
+
+function listenOnJupyterBridge() {
+    // This kicks off a loop that ends by calling waitOnJupyterBridge again. This first call
+    // ejects any dead readers before we start a read
+    if (CommandWindow > 1) {
+        fetchIntoWindow() // Keep up to CommandWindow requests from Jupyter bridge executing, and return their replies
+    } else {
+        waitOnJupyterBridge() // Wait for message from Jupyter bridge, execute it, and return reply
+    }
+}
+
+if (UseWebSocket) {
+    openJupyterBridgeSocket()
+} else {
+    listenOnJupyterBridge()
+}
 
 if (showDebug) {
     alert("Jupyter-bridge browser component is started on " + JupyterBridge + ', channel ' + Channel)
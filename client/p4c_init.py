@@ -17,6 +17,8 @@
 #
 # * _PY4CYTOSCAPE ... names the actual module to be loaded (default: py4cytocape in PyPI)
 # * _PY4CYTOSCAPE_DEBUG_BROWSER ... True browser debug console output (default: False)
+# * _PY4CYTOSCAPE_COMMAND_WINDOW ... most read-only Cytoscape commands the browser executes at once (default: 1)
+# * _PY4CYTOSCAPE_WEBSOCKET ... True to have the browser try a WebSocket before long polling (default: False)
 #
 # Examples of plausible _PY4CYTOSCAPE values:
 #
@@ -116,6 +118,10 @@ else:
   # py4cytoscape web client needs to be loaded ... generate code and prepare it for loading
   if "_PY4CYTOSCAPE_DEBUG_BROWSER" not in globals():  _PY4CYTOSCAPE_DEBUG_BROWSER = False
   _PY4CYTOSCAPE_BROWSER_CLIENT_JS = p4c.get_browser_client_js(_PY4CYTOSCAPE_DEBUG_BROWSER)
+  if "_PY4CYTOSCAPE_COMMAND_WINDOW" in globals():
+    _PY4CYTOSCAPE_BROWSER_CLIENT_JS = f'var CommandWindow = {int(_PY4CYTOSCAPE_COMMAND_WINDOW)};\n' + _PY4CYTOSCAPE_BROWSER_CLIENT_JS
+  if "_PY4CYTOSCAPE_WEBSOCKET" in globals():
+    _PY4CYTOSCAPE_BROWSER_CLIENT_JS = f'var UseWebSocket = {"true" if _PY4CYTOSCAPE_WEBSOCKET else "false"};\n' + _PY4CYTOSCAPE_BROWSER_CLIENT_JS
   _PY4CYTOSCAPE_CHANNEL = p4c.get_browser_client_channel()
   print(f'Loading Javascript client ... {_PY4CYTOSCAPE_CHANNEL} on {p4c.get_jupyter_bridge_url()}')
   if _PY4CYTOSCAPE_RUNNING_IN_COLAB:
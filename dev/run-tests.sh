@@ -2,5 +2,8 @@ export PYTHONPATH=..
 source jupyter-bridge-env/bin/activate
 cd jupyter-bridge/server
 python3 -m unittest tests/test_jupyter_bridge.py
+python3 -m unittest tests/test_message_store.py
+python3 -m unittest tests/test_route_log.py
+python3 -m unittest tests/test_asgi.py
 deactivate
 cd ~
\ No newline at end of file
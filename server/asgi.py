@@ -0,0 +1,844 @@
+"""ASGI entry point for Jupyter-bridge, for serving many idle channels from a single process.
+
+Under uWSGI (wsgi.py), each call blocked in _dequeue (dequeue_request, dequeue_reply,
+queue_reply_and_dequeue_request or queue_request_and_dequeue_reply) occupies a whole worker process while it waits,
+so the number of concurrent channels is limited by the number of processes. Here, each waiter is a coroutine instead. All waiters in the process share a single redis pub/sub connection that receives the
+wakeups published by _enqueue, and they read and update their channel keys through an async redis client. The
+coroutines here mirror their namesakes in jupyter_bridge.py and decide by the same helpers (e.g., _DequeueState,
+_StreamWriter and _enqueue_params), so they differ only in how they call redis and how they wait.
+
+Routes that don't wait (ping, stats, queue_request and queue_reply) are delegated to the Flask app in
+jupyter_bridge.py, which executes them on a thread pool. So, both entry points share the same key layout,
+statistics and logging, and an ASGI server and a uWSGI server can serve the same redis instance at the same time.
+
+Only this entry point serves the /websocket endpoint, which pushes a channel's requests to its browser and takes its
+replies on one long-lived connection.
+
+To run, install an ASGI server with WebSocket support (e.g., pip install 'uvicorn[standard]') and start it from this
+directory:
+
+    uvicorn asgi:app --uds jupyter-bridge.sock
+
+"""
+import asyncio
+import math
+import sys
+import time
+from tempfile import SpooledTemporaryFile
+from urllib.parse import parse_qs
+
+import redis.asyncio
+
+import jupyter_bridge
+import message_store
+from jupyter_bridge import logger, _get_transaction_id, _exception_message, _channel_stripe, _correlation_id
+from jupyter_bridge import _begin_route_log, _end_route_log, _loggable
+from jupyter_bridge import _observe, _observe_route, _observe_enqueue, _count_waiter
+from jupyter_bridge import _enqueue_params, _enqueue_result, _dequeue_result, _dequeue_timeout_secs, _DequeueState
+from jupyter_bridge import _request_discard_key, _log_discarded_reply, _streams_reply, _reply_stream
+from jupyter_bridge import _pad_message, _message_chunks, _ack_id, _held_ids
+from jupyter_bridge import _content_encoding, _reply_content_type, _stored_message, _stored_request, _readable_message, _sent_encoding, _decompressor
+from jupyter_bridge import StreamedMessage, _StreamWriter, _StreamReader
+from jupyter_bridge import SpooledMessage, _spoolable, _spool_message, _unspool_message, _spooled_file, _accel_redirect, SPOOL_ACCEL_PREFIX
+from jupyter_bridge import ChannelFullException, ZombieChannelException
+from jupyter_bridge import _admission_params, _admission_result
+from jupyter_bridge import NOTEBOOK, BROWSER
+from jupyter_bridge import CHANNEL_MUTEX_COUNT, DEQUEUE_TIMEOUT_SECS, DEQUEUE_IDLE_STATUS, QUEUE_FULL_RETRY_SECS
+from jupyter_bridge import _drain_result, _drain_check_due, _WakeupFanout, WAKEUP_START_SECS, NODE, DRAIN
+from jupyter_bridge import STREAM_CHUNK_BYTES, STREAM_CHUNK_TIMEOUT_SECS, EXPIRE_SECS
+from jupyter_bridge import STREAM_END, STREAM_ABORTED
+from jupyter_bridge import HTTP_OK, HTTP_SYS_ERR, HTTP_TIMEOUT, HTTP_TOO_MANY
+from jupyter_bridge import DEQUEUE_BUSY, REPLY, REQUEST, CORRELATION_ID_HEADER, MESSAGE_ID_HEADER, JSON_TYPE, PLAIN_TYPE, FRAMED_REPLY_TYPE
+from jupyter_bridge import ENQUEUE_SCRIPT, DEQUEUE_SCRIPT, RATE_LIMIT_SCRIPT
+from jupyter_bridge import STORE_URL, STORE_POOL_SIZE, STORE_SHARDS
+
+MAX_SPOOLED_BODY_BYTES = 65536 # Request bodies larger than this are spooled to a temporary file before calling Flask
+MAX_SOCKET_WINDOW = 64 # Most requests a browser can hold on its WebSocket without having replied to them
+SOCKET_SHUTDOWN = 4429 # WebSocket close code that tells a browser to stop listening (as an HTTP 429 does)
+SOCKET_TRY_AGAIN = 1013 # WebSocket close code that tells a browser to listen by long polling instead
+SOCKET_POLICY_VIOLATION = 1008
+SOCKET_INTERNAL_ERROR = 1011 # WebSocket close code that tells a browser the server failed ... it listens by long polling instead
+SOCKET_SERVICE_RESTART = 1012 # WebSocket close code that tells a browser to reconnect (e.g., to a server that isn't draining)
+CLEANUP_TIMEOUT_SECS = 5 # Longest a cancelled dequeue waits for redis to reset its busy flag
+
+if STORE_URL == message_store.LOCAL_STORE: # A local store lives in the Flask app's process, and can't be shared
+    raise Exception('The ASGI server needs a redis message store ... set JUPYTER_STORE_URL to a redis URL')
+
+def _open_store(url):
+    if STORE_POOL_SIZE:
+        return redis.asyncio.Redis(connection_pool=redis.asyncio.BlockingConnectionPool.from_url(url, max_connections=STORE_POOL_SIZE,
+                                                                                               timeout=message_store.POOL_TIMEOUT_SECS))
+    return redis.asyncio.Redis.from_url(url)
+
+# As in jupyter_bridge, channels' keys are kept in the shard that their channel IDs hash to, if there are shards
+redis_db = _open_store(STORE_URL)
+channel_stores = message_store.ShardRing({url: _open_store(url) for url in STORE_SHARDS} if STORE_SHARDS else {STORE_URL: redis_db})
+enqueue_script = redis_db.register_script(ENQUEUE_SCRIPT)
+dequeue_script = redis_db.register_script(DEQUEUE_SCRIPT)
+rate_limit_script = redis_db.register_script(RATE_LIMIT_SCRIPT)
+
+# Coroutine counterparts of jupyter_bridge.channel_mutexes, assigned to channels the same way. A dequeue route holds
+# its channel's mutex, and _dequeue releases it while waiting for a message.
+channel_mutexes = [asyncio.Lock() for _ in range(CHANNEL_MUTEX_COUNT)]
+
+
+class _SocketWindow:
+    """Counts the requests a browser holds on its WebSocket without having replied to them. For a browser that
+    acknowledges requests, it also keeps the message IDs of the requests the browser holds, so they aren't pushed again.
+    """
+
+    def __init__(self, size, held=None):
+        self.size = size
+        self.unanswered = 0
+        self.held = held # None if the browser doesn't acknowledge requests
+        self.changed = asyncio.Condition()
+
+    def dequeue_ack(self):
+        # The ack and held arguments of the next dequeue (see _ack_id and _held_ids)
+        return (None, '') if self.held is None else ('', ','.join(sorted(self.held)))
+
+    async def claim(self):
+        # Waits until the browser can hold another request
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.unanswered < self.size)
+            self.unanswered += 1
+
+    async def answer(self, ack=''):
+        async with self.changed:
+            if self.held is not None:
+                self.held.difference_update(ack.split(','))
+            if self.unanswered > 0:
+                self.unanswered -= 1
+                self.changed.notify_all()
+
+    async def drain(self):
+        # Waits until the browser has replied to all of the requests it holds
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.unanswered == 0)
+
+
+class _Wakeups(_WakeupFanout):
+    """Runs a listener task per store for the coroutines waiting in _dequeue. Waiters send their keys' SUBSCRIBEs and
+    UNSUBSCRIBEs on the listeners' subscriptions themselves, one at a time, so that they're sent in the order they're
+    decided on. If a listener fails, the next waiter starts new listeners.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._listeners = []
+        self._subscribing = 0 # Listeners that haven't subscribed yet
+        self._started = None
+        self._commands = asyncio.Lock() # Held from deciding on a subscription's command until it's sent
+
+    async def start(self):
+        # Starts the listeners if they aren't running, and returns whether it did
+        restarted = self._started is None
+        if restarted:
+            self._started = asyncio.get_running_loop().create_future()
+            self._subscribing = len(channel_stores.stores())
+            self._listeners = [asyncio.create_task(self._listen(store)) for store in channel_stores.stores()]
+        await asyncio.shield(self._started)
+        return restarted
+
+    async def stop(self):
+        listeners, self._listeners = self._listeners, []
+        for listener in listeners:
+            listener.cancel()
+        await asyncio.gather(*listeners, return_exceptions=True) # Each closes its subscription
+        with self.lock:
+            self._unregistered()
+        self._started = None
+
+    async def add(self, key, store):
+        # Adds a waiter on a key kept in the given store, and returns the event it waits on once the key's
+        # subscription is confirmed
+        event = self._event()
+        try:
+            async with self._commands:
+                with self.lock:
+                    subscription, confirmation = self._added(key, store, event)
+                if subscription is not None:
+                    await subscription.subscribe(key)
+            if confirmation is not None:
+                await asyncio.wait_for(confirmation.wait(), WAKEUP_START_SECS)
+        except BaseException:
+            await _uncancelled(self.remove(key, event), CLEANUP_TIMEOUT_SECS)
+            raise
+        return event
+
+    async def remove(self, key, event):
+        async with self._commands:
+            with self.lock:
+                subscription = self._removed(key, event)
+            if subscription is not None:
+                try:
+                    await subscription.unsubscribe(key)
+                except Exception as e: # The listener fails, too, and its replacement won't subscribe to the key
+                    logger.debug(f'asgi wakeup unsubscribe exception {e!r}')
+
+    async def wait(self, event, timeout):
+        # Not asyncio.wait_for, which can swallow the waiter's cancellation if the event is set at the same time (so
+        # a WebSocket's request pusher could outlive its socket)
+        waiter = asyncio.ensure_future(event.wait())
+        try:
+            await asyncio.wait({waiter}, timeout=timeout)
+        finally:
+            waiter.cancel()
+        event.clear()
+
+    def _event(self):
+        return asyncio.Event()
+
+    async def _listen(self, store):
+        wakeup = store.pubsub()
+        try:
+            async with self._commands:
+                with self.lock:
+                    channels = self._registered(store, wakeup)
+                await wakeup.subscribe(*channels)
+            while True:
+                message = await wakeup.get_message(timeout=None)
+                if message is not None and self._received(message, wakeup):
+                    self._subscribing -= 1
+                    if self._subscribing <= 0 and not self._started.done():
+                        self._started.set_result(True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug(f'asgi wakeup listener exception {e!r}')
+            if self._started and not self._started.done():
+                self._started.set_exception(e)
+            for listener in self._listeners: # Next waiter restarts the listeners
+                if listener is not asyncio.current_task():
+                    listener.cancel()
+            self._listeners = []
+            self._started = None
+            with self.lock:
+                self._unregistered()
+            self._wake() # Current waiters re-read their keys
+        finally:
+            await wakeup.aclose()
+
+wakeups = _Wakeups()
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+    elif scope['type'] == 'websocket':
+        if scope['path'] == '/websocket':
+            _begin_route_log('websocket')
+            try:
+                await _websocket_route(scope, receive, send)
+            finally:
+                _end_route_log(None)
+        else:
+            await send({'type': 'websocket.close', 'code': SOCKET_POLICY_VIOLATION})
+    elif scope['type'] == 'http':
+        if scope['path'] in NATIVE_ROUTES and scope['method'] != 'OPTIONS': # Flask answers CORS preflights
+            # Each request runs in a task of its own, so its route log is its own, too (as in jupyter_bridge's
+            # before_request and after_request)
+            status = []
+            async def send_status(event):
+                if event['type'] == 'http.response.start':
+                    status.append(event['status'])
+                await send(event)
+            route_started = time.monotonic()
+            _begin_route_log(scope['path'][1:])
+            try:
+                args = parse_qs(scope['query_string'].decode('latin-1'))
+                retry_secs = await _admission_wait(args['channel'][0] if 'channel' in args else None,
+                                                   scope['client'][0] if scope.get('client') else None)
+                if retry_secs:
+                    await _send_response(send_status, *_rate_limited_response(retry_secs))
+                else:
+                    await NATIVE_ROUTES[scope['path']](scope, receive, send_status)
+            finally:
+                _end_route_log(status[0] if status else None)
+                _observe_route(scope['path'][1:], status[0] if status else None, route_started)
+        else:
+            await _call_flask(scope, receive, send)
+    else:
+        raise Exception(f'Unsupported ASGI scope type {scope["type"]}')
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await wakeups.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await wakeups.stop()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def _dequeue_route(scope, send, route, operation):
+    local_transaction = _get_transaction_id()
+
+    logger.debug(f'into {route} ({local_transaction})')
+    try:
+        args = parse_qs(scope['query_string'].decode('latin-1'), keep_blank_values=True)
+        if 'channel' in args:
+            channel = args['channel'][0]
+            correlation_id = _correlation_id(args['id'][0] if 'id' in args else None)
+            pad = _pad_message(args['pad'][0] if 'pad' in args else None)
+            ack = _ack_id(args['ack'][0] if 'ack' in args else None)
+            held = _held_ids(args['held'][0] if 'held' in args else None)
+            async with _channel_mutex(channel):
+                message, encoding, correlation_id, valid_reader, content_type, ack_id = await _dequeue(local_transaction, operation, channel, 'reset' in args,
+                                                                                                       correlation_id=correlation_id, ack=ack,
+                                                                                                       side=BROWSER if operation == REQUEST else NOTEBOOK,
+                                                                                                       held=held) # Will wait for message
+            response = await _dequeue_response(message, encoding, correlation_id, valid_reader, pad, _header(scope, b'accept-encoding'), content_type, ack_id)
+        else:
+            raise Exception('Channel is missing in parameter list')
+    except ZombieChannelException as e:
+        logger.debug(f'{route} ({local_transaction}) exception {e!r}')
+        response = _zombie_channel_response(e)
+    except Exception as e:
+        logger.debug(f'{route} ({local_transaction}) exception {e!r}')
+        response = (HTTP_SYS_ERR, 'text/plain', _exception_message(e).encode('utf-8'))
+    finally:
+        logger.debug(f'out of {route} ({local_transaction})')
+
+    await _send_response(send, *response)
+
+async def _queue_reply_and_dequeue_request_route(scope, receive, send):
+    local_transaction = _get_transaction_id()
+
+    logger.debug(f'into queue_reply_and_dequeue_request ({local_transaction})')
+    try:
+        args = parse_qs(scope['query_string'].decode('latin-1'), keep_blank_values=True)
+        if 'channel' in args:
+            channel = args['channel'][0]
+            correlation_id = _correlation_id(args['id'][0] if 'id' in args else None)
+            pad = _pad_message(args['pad'][0] if 'pad' in args else None)
+            ack = _ack_id(args['ack'][0] if 'ack' in args else None)
+            reply_type = _reply_content_type(_header(scope, b'content-type'), args['type'][0] if 'type' in args else None)
+            if reply_type is not None:
+                await _enqueue_reply(local_transaction, scope, receive, args, channel, correlation_id, reply_type)
+                async with _channel_mutex(channel):
+                    message, encoding, correlation_id, valid_reader, content_type, ack_id = await _dequeue(local_transaction, REQUEST, channel, False, ack=ack,
+                                                                                                           side=BROWSER) # Will wait for message
+                response = await _dequeue_response(message, encoding, correlation_id, valid_reader, pad, _header(scope, b'accept-encoding'), content_type, ack_id)
+            else:
+                raise Exception(f'Payload must be {PLAIN_TYPE} or {FRAMED_REPLY_TYPE}')
+        else:
+            raise Exception('Channel is missing in parameter list')
+    except ChannelFullException as e:
+        logger.debug(f'queue_reply_and_dequeue_request ({local_transaction}) exception {e!r}')
+        response = _channel_full_response(e)
+    except ZombieChannelException as e:
+        logger.debug(f'queue_reply_and_dequeue_request ({local_transaction}) exception {e!r}')
+        response = _zombie_channel_response(e)
+    except Exception as e:
+        logger.debug(f'queue_reply_and_dequeue_request ({local_transaction}) exception {e!r}')
+        response = (HTTP_SYS_ERR, 'text/plain', _exception_message(e).encode('utf-8'))
+    finally:
+        logger.debug(f'out of queue_reply_and_dequeue_request ({local_transaction})')
+
+    await _send_response(send, *response)
+
+async def _queue_request_and_dequeue_reply_route(scope, receive, send):
+    local_transaction = _get_transaction_id()
+
+    logger.debug(f'into queue_request_and_dequeue_reply ({local_transaction})')
+    try:
+        args = parse_qs(scope['query_string'].decode('latin-1'), keep_blank_values=True)
+        if 'channel' in args:
+            channel = args['channel'][0]
+            correlation_id = _correlation_id(args['id'][0] if 'id' in args else None)
+            pad = _pad_message(args['pad'][0] if 'pad' in args else None)
+            ack = _ack_id(args['ack'][0] if 'ack' in args else None)
+            timeout_secs = _dequeue_timeout_secs(args['timeout'][0] if 'timeout' in args else None)
+            if _header(scope, b'content-type').startswith('application/json'):
+                message, encoding, calls = await _read_request(scope, receive, args)
+                async with _channel_mutex(channel):
+                    await _enqueue_request(local_transaction, 'queue_request_and_dequeue_reply', channel, message, correlation_id, calls, encoding)
+                    message, encoding, correlation_id, valid_reader, content_type, ack_id = await _dequeue(local_transaction, REPLY, channel, False, timeout_secs,
+                                                                                                           correlation_id=correlation_id, ack=ack,
+                                                                                                           side=NOTEBOOK) # Will wait for message
+                response = await _dequeue_response(message, encoding, correlation_id, valid_reader, pad, _header(scope, b'accept-encoding'), content_type, ack_id)
+            else:
+                raise Exception('Payload must be application/json')
+        else:
+            raise Exception('Channel is missing in parameter list')
+    except ChannelFullException as e:
+        logger.debug(f'queue_request_and_dequeue_reply ({local_transaction}) exception {e!r}')
+        response = _channel_full_response(e)
+    except Exception as e:
+        logger.debug(f'queue_request_and_dequeue_reply ({local_transaction}) exception {e!r}')
+        response = (HTTP_SYS_ERR, 'text/plain', _exception_message(e).encode('utf-8'))
+    finally:
+        logger.debug(f'out of queue_request_and_dequeue_reply ({local_transaction})')
+
+    await _send_response(send, *response)
+
+NATIVE_ROUTES = {'/dequeue_request': lambda scope, receive, send: _dequeue_route(scope, send, 'dequeue_request', REQUEST),
+                 '/dequeue_reply': lambda scope, receive, send: _dequeue_route(scope, send, 'dequeue_reply', REPLY),
+                 '/queue_reply_and_dequeue_request': _queue_reply_and_dequeue_request_route,
+                 '/queue_request_and_dequeue_reply': _queue_request_and_dequeue_reply_route}
+
+async def _websocket_route(scope, receive, send):
+    # Pushes a channel's requests to its browser as soon as they're queued, and queues the replies the browser sends
+    # back on the same socket, so an idle channel costs no calls. Each frame is a correlation ID (possibly empty), a
+    # newline, and a request or reply ... a reply in a text frame is plain, and a reply in a binary frame is framed
+    # (see FRAMED_REPLY_TYPE). The browser holds up to `window` requests at a time (1 by default), and more are
+    # pushed as it replies. As with dequeue_request, a redundant reader or a rejected zombie browser is told to stop
+    # listening (by close code 4429). A browser that passes `ack` (see _ack_id) acknowledges each request with its
+    # reply: a request's correlation ID is followed by a space and its message ID, and the reply's correlation ID is
+    # followed by the same. Requests pushed and not acknowledged are pushed again on the channel's next socket, except
+    # those the browser says it still holds (see _held_ids). If pushing fails, the socket is closed with code 1011.
+    local_transaction = _get_transaction_id()
+
+    logger.debug(f'into websocket ({local_transaction})')
+    try:
+        if (await receive())['type'] != 'websocket.connect':
+            return
+        args = parse_qs(scope['query_string'].decode('latin-1'), keep_blank_values=True)
+        if 'channel' not in args:
+            logger.debug(f'websocket ({local_transaction}) exception: Channel is missing in parameter list')
+            await send({'type': 'websocket.close', 'code': SOCKET_POLICY_VIOLATION})
+            return
+        channel = args['channel'][0]
+        window = min(max(int(args['window'][0]), 1), MAX_SOCKET_WINDOW) if 'window' in args else 1
+        held = _held_ids(args['held'][0] if 'held' in args else None)
+        if await _admission_wait(channel, scope['client'][0] if scope.get('client') else None):
+            await send({'type': 'websocket.close', 'code': SOCKET_TRY_AGAIN}) # The browser falls back to long polling, which is told when to retry
+            return
+        await send({'type': 'websocket.accept'})
+
+        window = _SocketWindow(window, set(filter(None, held.split(','))) if 'ack' in args else None)
+        pusher = asyncio.create_task(_push_requests(local_transaction, channel, send, window))
+        receiver = None
+        try:
+            while True:
+                # Watch the pusher while waiting for the browser, so the socket isn't left open without one
+                receiver = receiver or asyncio.ensure_future(receive())
+                done, _ = await asyncio.wait({receiver, pusher}, return_when=asyncio.FIRST_COMPLETED)
+                if pusher in done:
+                    if pusher.exception() is not None:
+                        logger.debug(f'websocket ({local_transaction}) pusher exception {pusher.exception()!r}')
+                        await send({'type': 'websocket.close', 'code': SOCKET_INTERNAL_ERROR, 'reason': 'Request pusher failed'})
+                    break
+                message = receiver.result()
+                receiver = None
+                if message['type'] == 'websocket.disconnect':
+                    break
+                elif message['type'] == 'websocket.receive':
+                    await window.answer(await _queue_socket_reply(local_transaction, scope, channel, message))
+        finally:
+            if receiver is not None:
+                receiver.cancel()
+            pusher.cancel() # Its dequeue finishes cleaning up (see _uncancelled) before it stops
+            await asyncio.wait({pusher})
+    except Exception as e:
+        logger.debug(f'websocket ({local_transaction}) exception {e!r}')
+    finally:
+        logger.debug(f'out of websocket ({local_transaction})')
+
+async def _push_requests(local_transaction, channel, send, window):
+    while True:
+        if await _draining(): # Once the browser has replied to what it holds, it reconnects elsewhere
+            await window.drain()
+            await send({'type': 'websocket.close', 'code': SOCKET_SERVICE_RESTART, 'reason': 'Draining'})
+            return
+        await window.claim()
+        ack, held = window.dequeue_ack()
+        try:
+            async with _channel_mutex(channel):
+                message, encoding, correlation_id, valid_reader, _, ack_id = await _dequeue(local_transaction, REQUEST, channel, False, ack=ack,
+                                                                                            side=BROWSER, held=held) # Will wait for message
+        except ZombieChannelException as e:
+            logger.debug(f'websocket ({local_transaction}) exception {e!r}')
+            await send({'type': 'websocket.close', 'code': SOCKET_SHUTDOWN, 'reason': str(e)})
+            return
+        if not valid_reader:
+            await send({'type': 'websocket.close', 'code': SOCKET_SHUTDOWN, 'reason': 'Redundant reader'})
+            return
+        if message is None:
+            window.unanswered -= 1
+        else:
+            frame = await asyncio.get_running_loop().run_in_executor(None, _socket_frame, message, encoding, correlation_id, ack_id)
+            if ack_id:
+                window.held.add(ack_id)
+            await send({'type': 'websocket.send', 'text': frame})
+
+async def _queue_socket_reply(local_transaction, scope, channel, message):
+    # Queues a reply that arrived on a WebSocket, waiting while the channel's reply queue is full or the browser is
+    # calling too often (which slows the browser down instead of failing the reply). Returns the message IDs of the
+    # requests that the reply acknowledges.
+    if message.get('text') is not None:
+        frame, content_type = message['text'].encode('utf-8'), ''
+    else:
+        frame, content_type = message.get('bytes') or b'', FRAMED_REPLY_TYPE
+    correlation_id, _, reply = frame.partition(b'\n')
+    correlation_id, _, ack = correlation_id.partition(b' ')
+    try:
+        correlation_id = _correlation_id(correlation_id.decode('latin-1'))
+        ack = _ack_id(ack.decode('latin-1'))
+    except Exception as e:
+        logger.debug(f'websocket ({local_transaction}) exception {e!r}')
+        return ''
+    retry_secs = await _admission_wait(channel, scope['client'][0] if scope.get('client') else None)
+    if retry_secs:
+        await asyncio.sleep(retry_secs)
+    reply, encoding = await asyncio.get_running_loop().run_in_executor(None, _stored_message, reply, '')
+    while True:
+        try:
+            async with _channel_mutex(channel):
+                await _enqueue(local_transaction, REPLY, channel, reply, correlation_id, encoding=encoding, content_type=content_type, ack=ack,
+                               side=BROWSER)
+            return ack
+        except ChannelFullException as e:
+            logger.debug(f'websocket ({local_transaction}) exception {e!r}')
+            await asyncio.sleep(QUEUE_FULL_RETRY_SECS)
+
+def _socket_frame(message, encoding, correlation_id, ack_id=''):
+    # Returns a request as a WebSocket text frame
+    if isinstance(message, SpooledMessage):
+        with _spooled_file(message) as spool_file:
+            message = spool_file.read()
+    elif isinstance(message, StreamedMessage):
+        raise Exception('Streamed requests cannot be sent on a WebSocket')
+    message, _ = _readable_message(message, encoding, None)
+    return correlation_id + (' ' + ack_id if ack_id else '') + '\n' + message.decode('utf-8')
+
+async def _dequeue_response(message, encoding, correlation_id, valid_reader, pad, accept_encoding, content_type=JSON_TYPE, ack_id=''):
+    if valid_reader:
+        if message is None:
+            return HTTP_TIMEOUT, 'text/plain', b''
+        accel_redirect = None
+        if isinstance(message, StreamedMessage):
+            sent_encoding = _sent_encoding(encoding, accept_encoding) if encoding else ''
+            body = _stream_chunks(message, encoding, sent_encoding)
+            encoding = sent_encoding
+        elif isinstance(message, SpooledMessage):
+            sent_encoding = _sent_encoding(encoding, accept_encoding) if encoding else ''
+            if SPOOL_ACCEL_PREFIX and sent_encoding == encoding and content_type == JSON_TYPE: # nginx sends it as JSON
+                accel_redirect = _accel_redirect(message)
+                body = b''
+            else:
+                body = _spooled_chunks(_spooled_file(message), _decompressor(encoding) if sent_encoding != encoding else None)
+            encoding = sent_encoding
+        else:
+            if encoding: # Decompressing a large message would hold up other callers
+                message, encoding = await asyncio.get_running_loop().run_in_executor(None, _readable_message, message, encoding, accept_encoding)
+            body = _message_chunks(message, pad and not encoding and content_type == JSON_TYPE)
+        headers = [(b'access-control-expose-headers', f'{CORRELATION_ID_HEADER}, {MESSAGE_ID_HEADER}'.encode('latin-1')), (b'vary', b'Accept-Encoding')]
+        if correlation_id:
+            headers.append((CORRELATION_ID_HEADER.lower().encode('latin-1'), correlation_id.encode('latin-1')))
+        if ack_id:
+            headers.append((MESSAGE_ID_HEADER.lower().encode('latin-1'), ack_id.encode('latin-1')))
+        if encoding:
+            headers.append((b'content-encoding', encoding.encode('latin-1')))
+        if accel_redirect:
+            headers.append((b'x-accel-redirect', accel_redirect.encode('latin-1')))
+        return HTTP_OK, content_type, body, headers
+    else:
+        return HTTP_TOO_MANY, 'text/plain', b''
+
+def _channel_full_response(e):
+    return HTTP_TOO_MANY, 'text/plain', str(e).encode('utf-8'), \
+           [(b'access-control-expose-headers', b'Retry-After'), (b'retry-after', str(QUEUE_FULL_RETRY_SECS).encode('latin-1'))]
+
+async def _admission_wait(channel, address):
+    params = _admission_params(channel, address)
+    if params is None:
+        return 0
+    try:
+        return _admission_result(await rate_limit_script(**params))
+    except Exception as e:
+        logger.debug(f'_admission_wait exception {e!r}')
+        return 0
+
+def _rate_limited_response(retry_secs):
+    logger.debug(f'rate limited for {retry_secs} seconds')
+    return HTTP_TOO_MANY, 'text/plain', f'Too many calls ... retry after {retry_secs:.3f} seconds'.encode('utf-8'), \
+           [(b'access-control-expose-headers', b'Retry-After'), (b'retry-after', str(math.ceil(retry_secs)).encode('latin-1'))]
+
+def _zombie_channel_response(e):
+    return HTTP_TOO_MANY, 'text/plain', str(e).encode('utf-8')
+
+async def _enqueue_request(local_transaction, route, channel, msg, correlation_id, calls=1, encoding=''):
+    last_reply = await _enqueue(local_transaction, REQUEST, channel, msg, correlation_id, discard_key=_request_discard_key(channel, correlation_id),
+                                calls=calls, encoding=encoding)
+    _log_discarded_reply(local_transaction, route, last_reply, msg)
+
+async def _enqueue(local_transaction, operation, channel, msg, correlation_id='', discard_key=None, calls=1, encoding='', content_type='', ack='', side=''):
+    key = f'{channel}:{operation}'
+    logger.debug(f' into _enqueue ({local_transaction}): key: {key}, correlation_id: {correlation_id}, encoding: {encoding}, content_type: {content_type}, ack: {ack}, side: {side}')
+    logger.debug(f'  _enqueue ({local_transaction}) sends: {_loggable(msg)}')
+    try:
+        spooled = await asyncio.get_running_loop().run_in_executor(None, _spool_message, msg) if _spoolable(msg) else None
+        try:
+            params = _enqueue_params(key, operation, spooled or msg, correlation_id, discard_key, calls, encoding, content_type, ack, side)
+            started = time.monotonic()
+            result = await enqueue_script(**params, client=_channel_store(channel))
+            _observe_enqueue(operation, params, started)
+            return _enqueue_result(key, result)
+        except Exception:
+            if spooled:
+                _unspool_message(spooled)
+            raise
+    finally:
+        logger.debug(f' out of _enqueue ({local_transaction})')
+
+async def _dequeue(local_transaction, operation, channel, reset_first, timeout_secs=DEQUEUE_TIMEOUT_SECS, correlation_id='', ack=None, side='', held=''):
+    dequeue = _DequeueState(local_transaction, operation, channel, reset_first, timeout_secs, correlation_id, ack, side, held)
+    channel_mutex = _channel_mutex(channel)
+    store = _channel_store(channel)
+    try:
+        # Register for a wakeup before the claim so that a message posted between the claim and the wait isn't missed
+        await wakeups.start()
+        event = await wakeups.add(dequeue.key, store)
+        try:
+            if dequeue.claimed(await _dequeue_attempt(store, dequeue.claim(await _draining()))):
+                _count_waiter(operation, 1)
+                try:
+                    while dequeue.waiting():
+                        channel_mutex.release()
+                        try:
+                            if not await wakeups.start(): # Listeners that had to be restarted may have missed the wakeup
+                                await wakeups.wait(event, dequeue.remaining_secs())
+                        finally:
+                            await _uncancelled(channel_mutex.acquire()) # The caller's `async with` releases it
+                        dequeue.checked_drain(await _draining())
+                        dequeue.took(await _dequeue_attempt(store, dequeue.attempt()))
+                    if not dequeue.released:
+                        dequeue.took(await _dequeue_attempt(store, dequeue.attempt(release=True)))
+                finally:
+                    _count_waiter(operation, -1)
+        finally:
+            await _uncancelled(wakeups.remove(dequeue.key, event), CLEANUP_TIMEOUT_SECS)
+    finally:
+        if not dequeue.released:
+            await _uncancelled(store.hset(dequeue.key, DEQUEUE_BUSY, DEQUEUE_IDLE_STATUS), CLEANUP_TIMEOUT_SECS)
+        logger.debug(f' out of _dequeue ({local_transaction})')
+
+    return dequeue.result()
+
+async def _dequeue_attempt(store, params):
+    started = time.monotonic()
+    result = await dequeue_script(**params, client=store)
+    _observe('jupyter_bridge_redis_seconds', 'script="dequeue"', time.monotonic() - started)
+    return _dequeue_result(params['keys'][0], result)
+
+async def _uncancelled(awaitable, timeout_secs=None):
+    # Awaits a step of a dequeue's cleanup to its end even if the caller is cancelled meanwhile (e.g., a WebSocket's
+    # request pusher when its socket closes), and then passes the cancellation on. A cancelled mutex acquire would leave
+    # the caller's `async with` releasing a mutex it doesn't hold, and a cancelled redis call would leave a busy flag
+    # behind. A step that takes longer than timeout_secs is abandoned.
+    step = asyncio.ensure_future(awaitable)
+    deadline = None if timeout_secs is None else time.monotonic() + timeout_secs
+    cancelled = False
+    while not step.done():
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            step.cancel()
+            break
+        try:
+            await asyncio.wait({step}, timeout=remaining)
+        except asyncio.CancelledError:
+            cancelled = True
+    if cancelled:
+        if step.done() and not step.cancelled():
+            step.exception() # Retrieved, so it isn't reported as unhandled
+        raise asyncio.CancelledError()
+    if not step.done() or step.cancelled():
+        raise asyncio.TimeoutError(f'Cleanup step took longer than {timeout_secs} seconds')
+    return step.result()
+
+def _channel_mutex(channel):
+    return channel_mutexes[_channel_stripe(channel)]
+
+async def _draining():
+    if _drain_check_due():
+        _drain_result(await redis_db.get(f'{DRAIN}:{NODE}'))
+    return jupyter_bridge.draining
+
+def _channel_store(channel):
+    return channel_stores.store(channel)
+
+def _header(scope, name):
+    for header_name, value in scope['headers']:
+        if header_name == name:
+            return value.decode('latin-1')
+    return ''
+
+async def _enqueue_reply(local_transaction, scope, receive, args, channel, correlation_id, content_type=''):
+    encoding = _content_encoding(_header(scope, b'content-encoding'), args['encoding'][0] if 'encoding' in args else None)
+    content_length = _header(scope, b'content-length')
+    if not _streams_reply(int(content_length) if content_length else None):
+        message, encoding = await _read_message(scope, receive, args)
+        async with _channel_mutex(channel):
+            await _enqueue(local_transaction, REPLY, channel, message, correlation_id, encoding=encoding, content_type=content_type)
+    else:
+        message, stored_encoding, compress = _reply_stream(channel, encoding)
+        async with _channel_mutex(channel):
+            await _enqueue(local_transaction, REPLY, channel, message, correlation_id, encoding=stored_encoding, content_type=content_type)
+        await _stream_message(local_transaction, REPLY, message, receive, compress)
+
+async def _stream_message(local_transaction, operation, message, receive, compress):
+    logger.debug(f' into _stream_message ({local_transaction}): key: {message.key}, compress: {compress}')
+    writer = _StreamWriter(compress)
+    end_tag = STREAM_ABORTED
+    try:
+        more = True
+        while more:
+            event = await receive()
+            if event['type'] == 'http.disconnect':
+                raise Exception('Caller disconnected before sending payload')
+            more = event.get('more_body', False)
+            for chunk in writer.chunks(event.get('body', b''), more):
+                await _push_chunk(message, chunk)
+        end_tag = STREAM_END
+    finally:
+        await _push_chunk(message, end_tag) # If the upload fails, the reader must not wait for the rest of it
+        await _channel_store(message.channel).hincrby(writer.statistics_key, operation, writer.stream_bytes)
+        logger.debug(f' out of _stream_message ({local_transaction}): {writer.stream_bytes} bytes, end: {end_tag}')
+
+async def _push_chunk(message, chunk):
+    pipeline = _channel_store(message.channel).pipeline(transaction=False)
+    pipeline.rpush(message.key, chunk)
+    pipeline.expire(message.key, EXPIRE_SECS)
+    await pipeline.execute()
+
+async def _stream_chunks(message, stored_encoding, sent_encoding):
+    reader = _StreamReader(message, stored_encoding, sent_encoding)
+    store = _channel_store(message.channel)
+    try:
+        while not reader.ended:
+            yield reader.data(await store.blpop(message.key, timeout=STREAM_CHUNK_TIMEOUT_SECS))
+    except Exception as e:
+        logger.debug(f'_stream_chunks exception {e!r}')
+        raise
+    finally:
+        await store.delete(message.key)
+
+async def _spooled_chunks(spool_file, decompressor):
+    # Reads a spooled message's file in chunks without holding up other callers, decompressing them if asked
+    loop = asyncio.get_running_loop()
+    with spool_file:
+        while True:
+            chunk = await loop.run_in_executor(None, spool_file.read, STREAM_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield decompressor.decompress(chunk) if decompressor else chunk
+        if decompressor:
+            yield decompressor.flush()
+
+async def _read_message(scope, receive, args):
+    # Reads a message and prepares it for storage (as in jupyter_bridge._stored_message) without holding up other callers
+    encoding = _content_encoding(_header(scope, b'content-encoding'), args['encoding'][0] if 'encoding' in args else None)
+    message = await _read_body(receive)
+    return await asyncio.get_running_loop().run_in_executor(None, _stored_message, message, encoding)
+
+async def _read_request(scope, receive, args):
+    # Reads a request and prepares it for storage (as in jupyter_bridge._stored_request) without holding up other callers
+    encoding = _content_encoding(_header(scope, b'content-encoding'), args['encoding'][0] if 'encoding' in args else None)
+    message = await _read_body(receive)
+    return await asyncio.get_running_loop().run_in_executor(None, _stored_request, message, encoding,
+                                                            args['batch'][0] if 'batch' in args else None)
+
+async def _read_body(receive):
+    body = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise Exception('Caller disconnected before sending payload')
+        body.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(body)
+
+async def _send_response(send, status, content_type, body, headers=()):
+    # The body is bytes, a list of chunks (e.g., a message and its padding) that are sent without joining them, or
+    # an async generator of chunks (e.g., a streamed message) that are sent as they're produced
+    if hasattr(body, '__aiter__'):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', content_type.encode('latin-1')),
+                                (b'access-control-allow-origin', b'*'), *headers]})
+        try:
+            async for chunk in body:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            await body.aclose()
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    chunks = body if isinstance(body, list) else [body]
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type.encode('latin-1')),
+                            (b'content-length', str(sum(len(chunk) for chunk in chunks)).encode('latin-1')),
+                            (b'access-control-allow-origin', b'*'), *headers]})
+    for chunk in chunks[:-1]:
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': chunks[-1]})
+
+async def _call_flask(scope, receive, send):
+    # Minimal ASGI to WSGI adapter. Unlike a thread-sensitive adapter, it runs each call on the default thread pool
+    # so that a large upload doesn't hold up other callers.
+    loop = asyncio.get_running_loop()
+    with SpooledTemporaryFile(max_size=MAX_SPOOLED_BODY_BYTES) as body:
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.write(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        body.seek(0)
+
+        def run_flask():
+            response_start = {}
+
+            def start_response(status, response_headers, exc_info=None):
+                response_start['status'] = int(status.split(' ', 1)[0])
+                response_start['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response_headers]
+
+            def send_from_thread(event):
+                asyncio.run_coroutine_threadsafe(send(event), loop).result()
+
+            chunks = jupyter_bridge.app(_wsgi_environ(scope, body), start_response)
+            try:
+                send_from_thread({'type': 'http.response.start', 'status': response_start['status'], 'headers': response_start['headers']})
+                for chunk in chunks:
+                    if chunk:
+                        send_from_thread({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                send_from_thread({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+
+        await loop.run_in_executor(None, run_flask)
+
+def _wsgi_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        else:
+            name = f'HTTP_{name}'
+            environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
@@ -0,0 +1,230 @@
+"""Load and latency benchmark for Jupyter-bridge.
+
+Simulates channel pairs, each of which is a notebook thread that sends requests and waits for their replies, and a
+browser thread that answers them with replies whose sizes are drawn from a distribution. Zombie pollers (browsers
+whose notebooks are gone) call dequeue_request on channels of their own, and are never sent anything.
+
+By default, the benchmark serves jupyter_bridge.app from this process (on a local port, with rate limits off), using
+the message store named by --store. With --url, it calls a Jupyter-bridge that's already running instead (e.g., a
+local uWSGI), and --workers names the processes whose memory is reported.
+
+Results are printed as JSON and appended to --output as a line of JSON, with the git commit they were measured at,
+so runs before and after a change can be compared:
+
+    python benchmark.py --channels 20 --zombies 100 --seconds 30 --sizes 200:0.8,100000:0.15,5000000:0.05
+    python benchmark.py --url http://127.0.0.1:5000 --workers uwsgi --store redis://localhost
+
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+TEST_URL = 'http://127.0.0.1:9999/v1' # The (never called) Cytoscape URL in requests
+
+
+def main(argv=None):
+    options = _options(argv)
+    if options.url:
+        bridge_url = options.url
+    else:
+        bridge_url = _start_bridge(options.store)
+
+    redis_db = _redis_client(options.store)
+    commands_before = _redis_commands(redis_db)
+    round_trips = _run(bridge_url, options)
+    commands_after = _redis_commands(redis_db)
+
+    latencies = sorted(round_trips['latencies'])
+    result = {'commit': _git_commit(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'options': {key: value for key, value in vars(options).items() if key != 'output'},
+              'round_trips': len(latencies),
+              'round_trips_per_sec': round(len(latencies) / options.seconds, 2),
+              'reply_bytes_per_sec': round(round_trips['bytes'] / options.seconds),
+              'latency_p50_ms': _percentile_ms(latencies, 0.50),
+              'latency_p99_ms': _percentile_ms(latencies, 0.99),
+              'latency_max_ms': _percentile_ms(latencies, 1.0),
+              'errors': dict(round_trips['errors']),
+              'zombie_polls': round_trips['zombie_polls'],
+              'redis_commands_per_round_trip': round((commands_after - commands_before) / len(latencies), 2)
+                                               if latencies and commands_before is not None else None,
+              'worker_rss_kb': _worker_rss(options.workers if options.url else None)}
+    print(json.dumps(result, indent=2))
+    if options.output:
+        with open(options.output, 'a') as output:
+            output.write(json.dumps(result) + '\n')
+
+def _options(argv):
+    parser = argparse.ArgumentParser(description='Jupyter-bridge load and latency benchmark')
+    parser.add_argument('--url', help='Jupyter-bridge to call (default: serve jupyter_bridge.app from this process)')
+    parser.add_argument('--store', default=os.environ.get('JUPYTER_STORE_URL', 'redis://localhost'),
+                        help="message store URL for the bridge served from this process ('local' for an in-process store), "
+                             "and for counting redis commands")
+    parser.add_argument('--workers', default='uwsgi', help='text in the command line of the --url server processes whose RSS is reported')
+    parser.add_argument('--channels', type=int, default=10, help='notebook/browser channel pairs')
+    parser.add_argument('--zombies', type=int, default=0, help='browsers that poll for requests that never come')
+    parser.add_argument('--seconds', type=float, default=20, help='how long notebooks send requests')
+    parser.add_argument('--sizes', default='200:0.9,100000:0.1',
+                        help='reply size distribution, as comma-separated bytes:weight pairs')
+    parser.add_argument('--separate', action='store_true',
+                        help='queue and dequeue in separate calls instead of queue_request_and_dequeue_reply and queue_reply_and_dequeue_request')
+    parser.add_argument('--pad', action='store_true', help='ask for padded responses')
+    parser.add_argument('--output', default='benchmark.jsonl', help="file that results are appended to ('' for none)")
+    options = parser.parse_args(argv)
+    options.sizes = [(int(size), float(weight)) for size, weight in (pair.split(':') for pair in options.sizes.split(','))]
+    return options
+
+def _start_bridge(store):
+    # The bridge reads its settings when it's imported
+    os.environ['JUPYTER_STORE_URL'] = store
+    os.environ.setdefault('JUPYTER_RATE_CHANNEL_PER_SEC', '0')
+    os.environ.setdefault('JUPYTER_RATE_ADDRESS_PER_SEC', '0')
+    from werkzeug.serving import make_server
+    import jupyter_bridge
+    logging.getLogger('werkzeug').setLevel(logging.WARNING) # Its access log would cost more than some calls
+    bridge_server = make_server('127.0.0.1', 0, jupyter_bridge.app, threaded=True)
+    threading.Thread(target=bridge_server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{bridge_server.server_port}'
+
+def _run(bridge_url, options):
+    round_trips = {'latencies': [], 'bytes': 0, 'errors': collections.Counter(), 'zombie_polls': 0}
+    lock = threading.Lock()
+    stop = threading.Event()
+    run_id = f'{os.getpid()}-{int(time.time())}'
+    pad = f'&pad={int(options.pad)}'
+
+    def notebook(channel):
+        session = requests.Session()
+        deadline = time.monotonic() + options.seconds
+        while time.monotonic() < deadline:
+            call = {'command': 'GET', 'url': f'{TEST_URL}/networks', 'params': None, 'data': None, 'headers': {},
+                    'size': random.choices([size for size, weight in options.sizes], [weight for size, weight in options.sizes])[0]}
+            started = time.perf_counter()
+            if options.separate:
+                res = session.post(f'{bridge_url}/queue_request?channel={channel}', json=call)
+                if res.status_code == 200:
+                    res = session.get(f'{bridge_url}/dequeue_reply?channel={channel}{pad}')
+                    while res.status_code == 408:
+                        res = session.get(f'{bridge_url}/dequeue_reply?channel={channel}{pad}')
+            else:
+                res = session.post(f'{bridge_url}/queue_request_and_dequeue_reply?channel={channel}{pad}', json=call)
+            elapsed = time.perf_counter() - started
+            with lock:
+                if res.status_code == 200:
+                    round_trips['latencies'].append(elapsed)
+                    round_trips['bytes'] += len(res.content)
+                else:
+                    round_trips['errors'][f'notebook {res.status_code}'] += 1
+            if res.status_code != 200:
+                time.sleep(0.1)
+
+    def browser(channel):
+        session = requests.Session()
+        res = session.get(f'{bridge_url}/dequeue_request?channel={channel}{pad}')
+        while not stop.is_set():
+            if res.status_code == 200:
+                call = res.json()
+                reply = json.dumps({'status': 200, 'reason': 'OK', 'text': 'x' * call['size']})
+                if options.separate:
+                    session.post(f'{bridge_url}/queue_reply?channel={channel}', data=reply, headers={'Content-Type': 'text/plain'})
+                    res = session.get(f'{bridge_url}/dequeue_request?channel={channel}{pad}')
+                else:
+                    res = session.post(f'{bridge_url}/queue_reply_and_dequeue_request?channel={channel}{pad}', data=reply,
+                                       headers={'Content-Type': 'text/plain'})
+            else:
+                if res.status_code != 408:
+                    with lock:
+                        round_trips['errors'][f'browser {res.status_code}'] += 1
+                    time.sleep(0.1)
+                res = session.get(f'{bridge_url}/dequeue_request?channel={channel}{pad}')
+
+    def zombie(channel):
+        session = requests.Session()
+        while not stop.is_set():
+            res = session.get(f'{bridge_url}/dequeue_request?channel={channel}{pad}')
+            with lock:
+                round_trips['zombie_polls'] += 1
+                if res.status_code != 408:
+                    round_trips['errors'][f'zombie {res.status_code}'] += 1
+            if res.status_code != 408:
+                time.sleep(1)
+
+    # Browsers and zombies are left waiting when the notebooks finish ... they end with the process
+    for pair in range(options.channels):
+        threading.Thread(target=browser, args=(f'bench-{run_id}-{pair}',), daemon=True).start()
+    for poller in range(options.zombies):
+        threading.Thread(target=zombie, args=(f'bench-{run_id}-zombie-{poller}',), daemon=True).start()
+    notebooks = [threading.Thread(target=notebook, args=(f'bench-{run_id}-{pair}',)) for pair in range(options.channels)]
+    for thread in notebooks:
+        thread.start()
+    for thread in notebooks:
+        thread.join()
+    stop.set()
+    return round_trips
+
+def _percentile_ms(latencies, fraction):
+    if not latencies:
+        return None
+    return round(latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000, 2)
+
+def _redis_client(store):
+    if store == 'local':
+        return None
+    try:
+        import redis
+        return redis.Redis.from_url(store)
+    except Exception as e:
+        print(f'Not counting redis commands: {e!r}', file=sys.stderr)
+        return None
+
+def _redis_commands(redis_db):
+    # Counts this call, too, which is negligible
+    try:
+        return redis_db.info('stats')['total_commands_processed'] if redis_db else None
+    except Exception as e:
+        print(f'Not counting redis commands: {e!r}', file=sys.stderr)
+        return None
+
+def _worker_rss(pattern):
+    # Resident memory of each process whose command line contains the pattern (or of this process, if none given)
+    if pattern is None:
+        return {str(os.getpid()): _rss_kb(os.getpid())}
+    rss = {}
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as cmdline:
+                if pattern.encode('utf-8') in cmdline.read() and int(pid) != os.getpid():
+                    rss[pid] = _rss_kb(pid)
+        except OSError:
+            pass # The process ended
+    return rss
+
+def _rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    main()
@@ -12,12 +12,17 @@ operation identifies in the request. The server waits for a reply on that channe
 The request and reply operations are symmetrical, and so share common code. However, the request operation saves
 the request in a request map (keyed by channel ID), and the reply operation saves the reply in a reply map.
 
-Queuing requests is not allowed. If the server sends a request before the client operates on it, an error occurs.
-Likewise, when the client sends a reply, it assumes the server will receive it before the client needs to send a
-subsequent reply.
+A request or reply sent without a correlation ID can't be queued. If the server sends such a request before the
+client operates on it, an error occurs. Likewise, when the client sends such a reply, it assumes the server will
+receive it before the client needs to send a subsequent reply. However, a request or reply sent with a correlation ID
+joins a bounded FIFO queue for its channel, so the server can send several requests without waiting for their
+replies. The correlation ID is returned with the message when it is dequeued, so the client can tag its reply with
+the request's ID, and the server can match replies to requests (or wait for a particular reply) in any order. When
+the queue is full, the sender gets an HTTP 429 and should retry later.
 
-Python maps are not thread-safe, so the request and reply maps are protected by semaphore. A message is stored in
-a Queue of length 1 so that the message receiver can block while waiting for it.
+Python maps are not thread-safe, so the request and reply maps are protected by semaphore. A message receiver
+blocks while waiting for a message by subscribing to a redis pub/sub channel named after the message's key, and
+the message sender publishes to that channel as soon as the message is stored.
 
 Violation of an integrity assertion implies either a calling error at either the Jupyter server or Jupyter client. If
 no violation occurs, a Jupyter-bridge call will return OK (for send operations) or OK and payload (for receive
@@ -25,16 +30,38 @@ operations). If an error occurs, an HTTP 500 will be returned.
 
 Requests are assumed to be a JSON structure that describes the Cytoscape HTTP call. Replies are assumed to be the
 raw text returned by Cytoscape, and may include JSON that will be recovered by the requestor when it receives the
-reply.
+reply. A reply is returned with the content type it was queued with (see FRAMED_REPLY_TYPE), so a reply framed by the
+client reaches the requestor as it was sent.
 
 """
-from flask import Flask, request, Response
+from flask import Flask, request, Response, g
+from werkzeug.wsgi import wrap_file
 import sys
 import time
+import math
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+import queue
+import random
+import contextvars
 import threading
+import itertools
+import re
+import zlib
+import gzip
+import uuid
+import collections
+import json
+import hmac
+import socket
+
+import message_store
+
+try:
+    import zstandard # Optional ... without it, zstd isn't accepted as a content encoding
+except ImportError:
+    zstandard = None
 
 
 app = Flask(__name__)
@@ -42,310 +69,1991 @@ app = Flask(__name__)
 JUPYTER_BRIDGE_VERSION = '0.0.4'
 
 
+LOG_LEVEL = os.environ.get('JUPYTER_LOG_LEVEL', 'DEBUG').upper() # Level of records logged by routes without a JUPYTER_LOG_LEVEL_<ROUTE> setting, and outside of routes
+LOG_QUEUE = os.environ.get('JUPYTER_LOG_QUEUE', '1') == '1' # Write log records on a background thread so that routes don't wait on the disk
+LOG_PAYLOAD_BYTES = int(os.environ.get('JUPYTER_LOG_PAYLOAD_BYTES', 1024)) # Longest payload logged in full ... longer payloads are truncated
+LOG_SAMPLE_TIMEOUT = float(os.environ.get('JUPYTER_LOG_SAMPLE_TIMEOUT', 1)) # Fraction of timed-out dequeue transactions that are logged
+DEQUEUE_ROUTES = {'dequeue_request', 'dequeue_reply', 'queue_reply_and_dequeue_request', 'queue_request_and_dequeue_reply'}
+
+class _ProcessQueueHandler(QueueHandler):
+    """Queues log records for a listener thread that writes them. uWSGI forks its workers after this module is
+    loaded, so each process starts its own listener when it first logs."""
+    def __init__(self, handler):
+        super().__init__(queue.SimpleQueue())
+        self.handler = handler
+        self.listener_pid = None
+        self.listener_lock = threading.Lock()
+
+    def enqueue(self, record):
+        if self.listener_pid != os.getpid():
+            with self.listener_lock:
+                if self.listener_pid != os.getpid():
+                    self.queue = queue.SimpleQueue() # Records queued before a fork belong to the parent's listener
+                    QueueListener(self.queue, self.handler, respect_handler_level=True).start()
+                    self.listener_pid = os.getpid()
+        super().enqueue(record)
+
+class _RouteLog:
+    """Logging choices for one route transaction"""
+    def __init__(self, level, sampled, deferred):
+        self.level = level
+        self.sampled = sampled
+        self.deferred = deferred # Records held until the transaction's outcome is known (or None)
+
+route_log = contextvars.ContextVar('route_log', default=None)
+route_log_settings = {}
+
+class _RouteLogFilter(logging.Filter):
+    """Drops records below their route's level and records of transactions not sampled, and holds the records of
+    dequeue transactions that may be discarded if they time out"""
+    def filter(self, record):
+        transaction_log = route_log.get()
+        if transaction_log is None:
+            return record.levelno >= logging.getLevelName(LOG_LEVEL)
+        elif not transaction_log.sampled or record.levelno < transaction_log.level:
+            return False
+        elif transaction_log.deferred is not None:
+            transaction_log.deferred.append(record)
+            return False
+        else:
+            return True
+
 # Set up detail logger
 logger = logging.getLogger('jupyter-bridge')
 logger_handler = RotatingFileHandler('jupyter-bridge.log', maxBytes=10485760, backupCount=10, encoding='utf8')
 logger_handler.setLevel('DEBUG')
 logger_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s'))
-logger.setLevel('DEBUG')
-logger.addHandler(logger_handler)
+logger.setLevel('DEBUG') # Levels are applied per route by _RouteLogFilter
+logger.addHandler(_ProcessQueueHandler(logger_handler) if LOG_QUEUE else logger_handler)
+logger.addFilter(_RouteLogFilter())
 
-PAD_MESSAGE = True # For troubleshooting truncated FIN terminator that loses headers and data
+PAD_MESSAGE = os.environ.get('JUPYTER_PAD_MESSAGE', '1') == '1' # Pad messages for callers that don't say ... for troubleshooting truncated FIN terminator that loses headers and data
+MESSAGE_PADDING = b' ' * 1500
 DEQUEUE_TIMEOUT_SECS = float(os.environ.get('JUPYTER_DEQUEUE_TIMEOUT_SECS', 15)) # Something less that connection timeout, but long enough not to cause caller to create a dequeue blizzard
-FAST_DEQUEUE_POLLING_SECS = float(os.environ.get('JUPYTER_FAST_BRIDGE_POLL_SECS', 0.1)) # A fast polling rate means overall fast response to clients
-SLOW_DEQUEUE_POLLING_SECS = float(os.environ.get('JUPYTER_SLOW_BRIDGE_POLL_SECS', 2)) # A slow polling rate means saving redis bandwidth
-ALLOWED_FAST_DEQUEUE_POLLS = int(os.environ.get('JUPYTER_ALLOWED_FAST_DEQUEUE_POLLS', 10)) # Count of polls before client drops from FAST to SLOW
+MAX_DEQUEUE_TIMEOUT_SECS = float(os.environ.get('JUPYTER_MAX_DEQUEUE_TIMEOUT_SECS', 55)) # Longest timeout a caller can ask for ... something less than nginx's 60 second uwsgi_read_timeout
 EXPIRE_SECS = 60 * 60 * 24 # How many seconds before an idle key dies
+STORE_URL = os.environ.get('JUPYTER_STORE_URL', 'redis://localhost') # Redis server (e.g., unix:///run/redis/redis.sock), or 'local' to keep messages in this process (see message_store.py)
+STORE_POOL_SIZE = int(os.environ.get('JUPYTER_STORE_POOL_SIZE', 0)) # Most redis connections a process can open (0 for no limit)
+STORE_SHARDS = [url.strip() for url in os.environ.get('JUPYTER_STORE_SHARDS', '').split(',') if url.strip()] # Comma-separated redis servers that channels are spread across ('' to keep channels in STORE_URL)
+CHANNEL_QUEUE_DEPTH = int(os.environ.get('JUPYTER_CHANNEL_QUEUE_DEPTH', 32)) # Most messages with correlation IDs that can wait on a channel
+QUEUE_FULL_RETRY_SECS = 1 # How long a sender should wait before retrying when a channel's queue is full
+DEQUEUE_LEASE_GRACE_SECS = 10 # How long past its timeout a reader's claim on a key lasts, in case its process dies while waiting
+
+# Warm restarts ... by default, a starting process deletes every channel key, so a restart drops the messages in
+# flight. With STALE_KEY_SECS, it deletes only the keys that have been idle that long, and channels carry on. Before a
+# node is restarted, POST /admin/drain tells its processes (those started before the drain) to stop holding long
+# polls: no dequeue waits longer than DRAIN_POLL_SECS, so callers soon poll again (and reach the restarted processes),
+# and the old processes are left with nothing to finish.
+STALE_KEY_SECS = float(os.environ.get('JUPYTER_STALE_KEY_SECS', 0)) # On startup, delete channel keys idle at least this long (0 to delete them all)
+NODE = os.environ.get('JUPYTER_NODE', socket.gethostname()) # Name that /admin/drain knows this node's processes by
+DRAIN_POLL_SECS = 1 # Longest a dequeue waits once its process is draining
+DRAIN_CHECK_SECS = 1 # How often a process checks whether its node is draining
+WAKEUP_START_SECS = 10 # Longest a dequeue waits for its process's wakeup listeners to subscribe
+WAKEUP_LISTEN_SECS = 1 # How often a wakeup listener checks whether it has been replaced
+DRAIN_EXPIRE_SECS = 60 * 60 # How long a drain lasts ... processes started after it aren't drained, anyway
+
+# Admission control ... calls to the channel endpoints are limited by token buckets kept in redis (so the limits apply
+# across all processes), one for each channel and one for each client address. A bucket holds up to BURST calls and
+# refills at PER_SEC calls per second. A call that finds either bucket empty gets an HTTP 429 and a Retry-After.
+RATE_CHANNEL_PER_SEC = float(os.environ.get('JUPYTER_RATE_CHANNEL_PER_SEC', 50)) # 0 for no channel limit
+RATE_CHANNEL_BURST = float(os.environ.get('JUPYTER_RATE_CHANNEL_BURST', 200))
+RATE_ADDRESS_PER_SEC = float(os.environ.get('JUPYTER_RATE_ADDRESS_PER_SEC', 200)) # 0 for no address limit ... addresses can be shared by many users behind NAT
+RATE_ADDRESS_BURST = float(os.environ.get('JUPYTER_RATE_ADDRESS_BURST', 1000))
+RATE = 'rate'
+CHANNEL_ROUTES = DEQUEUE_ROUTES | {'queue_request', 'queue_reply'}
+CORRELATION_ID_PATTERN = re.compile(r'[A-Za-z0-9._:-]{1,128}')
+MAX_BATCH_CALLS = int(os.environ.get('JUPYTER_MAX_BATCH_CALLS', 10000)) # Most Cytoscape calls a batch request can claim
+COMPRESS_MIN_BYTES = int(os.environ.get('JUPYTER_COMPRESS_MIN_BYTES', 16384)) # Uncompressed messages at least this long are stored compressed (0 to never compress)
+PREFLIGHT_MAX_AGE_SECS = 600 # How long a browser may reuse the answer to a CORS preflight
+COMPRESS_LEVEL = 1 # Fastest gzip level ... Cytoscape JSON compresses well even at this level
+
+STREAM_MIN_BYTES = int(os.environ.get('JUPYTER_STREAM_MIN_BYTES', 8 * 1024 * 1024)) # Replies at least this long (or of unknown length) are streamed through redis instead of being stored whole
+STREAM_CHUNK_BYTES = 256 * 1024 # Bounds the memory each process needs for streaming a reply
+STREAM_CHUNK_TIMEOUT_SECS = 30 # Longest wait for the next chunk of a streamed reply ... something less than nginx's 60 second uwsgi_read_timeout
+
+SPOOL_DIR = os.environ.get('JUPYTER_SPOOL_DIR', '') # Directory where long messages are held instead of in redis ('' to hold all messages in redis)
+SPOOL_MIN_BYTES = int(os.environ.get('JUPYTER_SPOOL_MIN_BYTES', 1024 * 1024)) # Stored messages at least this long are spooled (if there's a SPOOL_DIR)
+SPOOL_ACCEL_PREFIX = os.environ.get('JUPYTER_SPOOL_ACCEL_PREFIX', '') # nginx internal location that serves SPOOL_DIR (e.g., /spool/), or '' to send spooled messages from Python
+SPOOL_SENT_DIR = 'sent' # Subdirectory of SPOOL_DIR holding spooled messages handed to nginx
+SPOOL_SENT_SECS = 60 # How long a spooled message handed to nginx is kept ... nginx opens it right away and reads it after it's gone
+SPOOL_SWEEP_SECS = 60 # How often expired spooled messages are discarded
+SPOOL_SWEEP_KEY = 'spool:sweep' # Held by the process sweeping the spool, so only one process sweeps at a time
+
+# Channel registry ... the last activity on each side of a channel (the notebook side that queues requests and the
+# browser side that queues replies) is recorded in a liveness hash per channel, and an index of channels is scored by
+# their last activity. A channel is idle when its notebook has been silent for CHANNEL_IDLE_SECS, and a zombie when
+# its notebook has been silent for CHANNEL_ZOMBIE_SECS while its browser keeps polling (e.g., a browser client left
+# behind by a notebook kernel restart).
+CHANNEL_IDLE_SECS = float(os.environ.get('JUPYTER_CHANNEL_IDLE_SECS', 10 * 60))
+CHANNEL_ZOMBIE_SECS = float(os.environ.get('JUPYTER_CHANNEL_ZOMBIE_SECS', 60 * 60)) # Zombie browsers wait twice as long for requests for each period of silence this long
+CHANNEL_REJECT_SECS = float(os.environ.get('JUPYTER_CHANNEL_REJECT_SECS', 7 * 24 * 60 * 60)) # Zombie browsers silent this long are told to stop polling (0 to never tell them)
+MAX_ZOMBIE_DOUBLINGS = 16
+ADMIN_TOKEN = os.environ.get('JUPYTER_ADMIN_TOKEN', '') # Bearer token that the /admin routes require ('' to disable them)
+LIVENESS = 'liveness'
+CHANNELS = 'channels'
+NOTEBOOK = 'notebook'
+BROWSER = 'browser'
+
+# Metrics ... each process adds its observations to a buffer, which a thread adds to the totals in redis every
+# METRICS_FLUSH_SECS, and /metrics reports the totals of all processes. Each process also counts its waiters, and the
+# thread replaces the process's counts in redis, so the counts of a process that dies expire with it.
+METRICS_KEY = 'metrics'
+WAITERS_KEY = 'metrics:waiter_processes' # Sorted set of the processes' waiter count keys, by when they were flushed
+METRICS_FLUSH_SECS = 1
+WAITERS_EXPIRE_SECS = 10 # A process's waiter counts are dropped once they haven't been flushed for this long
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+REDIS_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1]
+BYTES_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864, 268435456]
+METRICS = { # Name: type, description, histogram buckets
+    'jupyter_bridge_route_seconds': ('histogram', 'Time for a route to produce its response', LATENCY_BUCKETS),
+    'jupyter_bridge_responses_total': ('counter', 'Responses by route and HTTP status', None),
+    'jupyter_bridge_queue_wait_seconds': ('histogram', 'Time a message waited between being queued and being dequeued', LATENCY_BUCKETS),
+    'jupyter_bridge_message_bytes': ('histogram', 'Size of queued messages as they are held', BYTES_BUCKETS),
+    'jupyter_bridge_redis_seconds': ('histogram', 'Time for a redis script call', REDIS_BUCKETS),
+    'jupyter_bridge_waiters': ('gauge', 'Dequeue calls waiting for a message', None),
+}
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+# Message content types ... a reply is normally a JSON envelope ({status, reason, text}) that the browser builds around
+# Cytoscape's response text and sends as text/plain, so a JSON response is escaped into a string and parsed twice. A
+# framed reply is a status line (e.g., '200 OK\n') followed by Cytoscape's response bytes as they came.
+JSON_TYPE = 'application/json'
+PLAIN_TYPE = 'text/plain'
+FRAMED_REPLY_TYPE = 'application/x-cytoscape-reply'
+
+# Streamed chunk format ... each chunk is tagged to say whether it is data or the end of the stream
+STREAM_DATA = b'd'
+STREAM_END = b'e'
+STREAM_ABORTED = b'a'
 
 DEQUEUE_BUSY_STATUS = b'busy'
 DEQUEUE_IDLE_STATUS = b'idle'
 
 HTTP_OK = 200
+HTTP_FORBIDDEN = 403
 HTTP_SYS_ERR = 500
 HTTP_TIMEOUT = 408
 HTTP_TOO_MANY = 429
 
-# Redis message format:
+# Redis message format ... each message waiting on a channel is stored in fields suffixed by its sequence number
+# (e.g., message:3, id:3, encoding:3, type:3, storage:3 and posted:3). Messages are dequeued in sequence order (unless requested by correlation ID), and head
+# is the sequence number of the last message dequeued in order.
 MESSAGE = b'message'
+CORRELATION_ID = b'id'
+ENCODING = b'encoding'
+CONTENT_TYPE = b'type'
+STORAGE = b'storage'
+STREAM = b'stream' # Storage of a message whose chunks are in a list of their own
+SPOOL = b'spool' # Storage of a message whose body is in a file in SPOOL_DIR
 POSTED_TIME = b'posted_time'
 PICKUP_TIME = b'pickup_time'
 DEQUEUE_BUSY = b'dequeue_busy'
-REPLY_FAST_POLLS_LEFT = b'reply_fast_polls_left'
+DEQUEUE_BUSY_UNTIL = b'busy_until' # When a reader's claim on the key lapses
+HEAD = b'head'
+TAIL = b'tail'
+PENDING = b'pending'
+
+CORRELATION_ID_HEADER = 'X-Correlation-Id'
+MESSAGE_ID_HEADER = 'X-Message-Id' # ID by which a reader that passes the ack argument acknowledges a message
 
 # Redis key constants
 REPLY = 'reply'
 REQUEST = 'request'
 STATISTIC = 'stat'
+STATISTIC_DAYS = f'{STATISTIC}:days' # Sorted set of statistics keys, scored by day (e.g., 20240131)
+STATISTIC_DAY_PATTERN = re.compile(rf'{STATISTIC}:(\d{{4}})-(\d{{2}})-(\d{{2}})')
 COUNT = 'count'
+DRAIN = 'drain' # drain:<node> holds when the node was drained, and drains are announced on the drain channel
+
+# Redis scripts for channel state transitions. Each executes atomically in a single round trip, so the busy/idle and
+# message checks can't interleave with the same transition in another process. Hash field names must match the
+# Redis message format constants above.
+
+# Discard all messages waiting on a key (including the chunks of streamed messages, and messages delivered but not yet
+# acknowledged) and return the first waiting message (or false). Spooled messages' files are left for the spool sweeper.
+CLEAR_PENDING_FUNCTION = """
+local function clear_pending(key)
+    for seq in string.gmatch(redis.call('HGET', key, 'unacked') or '', '%d+') do
+        redis.call('HDEL', key, 'message:' .. seq, 'id:' .. seq, 'encoding:' .. seq, 'type:' .. seq, 'storage:' .. seq,
+                   'posted:' .. seq, 'delivered:' .. seq)
+    end
+    redis.call('HDEL', key, 'unacked')
+    local head = tonumber(redis.call('HGET', key, 'head') or 0)
+    local tail = tonumber(redis.call('HGET', key, 'tail') or 0)
+    local first = false
+    if tail > head then
+        for seq = head + 1, tail do
+            local message = redis.call('HGET', key, 'message:' .. seq)
+            if message and redis.call('HGET', key, 'storage:' .. seq) == 'stream' then
+                redis.call('DEL', message)
+            end
+            first = first or message
+            redis.call('HDEL', key, 'message:' .. seq, 'id:' .. seq, 'encoding:' .. seq, 'type:' .. seq, 'storage:' .. seq,
+                       'posted:' .. seq)
+        end
+        redis.call('HSET', key, 'head', tail, 'pending', 0)
+    end
+    return first
+end
+"""
+
+# Record activity on one side of a channel (at the given time), and return what is known about the channel's liveness
+# (see TOUCH_CHANNEL_SCRIPT)
+TOUCH_CHANNEL_FUNCTION = """
+local function touch_channel(liveness_key, index_key, side, now, expire_secs, channel)
+    redis.call('HSETNX', liveness_key, 'since', now)
+    redis.call('HSET', liveness_key, side, now)
+    redis.call('EXPIRE', liveness_key, expire_secs)
+    redis.call('ZADD', index_key, now, channel)
+    redis.call('ZREMRANGEBYSCORE', index_key, '-inf', tonumber(now) - tonumber(expire_secs))
+    return redis.call('HMGET', liveness_key, 'notebook', 'browser', 'since', 'evicted')
+end
+"""
+
+# Drop the delivered messages whose sequence numbers are given (as a list of numbers separated by anything else), so
+# they aren't delivered again (see DEQUEUE_SCRIPT)
+ACKNOWLEDGE_FUNCTION = """
+local function acknowledge(key, seqs)
+    local acked = {}
+    local any = false
+    for seq in string.gmatch(seqs, '%d+') do
+        if redis.call('HDEL', key, 'delivered:' .. seq) == 1 then
+            redis.call('HDEL', key, 'message:' .. seq, 'id:' .. seq, 'encoding:' .. seq, 'type:' .. seq, 'storage:' .. seq,
+                       'posted:' .. seq)
+            acked[seq] = true
+            any = true
+        end
+    end
+    if any then
+        local unacked = {}
+        for seq in string.gmatch(redis.call('HGET', key, 'unacked') or '', '%d+') do
+            if not acked[seq] then
+                table.insert(unacked, seq)
+            end
+        end
+        redis.call('HSET', key, 'unacked', table.concat(unacked, ' '))
+    end
+end
+"""
+
+# Store a message unless the channel can't accept it, publish a wakeup for its readers, and count it in the day's
+# stats (and the day in the statistics index). A message without a correlation ID can't wait behind another message,
+# and a message with one can't wait behind a full queue. If a key to discard or acknowledge messages on is given,
+# either all messages still waiting there are discarded first, or (for a reply that acknowledges the requests it
+# answers) the messages there that ARGV[14] names are acknowledged once the message is stored. A sender's activity on
+# its channel can be recorded first, as TOUCH_CHANNEL_SCRIPT does, so the sender needn't make a call of its own for it.
+#   KEYS: message key, statistics key, statistics index key[, liveness key, channel index key][, key to discard or
+#         acknowledge messages on]
+#   ARGV: message (or key of a streamed message's chunks, or name of a spooled message's file), correlation ID or '',
+#         posted time, expiration seconds, operation, queue depth, Cytoscape calls, content encoding or '',
+#         storage ('', 'stream' or 'spool'), message bytes, posted monotonic time, statistics day (e.g., 20240131),
+#         content type or '' (for JSON), sequence numbers of the messages acknowledged (separated by commas) or '',
+#         side whose activity is recorded (see TOUCH_CHANNEL_SCRIPT) or '', time, channel
+#   Returns: {1 if stored, 0 if a message is already waiting or -1 if the queue is full, first discarded message or ''}
+ENQUEUE_SCRIPT = CLEAR_PENDING_FUNCTION + TOUCH_CHANNEL_FUNCTION + ACKNOWLEDGE_FUNCTION + """
+local other_key = KEYS[4]
+if ARGV[15] ~= '' then
+    touch_channel(KEYS[4], KEYS[5], ARGV[15], ARGV[16], ARGV[4], ARGV[17])
+    other_key = KEYS[6]
+end
+local discarded = false
+if other_key and ARGV[14] == '' then
+    discarded = clear_pending(other_key)
+end
+local pending = tonumber(redis.call('HGET', KEYS[1], 'pending') or 0)
+if ARGV[2] == '' then
+    if pending > 0 then
+        return {0, discarded or ''}
+    end
+elseif pending >= tonumber(ARGV[6]) then
+    return {-1, discarded or ''}
+end
+local seq = redis.call('HINCRBY', KEYS[1], 'tail', 1)
+redis.call('HINCRBY', KEYS[1], 'pending', 1)
+redis.call('HSET', KEYS[1], 'message:' .. seq, ARGV[1], 'id:' .. seq, ARGV[2], 'encoding:' .. seq, ARGV[8],
+           'type:' .. seq, ARGV[13], 'storage:' .. seq, ARGV[9], 'posted:' .. seq, ARGV[11], 'pickup_time', '', 'posted_time', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('PUBLISH', KEYS[1], 'message')
+redis.call('HINCRBY', KEYS[2], 'count:' .. ARGV[5], ARGV[7])
+redis.call('HINCRBY', KEYS[2], ARGV[5], ARGV[10])
+redis.call('ZADD', KEYS[3], ARGV[12], KEYS[2])
+if other_key and ARGV[14] ~= '' then
+    acknowledge(other_key, ARGV[14])
+end
+return {1, discarded or ''}
+"""
+
+# Make one attempt at taking a waiting message ... either the oldest one or the one with a given correlation ID. The
+# first attempt claims the key for the reader (unless another reader already has it), and the last attempt releases
+# it. Taking a message releases it, too. A claim lapses at the time given with it, so a reader whose process died
+# while waiting doesn't lock out the readers that come after it. For a reader that acknowledges messages, a message
+# (unless streamed or spooled) is kept after it's taken, until the reader acknowledges it by its sequence number on a
+# later claim (or a reply acknowledges it, see ENQUEUE_SCRIPT). Until then, it's taken again ahead of the messages
+# still waiting, unless the reader says it still holds it (e.g., a browser executing several requests at once, which
+# acknowledges each one with its reply). A claim can also record the reader's
+# activity on its channel, as TOUCH_CHANNEL_SCRIPT does, so the reader needn't make a call of its own for it.
+#   KEYS: message key[, liveness key, channel index key]
+#   ARGV: '1' to claim, '1' to discard waiting messages when claiming, '1' to release, pickup time,
+#         expiration seconds, correlation ID or '', time, time the claim lapses, '1' if the reader acknowledges
+#         messages, sequence numbers of the messages acknowledged when claiming (separated by commas) or '', side
+#         whose activity the claim records (see TOUCH_CHANNEL_SCRIPT) or '', channel, sequence numbers of the
+#         messages the reader holds (separated by commas) or ''
+#   Returns: {'busy'} if another reader has the key, {'message', message, correlation ID, content encoding,
+#            storage, posted monotonic time, content type, sequence number to acknowledge or ''} if taken, or
+#            {'empty'} ... each followed by the channel's liveness (as TOUCH_CHANNEL_SCRIPT returns it) if the claim
+#            recorded activity, or else false
+DEQUEUE_SCRIPT = CLEAR_PENDING_FUNCTION + TOUCH_CHANNEL_FUNCTION + ACKNOWLEDGE_FUNCTION + """
+local liveness = false
+if ARGV[1] == '1' and ARGV[11] ~= '' then
+    liveness = touch_channel(KEYS[2], KEYS[3], ARGV[11], ARGV[7], ARGV[5], ARGV[12])
+end
+if ARGV[1] == '1' then
+    if redis.call('HGET', KEYS[1], 'dequeue_busy') == 'busy' and
+       tonumber(redis.call('HGET', KEYS[1], 'busy_until') or 0) > tonumber(ARGV[7]) then
+        return {'busy', liveness}
+    end
+    redis.call('HSET', KEYS[1], 'dequeue_busy', 'busy', 'busy_until', ARGV[8], 'pickup_time', '')
+    if ARGV[2] == '1' then
+        clear_pending(KEYS[1])
+    end
+    acknowledge(KEYS[1], ARGV[10])
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+end
+local head = tonumber(redis.call('HGET', KEYS[1], 'head') or 0)
+local tail = tonumber(redis.call('HGET', KEYS[1], 'tail') or 0)
+local seq = false
+local redelivered = false
+if ARGV[9] == '1' then
+    -- Deliver again what the reader hasn't acknowledged and doesn't hold
+    local held = {}
+    for candidate in string.gmatch(ARGV[13], '%d+') do
+        held[candidate] = true
+    end
+    for candidate in string.gmatch(redis.call('HGET', KEYS[1], 'unacked') or '', '%d+') do
+        if not held[candidate] and (ARGV[6] == '' or redis.call('HGET', KEYS[1], 'id:' .. candidate) == ARGV[6]) then
+            seq = tonumber(candidate)
+            redelivered = true
+            break
+        end
+    end
+end
+if redelivered then
+    -- Nothing more to look for
+elseif ARGV[6] == '' then
+    -- Skip over messages already taken by correlation ID (or delivered and not yet acknowledged)
+    local next_head = head
+    while next_head < tail and not seq do
+        next_head = next_head + 1
+        if redis.call('HEXISTS', KEYS[1], 'message:' .. next_head) == 1 and
+           redis.call('HEXISTS', KEYS[1], 'delivered:' .. next_head) == 0 then
+            seq = next_head
+        end
+    end
+    if next_head ~= head then
+        redis.call('HSET', KEYS[1], 'head', next_head)
+    end
+else
+    for candidate = head + 1, tail do
+        if redis.call('HGET', KEYS[1], 'id:' .. candidate) == ARGV[6] and
+           redis.call('HEXISTS', KEYS[1], 'delivered:' .. candidate) == 0 then
+            seq = candidate
+            break
+        end
+    end
+end
+if seq then
+    local message = redis.call('HGET', KEYS[1], 'message:' .. seq)
+    local id = redis.call('HGET', KEYS[1], 'id:' .. seq)
+    local encoding = redis.call('HGET', KEYS[1], 'encoding:' .. seq) or ''
+    local storage = redis.call('HGET', KEYS[1], 'storage:' .. seq) or ''
+    local posted = redis.call('HGET', KEYS[1], 'posted:' .. seq) or ''
+    local content_type = redis.call('HGET', KEYS[1], 'type:' .. seq) or ''
+    local ack = ''
+    if redelivered then
+        ack = tostring(seq)
+    elseif ARGV[9] == '1' and storage == '' then
+        ack = tostring(seq)
+        redis.call('HSET', KEYS[1], 'delivered:' .. seq, ARGV[7])
+        local unacked = redis.call('HGET', KEYS[1], 'unacked') or ''
+        redis.call('HSET', KEYS[1], 'unacked', unacked == '' and ack or unacked .. ' ' .. ack)
+        redis.call('HINCRBY', KEYS[1], 'pending', -1)
+    else
+        redis.call('HDEL', KEYS[1], 'message:' .. seq, 'id:' .. seq, 'encoding:' .. seq, 'type:' .. seq, 'storage:' .. seq,
+                   'posted:' .. seq)
+        redis.call('HINCRBY', KEYS[1], 'pending', -1)
+    end
+    redis.call('HSET', KEYS[1], 'pickup_time', ARGV[4], 'dequeue_busy', 'idle')
+    return {'message', message, id, encoding, storage, posted, content_type, ack, liveness}
+end
+if ARGV[3] == '1' then
+    redis.call('HSET', KEYS[1], 'dequeue_busy', 'idle')
+end
+return {'empty', liveness}
+"""
+
+# Take a token from each of a set of token buckets, or none of them if any is empty
+#   KEYS: bucket keys
+#   ARGV: time, then each bucket's refill rate (tokens per second) and capacity
+#   Returns: 0 if the tokens were taken, or else how many seconds until they could be (as a string, because redis
+#            truncates Lua numbers)
+RATE_LIMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate, capacity = tonumber(ARGV[2 * i]), tonumber(ARGV[2 * i + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'time')
+    local tokens, last = tonumber(bucket[1]) or capacity, tonumber(bucket[2]) or now
+    levels[i] = math.min(capacity, tokens + math.max(0, now - last) * rate)
+    if levels[i] < 1 then
+        wait = math.max(wait, (1 - levels[i]) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local rate, capacity = tonumber(ARGV[2 * i]), tonumber(ARGV[2 * i + 1])
+    if wait == 0 then
+        levels[i] = levels[i] - 1
+    end
+    redis.call('HSET', key, 'tokens', levels[i], 'time', now)
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return tostring(wait)
+"""
+
+# Record activity on one side of a channel, and return what is known about the channel's liveness
+#   KEYS: liveness key, channel index key
+#   ARGV: side ('notebook' or 'browser'), time, expiration seconds, channel
+#   Returns: {notebook time, browser time, first seen time, '1' if evicted} (each false if unknown)
+TOUCH_CHANNEL_SCRIPT = TOUCH_CHANNEL_FUNCTION + """
+return touch_channel(KEYS[1], KEYS[2], ARGV[1], ARGV[2], ARGV[3], ARGV[4])
+"""
+LIVENESS_FIELDS = ['notebook', 'browser', 'since', 'evicted']
+
+DEQUEUE_SCRIPT_BUSY = b'busy'
+DEQUEUE_SCRIPT_MESSAGE = b'message'
 
-# Mutex for servicing multiple clients. This should be used around each top level (i.e., Flask-routed) function.
-# It stops all other functions from executing when one function executes. This is very conservative, but turns
-# out to be helpful because unrestricted execution seems to allow loss of log entries or scrambling log entry
-# order. It's also possible that something somewhere in this code isn't thread-safe. If so, this stops us from
-# spending endless hours looking for the problem. Finally, it's OK to use this for global-level locking, as each
-# top level function is fast, especially compared to the network-based caller-server delays introduced by the
-# Internet.
-global_mutex = threading.Lock() # Initialize to allow a single user at a time
+# Mutexes for servicing multiple clients. A channel's mutex should be held around each top level (i.e., Flask-routed)
+# operation on that channel so that operations on the same channel execute one at a time and in order. Operations on
+# different channels don't affect each other, so they don't wait on each other, either. (Channels are assigned to a
+# fixed pool of mutexes by hash, so two channels occasionally share a mutex ... this is harmless.) Each transaction
+# executes on a single thread and tags each of its log entries with its transaction ID, so its log entries stay in
+# order even when transactions on other channels interleave with it. Routes that don't operate on a channel
+# (e.g., ping and stats) don't need a mutex at all.
+CHANNEL_MUTEX_COUNT = int(os.environ.get('JUPYTER_CHANNEL_MUTEX_COUNT', 64))
+channel_mutexes = [threading.Lock() for _ in range(CHANNEL_MUTEX_COUNT)]
 
 logger.debug('Starting Jupyter-bridge with python environment: \n' + '\n'.join(sys.path))
-logger.debug(f'Jupyter-bridge polling timeout: {DEQUEUE_TIMEOUT_SECS}, slow poll: {SLOW_DEQUEUE_POLLING_SECS}, fast poll: {FAST_DEQUEUE_POLLING_SECS}')
+logger.debug(f'Jupyter-bridge dequeue timeout: {DEQUEUE_TIMEOUT_SECS}')
 
-# Start the Redis client ... assume that the redis server has already started
+# Start the message store clients ... for a redis store, assume that the redis server has already started. With
+# STORE_SHARDS, each channel's keys (its queues, liveness and streamed chunks), along with the statistics of the
+# messages sent on it, are kept in the shard that its channel ID hashes to, so the request and reply sides of a channel
+# meet on the same shard whichever Jupyter-bridge node serves them. STORE_URL keeps what isn't per channel (metrics,
+# rate limits and the spool sweeper's lock). Scripts are registered with STORE_URL's client and are called with the
+# client of the store whose keys they use.
 try:
-    import redis
-    redis_db = redis.Redis('localhost')
-    logger.debug('started redis connection')
+    redis_db = message_store.open_store(STORE_URL, STORE_POOL_SIZE,
+                                        {ENQUEUE_SCRIPT: message_store.enqueue_script, DEQUEUE_SCRIPT: message_store.dequeue_script,
+                                         TOUCH_CHANNEL_SCRIPT: message_store.touch_channel_script,
+                                         RATE_LIMIT_SCRIPT: message_store.rate_limit_script})
+    if message_store.LOCAL_STORE in STORE_SHARDS or (STORE_SHARDS and STORE_URL == message_store.LOCAL_STORE):
+        raise Exception('A local message store cannot be sharded')
+    channel_stores = message_store.ShardRing({url: message_store.open_store(url, STORE_POOL_SIZE, None) for url in STORE_SHARDS}
+                                             if STORE_SHARDS else {STORE_URL: redis_db})
+    enqueue_script = redis_db.register_script(ENQUEUE_SCRIPT)
+    dequeue_script = redis_db.register_script(DEQUEUE_SCRIPT)
+    touch_channel_script = redis_db.register_script(TOUCH_CHANNEL_SCRIPT)
+    rate_limit_script = redis_db.register_script(RATE_LIMIT_SCRIPT)
+    logger.debug(f'started message store connection: {STORE_URL}, channel shards: {STORE_SHARDS}')
 except Exception as e:
-    logger.debug(f'exception starting redis: {e!r}')
+    logger.debug(f'exception starting message store: {e!r}')
 
+if SPOOL_DIR and STORE_SHARDS: # A spooled message can be dequeued by any node, which reads its file by name
+    logger.warning(f'Spooling to {SPOOL_DIR} with sharded message stores ... every node must share the spool directory, '
+                   f'and its files are discarded only by the spool sweeper')
 
-# Clear out all keys in case prior server instance was in the middle of any operations
-def _del_key(key):
+
+# Clear out all keys in case prior server instance was in the middle of any operations. SCAN and UNLINK (which frees
+# memory in the background) keep redis responsive even when there are many channel keys. Statistics days recorded
+# before there was a statistics index are added to it. Sharded stores are shared with other Jupyter-bridge nodes
+# that may be serving their channels, so their keys are left to expire instead. On a warm start (see STALE_KEY_SECS),
+# only stale keys are deleted, from every shard.
+UNLINK_BATCH = 500
+SCAN_COUNT = 1000
+CHANNEL_KEY_PATTERN = re.compile(rf'.*:({REPLY}|{REQUEST})|.*:{STREAM.decode()}:.*'.encode('utf-8'), re.DOTALL)
+
+def _clear_channel_keys(store, stale_secs=0):
+    batch = []
+    deleted = 0
     try:
-        if redis_db.delete(key) == 1:
-            logger.debug(f'Deleted key {key}')
-        else:
-            logger.debug(f'Failed deleting key {key}')
+        for key in store.scan_iter(count=SCAN_COUNT):
+            if CHANNEL_KEY_PATTERN.fullmatch(key):
+                batch.append(key)
+                if len(batch) >= UNLINK_BATCH:
+                    deleted += _unlink_keys(store, batch, stale_secs)
+                    batch = []
+            elif STATISTIC_DAY_PATTERN.fullmatch(key.decode('utf-8', 'replace')):
+                store.zadd(STATISTIC_DAYS, {key: _statistic_day(key.decode('utf-8'))}, nx=True)
+        if batch:
+            deleted += _unlink_keys(store, batch, stale_secs)
+        logger.debug(f'Deleted {deleted} keys')
     except Exception as e:
-        logger.debug(f'Exception deleting key {key}: {e}')
+        logger.debug(f'Exception deleting keys: {e!r}')
+
+def _unlink_keys(store, keys, stale_secs):
+    # Unlinks the keys, or only those idle at least stale_secs ... a channel key's expiration is renewed whenever it's
+    # used, so its idle time is how much of EXPIRE_SECS has run out (and a key without an expiration is a leftover)
+    if stale_secs:
+        pipeline = store.pipeline(transaction=False)
+        for key in keys:
+            pipeline.ttl(key)
+        keys = [key for key, ttl in zip(keys, pipeline.execute()) if ttl == -1 or EXPIRE_SECS - ttl >= stale_secs]
+    return store.unlink(*keys) if keys else 0
+
+def _statistic_day(key):
+    # A statistics key's day as its score in the statistics index (e.g., stat:2024-01-31 is 20240131)
+    return int(''.join(STATISTIC_DAY_PATTERN.fullmatch(key).groups()))
 
-for key in redis_db.keys(f'*:{REPLY}'):
-    _del_key(key)
+if STALE_KEY_SECS:
+    for store in channel_stores.stores():
+        _clear_channel_keys(store, STALE_KEY_SECS)
+elif not STORE_SHARDS:
+    _clear_channel_keys(redis_db)
 
-for key in redis_db.keys(f'*:{REQUEST}'):
-    _del_key(key)
+if SPOOL_DIR and not STORE_SHARDS and not STALE_KEY_SECS: # Spooled messages belong to the keys just deleted
+    os.makedirs(os.path.join(SPOOL_DIR, SPOOL_SENT_DIR), exist_ok=True)
+    for directory in [SPOOL_DIR, os.path.join(SPOOL_DIR, SPOOL_SENT_DIR)]:
+        for entry in os.scandir(directory):
+            if entry.is_file():
+                os.remove(entry.path)
+
+@app.before_request
+def before_request():
+    _begin_route_log(request.endpoint)
+    g.route_started = time.monotonic()
+    if request.endpoint in CHANNEL_ROUTES and request.method != 'OPTIONS':
+        retry_secs = _admission_wait(request.args.get('channel'), request.remote_addr)
+        if retry_secs:
+            return _rate_limited_response(retry_secs)
+
+@app.after_request
+def after_request(response):
+    if request.method == 'OPTIONS':
+        # Answer a CORS preflight (e.g., for a long browser reply whose upload the browser watches)
+        response.headers.update({'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET, POST',
+                                 'Access-Control-Allow-Headers': 'Content-Type',
+                                 'Access-Control-Max-Age': str(PREFLIGHT_MAX_AGE_SECS)})
+    _end_route_log(response.status_code)
+    _observe_route(request.endpoint, response.status_code, g.route_started)
+    return response
 
 @app.route('/ping', methods=['GET'])
 def ping():
-    with global_mutex:
-        logger.debug('into ping')
-        try:
-            return Response(f'pong {JUPYTER_BRIDGE_VERSION}', status=200, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
-        finally:
-            logger.debug('out of ping')
+    logger.debug('into ping')
+    try:
+        return Response(f'pong {JUPYTER_BRIDGE_VERSION}', status=200, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    finally:
+        logger.debug('out of ping')
 
 @app.route('/stats', methods=['GET'])
 def stats():
-    with global_mutex:
-        logger.debug('into stats')
+    logger.debug('into stats')
 
-        try:
-            # Find all statistics records
-            keys = redis_db.keys(f'{STATISTIC}:*')
-
-            # Create map of statistic lines
-            csv_dict = {}
-            for day in keys:
-                day_string = day.decode('utf-8')[len(STATISTIC) + 1 : ]
-                counts = ['' if count is None else count.decode('utf-8')   for count in redis_db.hmget(day, [f'{COUNT}:{REQUEST}', REQUEST, f'{COUNT}:{REPLY}', REPLY])]
-                csv_dict[day_string] = f"{day_string},{','.join(counts)}"
-
-            # Sort the statistics by date and create the list of dates and counts
-            sorted_csv = dict(sorted(csv_dict.items(), key=lambda item: item[0]))
-            csv = '\n'.join(list(sorted_csv.values()))
-
-            return Response(
-                f"date,{COUNT}({REQUEST}),{REQUEST} bytes,{COUNT}({REPLY}),{REPLY} bytes\n{csv}",
-                mimetype="text/csv",
-                headers={"Content-disposition":
-                             "attachment; filename=jupyter-bridge.csv"})
-        finally:
-            logger.debug('out of stats')
+    try:
+        # Find the statistics records in the date range (if any) in each store, fetching all of a store's days'
+        # counts in one round trip, and add up each day's counts
+        start = _stats_date(request.args.get('start'), '-inf')
+        end = _stats_date(request.args.get('end'), '+inf')
+        totals = {}
+        for store in channel_stores.stores():
+            days = store.zrangebyscore(STATISTIC_DAYS, start, end)
+            pipeline = store.pipeline(transaction=False)
+            for day in days:
+                pipeline.hmget(day, [f'{COUNT}:{REQUEST}', REQUEST, f'{COUNT}:{REPLY}', REPLY])
+            for day, day_counts in zip(days, pipeline.execute()):
+                totals[day] = [_add_count(total, count) for total, count in zip(totals.get(day, [None] * len(day_counts)), day_counts)]
+
+        # Create list of statistic lines, in date order
+        csv_lines = []
+        for day in sorted(totals):
+            day_string = day.decode('utf-8')[len(STATISTIC) + 1 : ]
+            counts = ['' if count is None else str(count)   for count in totals[day]]
+            csv_lines.append(f"{day_string},{','.join(counts)}")
+        csv = '\n'.join(csv_lines)
+
+        return Response(
+            f"date,{COUNT}({REQUEST}),{REQUEST} bytes,{COUNT}({REPLY}),{REPLY} bytes\n{csv}",
+            mimetype="text/csv",
+            headers={"Content-disposition":
+                         "attachment; filename=jupyter-bridge.csv"})
+    except Exception as e:
+        logger.debug(f'stats exception {e!r}')
+        return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    finally:
+        logger.debug('out of stats')
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    logger.debug('into metrics')
+
+    try:
+        _flush_metrics()
+        samples = {**redis_db.hgetall(METRICS_KEY), **_waiter_samples()}
+        return Response(_metrics_text(samples), status=200, content_type='text/plain; version=0.0.4',
+                        headers={'Access-Control-Allow-Origin': '*'})
+    except Exception as e:
+        logger.debug(f'metrics exception {e!r}')
+        return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    finally:
+        logger.debug('out of metrics')
+
+@app.route('/admin/channels', methods=['GET'])
+def admin_channels():
+    # Lists the channels with recent activity (optionally, only those in the state given by the state argument)
+    logger.debug('into admin_channels')
+
+    try:
+        _check_admin_token(request.headers.get('Authorization'))
+        now = time.time()
+        listing = []
+        for store in channel_stores.stores(): # Each shard indexes its own channels
+            channels = store.zrevrangebyscore(CHANNELS, '+inf', now - EXPIRE_SECS)
+            pipeline = store.pipeline(transaction=False)
+            for channel in channels:
+                pipeline.hmget(f'{channel.decode("utf-8")}:{LIVENESS}', LIVENESS_FIELDS)
+            for channel, fields in zip(channels, pipeline.execute()):
+                liveness = _liveness_result(fields)
+                if liveness['since'] is not None: # Otherwise, the channel expired after the index was read
+                    state = _channel_state(liveness, now)
+                    if request.args.get('state') in (None, state):
+                        listing.append({'channel': channel.decode('utf-8'), 'state': state, 'evicted': liveness['evicted'],
+                                        'notebook_idle_secs': _idle_secs(liveness[NOTEBOOK], now),
+                                        'browser_idle_secs': _idle_secs(liveness[BROWSER], now),
+                                        'age_secs': _idle_secs(liveness['since'], now)})
+        listing.sort(key=lambda entry: min(idle for idle in [entry['notebook_idle_secs'], entry['browser_idle_secs'], entry['age_secs']]
+                                           if idle is not None)) # Most recently active first
+        return Response(json.dumps(listing), status=HTTP_OK, content_type='application/json', headers={'Access-Control-Allow-Origin': '*'})
+    except AdminTokenException as e:
+        logger.debug(f'admin_channels exception {e!r}')
+        return Response(str(e), status=HTTP_FORBIDDEN, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    except Exception as e:
+        logger.debug(f'admin_channels exception {e!r}')
+        return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    finally:
+        logger.debug('out of admin_channels')
+
+@app.route('/admin/evict', methods=['POST'])
+def admin_evict():
+    # Discards a channel's waiting messages and tells its browser to stop polling
+    logger.debug('into admin_evict')
+
+    try:
+        _check_admin_token(request.headers.get('Authorization'))
+        if 'channel' in request.args:
+            channel = request.args['channel']
+            with _channel_mutex(channel):
+                pipeline = _channel_store(channel).pipeline(transaction=False)
+                pipeline.hset(f'{channel}:{LIVENESS}', 'evicted', '1')
+                pipeline.hsetnx(f'{channel}:{LIVENESS}', 'since', time.time())
+                pipeline.expire(f'{channel}:{LIVENESS}', EXPIRE_SECS)
+                pipeline.unlink(f'{channel}:{REQUEST}', f'{channel}:{REPLY}')
+                pipeline.execute()
+            return Response('', status=HTTP_OK, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+        else:
+            raise Exception('Channel is missing in parameter list')
+    except AdminTokenException as e:
+        logger.debug(f'admin_evict exception {e!r}')
+        return Response(str(e), status=HTTP_FORBIDDEN, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    except Exception as e:
+        logger.debug(f'admin_evict exception {e!r}')
+        return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    finally:
+        logger.debug('out of admin_evict')
+
+@app.route('/admin/drain', methods=['POST'])
+def admin_drain():
+    # Tells a node's running processes to stop holding long polls, before the node is restarted
+    logger.debug('into admin_drain')
+
+    try:
+        _check_admin_token(request.headers.get('Authorization'))
+        node = request.args.get('node', NODE)
+        redis_db.set(f'{DRAIN}:{node}', time.time(), ex=DRAIN_EXPIRE_SECS)
+        for store in channel_stores.stores(): # Waiters listen for wakeups on their channels' stores
+            store.publish(DRAIN, node)
+        return Response(node, status=HTTP_OK, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    except AdminTokenException as e:
+        logger.debug(f'admin_drain exception {e!r}')
+        return Response(str(e), status=HTTP_FORBIDDEN, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    except Exception as e:
+        logger.debug(f'admin_drain exception {e!r}')
+        return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    finally:
+        logger.debug('out of admin_drain')
 
 @app.route('/queue_request', methods=['POST'])
 def queue_request():
-    with global_mutex:
-        local_transaction = _get_transaction_id()
+    local_transaction = _get_transaction_id()
 
-        logger.debug(f'into queue_request ({local_transaction})')
-        try:
-            if 'channel' in request.args:
-                channel = request.args['channel']
-
-                # Send new request
-                if request.content_type.startswith('application/json'):
-                    message = request.get_data()
-
-                    # Verify that the reply to a previous request was picked up before issuing new request
-                    reply_key = f'{channel}:{REPLY}'
-                    last_reply = redis_db.hget(reply_key, MESSAGE)
-                    if last_reply:
-                        logger.debug(f'Warning: queue_request ({local_transaction}) Reply not picked up before new request. Reply: {last_reply}, Request: {message}')
-                        _del_message(reply_key)
-
-                    _enqueue(local_transaction, REQUEST, channel, message)
-                    return Response('', status=HTTP_OK, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
-                else:
-                    raise Exception('Payload must be application/json')
+    logger.debug(f'into queue_request ({local_transaction})')
+    try:
+        if 'channel' in request.args:
+            channel = request.args['channel']
+            correlation_id = _correlation_id(request.args.get('id'))
+
+            # Send new request
+            if request.content_type.startswith('application/json'):
+                message, encoding, calls = _stored_request(request.get_data(), _content_encoding(request.headers.get('Content-Encoding'), request.args.get('encoding')),
+                                                           request.args.get('batch'))
+                with _channel_mutex(channel):
+                    _enqueue_request(local_transaction, 'queue_request', channel, message, correlation_id, calls, encoding, side=NOTEBOOK)
+                return Response('', status=HTTP_OK, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
             else:
-                raise Exception('Channel is missing in parameter list')
-        except Exception as e:
-            logger.debug(f'queue_request ({local_transaction}) exception {e!r}')
-            return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
-        finally:
-            logger.debug(f'out of queue_request ({local_transaction})')
+                raise Exception('Payload must be application/json')
+        else:
+            raise Exception('Channel is missing in parameter list')
+    except ChannelFullException as e:
+        logger.debug(f'queue_request ({local_transaction}) exception {e!r}')
+        return _channel_full_response(e)
+    except Exception as e:
+        logger.debug(f'queue_request ({local_transaction}) exception {e!r}')
+        return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    finally:
+        logger.debug(f'out of queue_request ({local_transaction})')
 
 @app.route('/queue_reply', methods=['POST'])
 def queue_reply():
-    with global_mutex:
-        local_transaction = _get_transaction_id()
+    local_transaction = _get_transaction_id()
 
-        logger.debug(f'into queue_reply ({local_transaction})')
-        try:
-            if 'channel' in request.args:
-                channel = request.args['channel']
-                if request.content_type.startswith('text/plain'):
-                    message = request.get_data()
-                    _enqueue(local_transaction, REPLY, channel, message)
-                    return Response('', status=HTTP_OK, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
-                else:
-                    raise Exception('Payload must be text/plain')
+    logger.debug(f'into queue_reply ({local_transaction})')
+    try:
+        if 'channel' in request.args:
+            channel = request.args['channel']
+            correlation_id = _correlation_id(request.args.get('id'))
+            reply_type = _reply_content_type(request.content_type, request.args.get('type'))
+            ack = _ack_id(request.args.get('ack'))
+            if reply_type is not None:
+                _enqueue_reply(local_transaction, channel, correlation_id, reply_type, ack or '', side=BROWSER)
+                return Response('', status=HTTP_OK, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
             else:
-                raise Exception('Channel is missing in parameter list')
-        except Exception as e:
-            logger.debug(f'queue_reply ({local_transaction}) exception {e!r}')
-            return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
-        finally:
-            logger.debug(f'out of queue_reply ({local_transaction})')
+                raise Exception(f'Payload must be {PLAIN_TYPE} or {FRAMED_REPLY_TYPE}')
+        else:
+            raise Exception('Channel is missing in parameter list')
+    except ChannelFullException as e:
+        logger.debug(f'queue_reply ({local_transaction}) exception {e!r}')
+        return _channel_full_response(e)
+    except Exception as e:
+        logger.debug(f'queue_reply ({local_transaction}) exception {e!r}')
+        return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    finally:
+        logger.debug(f'out of queue_reply ({local_transaction})')
 
 @app.route('/dequeue_request', methods=['GET'])
 def dequeue_request():
-    with global_mutex:
-        local_transaction = _get_transaction_id()
+    local_transaction = _get_transaction_id()
 
-        logger.debug(f'into dequeue_request ({local_transaction})')
-        try:
-            if 'channel' in request.args:
-                channel = request.args['channel']
-                message, valid_reader = _dequeue(local_transaction, REQUEST, channel, 'reset' in request.args) # Will block waiting for message
-                if valid_reader:
-                    if message is None:
-                        return Response('', status=HTTP_TIMEOUT, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
-                    else:
-                        message = _add_padding(message)
-                        return Response(message, status=HTTP_OK, content_type='application/json', headers={'Access-Control-Allow-Origin': '*'})
-                else:
-                    return Response('', status=HTTP_TOO_MANY, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
-            else:
-                raise Exception('Channel is missing in parameter list')
-        except Exception as e:
-            logger.debug(f'dequeue_request ({local_transaction}) exception {e!r}')
-            return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
-        finally:
-            logger.debug(f'out of dequeue_request ({local_transaction})')
+    logger.debug(f'into dequeue_request ({local_transaction})')
+    try:
+        if 'channel' in request.args:
+            channel = request.args['channel']
+            correlation_id = _correlation_id(request.args.get('id'))
+            pad = _pad_message(request.args.get('pad'))
+            ack = _ack_id(request.args.get('ack'))
+            held = _held_ids(request.args.get('held'))
+            with _channel_mutex(channel):
+                message, encoding, correlation_id, valid_reader, content_type, ack_id = _dequeue(local_transaction, REQUEST, channel, 'reset' in request.args,
+                                                                                                 correlation_id=correlation_id, ack=ack, side=BROWSER,
+                                                                                                 held=held) # Will block waiting for message
+            return _dequeue_response(message, encoding, correlation_id, valid_reader, pad, request.headers.get('Accept-Encoding'), content_type, ack_id)
+        else:
+            raise Exception('Channel is missing in parameter list')
+    except ZombieChannelException as e:
+        logger.debug(f'dequeue_request ({local_transaction}) exception {e!r}')
+        return _zombie_channel_response(e)
+    except Exception as e:
+        logger.debug(f'dequeue_request ({local_transaction}) exception {e!r}')
+        return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    finally:
+        logger.debug(f'out of dequeue_request ({local_transaction})')
 
 @app.route('/dequeue_reply', methods=['GET'])
 def dequeue_reply():
-    with global_mutex:
-        local_transaction = _get_transaction_id()
+    local_transaction = _get_transaction_id()
 
-        logger.debug(f'into dequeue_reply ({local_transaction})')
-        try:
-            if 'channel' in request.args:
-                channel = request.args['channel']
-                message, valid_reader = _dequeue(local_transaction, REPLY, channel, 'reset' in request.args) # Will block waiting for message
-                if valid_reader:
-                    if message is None:
-                        return Response('', status=HTTP_TIMEOUT, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
-                    else:
-                        message = _add_padding(message)
-                        return Response(message, status=HTTP_OK, content_type='application/json',
-                                        headers={'Access-Control-Allow-Origin': '*'})
-                else:
-                    return Response('', status=HTTP_TOO_MANY, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    logger.debug(f'into dequeue_reply ({local_transaction})')
+    try:
+        if 'channel' in request.args:
+            channel = request.args['channel']
+            correlation_id = _correlation_id(request.args.get('id'))
+            pad = _pad_message(request.args.get('pad'))
+            ack = _ack_id(request.args.get('ack'))
+            held = _held_ids(request.args.get('held'))
+            with _channel_mutex(channel):
+                message, encoding, correlation_id, valid_reader, content_type, ack_id = _dequeue(local_transaction, REPLY, channel, 'reset' in request.args,
+                                                                                                 correlation_id=correlation_id, ack=ack, side=NOTEBOOK,
+                                                                                                 held=held) # Will block waiting for message
+            return _dequeue_response(message, encoding, correlation_id, valid_reader, pad, request.headers.get('Accept-Encoding'), content_type, ack_id)
+        else:
+            raise Exception('Channel is missing in parameter list')
+    except Exception as e:
+        logger.debug(f'dequeue_reply ({local_transaction}) exception {e!r}')
+        return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    finally:
+        logger.debug(f'out of dequeue_reply ({local_transaction})')
+
+@app.route('/queue_reply_and_dequeue_request', methods=['POST'])
+def queue_reply_and_dequeue_request():
+    # Combines queue_reply and dequeue_request so that the browser can return a reply and wait for the next request
+    # in a single round trip
+    local_transaction = _get_transaction_id()
+
+    logger.debug(f'into queue_reply_and_dequeue_request ({local_transaction})')
+    try:
+        if 'channel' in request.args:
+            channel = request.args['channel']
+            correlation_id = _correlation_id(request.args.get('id'))
+            pad = _pad_message(request.args.get('pad'))
+            ack = _ack_id(request.args.get('ack'))
+            reply_type = _reply_content_type(request.content_type, request.args.get('type'))
+            if reply_type is not None:
+                _enqueue_reply(local_transaction, channel, correlation_id, reply_type)
+                with _channel_mutex(channel):
+                    message, encoding, correlation_id, valid_reader, content_type, ack_id = _dequeue(local_transaction, REQUEST, channel, False, ack=ack,
+                                                                                                     side=BROWSER) # Will block waiting for message
+                return _dequeue_response(message, encoding, correlation_id, valid_reader, pad, request.headers.get('Accept-Encoding'), content_type, ack_id)
             else:
-                raise Exception('Channel is missing in parameter list')
+                raise Exception(f'Payload must be {PLAIN_TYPE} or {FRAMED_REPLY_TYPE}')
+        else:
+            raise Exception('Channel is missing in parameter list')
+    except ChannelFullException as e:
+        logger.debug(f'queue_reply_and_dequeue_request ({local_transaction}) exception {e!r}')
+        return _channel_full_response(e)
+    except ZombieChannelException as e:
+        logger.debug(f'queue_reply_and_dequeue_request ({local_transaction}) exception {e!r}')
+        return _zombie_channel_response(e)
+    except Exception as e:
+        logger.debug(f'queue_reply_and_dequeue_request ({local_transaction}) exception {e!r}')
+        return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    finally:
+        logger.debug(f'out of queue_reply_and_dequeue_request ({local_transaction})')
+
+@app.route('/queue_request_and_dequeue_reply', methods=['POST'])
+def queue_request_and_dequeue_reply():
+    # Combines queue_request and dequeue_reply so that the notebook can send a request and wait for its reply in a
+    # single round trip. The caller can wait longer than DEQUEUE_TIMEOUT_SECS by passing a timeout (in seconds). If
+    # the request has a correlation ID, only the reply with the same correlation ID is returned.
+    local_transaction = _get_transaction_id()
+
+    logger.debug(f'into queue_request_and_dequeue_reply ({local_transaction})')
+    try:
+        if 'channel' in request.args:
+            channel = request.args['channel']
+            correlation_id = _correlation_id(request.args.get('id'))
+            pad = _pad_message(request.args.get('pad'))
+            ack = _ack_id(request.args.get('ack'))
+            timeout_secs = _dequeue_timeout_secs(request.args.get('timeout'))
+            if request.content_type.startswith('application/json'):
+                message, encoding, calls = _stored_request(request.get_data(), _content_encoding(request.headers.get('Content-Encoding'), request.args.get('encoding')),
+                                                           request.args.get('batch'))
+                with _channel_mutex(channel):
+                    _enqueue_request(local_transaction, 'queue_request_and_dequeue_reply', channel, message, correlation_id, calls, encoding)
+                    message, encoding, correlation_id, valid_reader, content_type, ack_id = _dequeue(local_transaction, REPLY, channel, False, timeout_secs,
+                                                                                                     correlation_id=correlation_id, ack=ack, side=NOTEBOOK) # Will block waiting for message
+                return _dequeue_response(message, encoding, correlation_id, valid_reader, pad, request.headers.get('Accept-Encoding'), content_type, ack_id)
+            else:
+                raise Exception('Payload must be application/json')
+        else:
+            raise Exception('Channel is missing in parameter list')
+    except ChannelFullException as e:
+        logger.debug(f'queue_request_and_dequeue_reply ({local_transaction}) exception {e!r}')
+        return _channel_full_response(e)
+    except Exception as e:
+        logger.debug(f'queue_request_and_dequeue_reply ({local_transaction}) exception {e!r}')
+        return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+    finally:
+        logger.debug(f'out of queue_request_and_dequeue_reply ({local_transaction})')
+
+class ChannelFullException(Exception):
+    """A message with a correlation ID was sent to a channel whose queue is full"""
+    pass
+
+def _admission_wait(channel, address):
+    # Returns how long the caller must wait before its call is admitted (0 if it's admitted now)
+    params = _admission_params(channel, address)
+    if params is None:
+        return 0
+    try:
+        return _admission_result(rate_limit_script(**params))
+    except Exception as e:
+        logger.debug(f'_admission_wait exception {e!r}') # Admit the call rather than fail it ... it will likely fail anyway
+        return 0
+
+def _admission_params(channel, address):
+    keys = []
+    args = [time.time()]
+    if channel and RATE_CHANNEL_PER_SEC:
+        keys.append(f'{RATE}:channel:{channel}')
+        args.extend([RATE_CHANNEL_PER_SEC, RATE_CHANNEL_BURST])
+    if address and RATE_ADDRESS_PER_SEC:
+        keys.append(f'{RATE}:address:{address}')
+        args.extend([RATE_ADDRESS_PER_SEC, RATE_ADDRESS_BURST])
+    return {'keys': keys, 'args': args} if keys else None
+
+def _admission_result(result):
+    return float(result)
+
+def _rate_limited_response(retry_secs):
+    logger.debug(f'rate limited for {retry_secs} seconds')
+    return Response(f'Too many calls ... retry after {retry_secs:.3f} seconds', status=HTTP_TOO_MANY, content_type='text/plain',
+                    headers={'Access-Control-Allow-Origin': '*', 'Access-Control-Expose-Headers': 'Retry-After',
+                             'Retry-After': str(math.ceil(retry_secs))})
+
+class ZombieChannelException(Exception):
+    """A browser polled a channel that was evicted or whose notebook has been silent too long"""
+    pass
+
+class AdminTokenException(Exception):
+    """An /admin route was called without the admin token"""
+    pass
+
+def _check_admin_token(authorization):
+    if not ADMIN_TOKEN:
+        raise AdminTokenException('Admin routes are disabled')
+    if not hmac.compare_digest((authorization or '').encode('utf-8'), f'Bearer {ADMIN_TOKEN}'.encode('utf-8')):
+        raise AdminTokenException('Admin token is missing or wrong')
+
+def _touch_channel(channel, side):
+    return _liveness_result(touch_channel_script(**_touch_channel_params(channel, side), client=_channel_store(channel)))
+
+def _touch_channel_params(channel, side):
+    return {'keys': [f'{channel}:{LIVENESS}', CHANNELS], 'args': [side, time.time(), EXPIRE_SECS, channel]}
+
+def _liveness_result(result):
+    notebook, browser, since, evicted = result
+    return {NOTEBOOK: float(notebook) if notebook else None, BROWSER: float(browser) if browser else None,
+            'since': float(since) if since else None, 'evicted': evicted == b'1'}
+
+def _notebook_silence(liveness, now):
+    # How long since the notebook side was last active ... or since the channel was first seen, if it never was
+    return now - (liveness[NOTEBOOK] or liveness['since'] or now)
+
+def _channel_state(liveness, now):
+    silence = _notebook_silence(liveness, now)
+    if silence < CHANNEL_IDLE_SECS:
+        return 'active'
+    elif silence >= CHANNEL_ZOMBIE_SECS and liveness[BROWSER] and now - liveness[BROWSER] < 2 * MAX_DEQUEUE_TIMEOUT_SECS:
+        return 'zombie'
+    else:
+        return 'idle'
+
+def _idle_secs(last_time, now):
+    return None if last_time is None else round(now - last_time, 1)
+
+def _browser_hold_secs(liveness, now):
+    # How long a browser's dequeue waits for a request. A zombie browser waits twice as long for each period of its
+    # notebook's silence (up to the longest wait allowed), so it polls less and less often, and it's eventually
+    # rejected, which tells it to stop polling.
+    if liveness['evicted']:
+        raise ZombieChannelException('Channel was evicted')
+    silence = _notebook_silence(liveness, now)
+    if silence < CHANNEL_ZOMBIE_SECS:
+        return DEQUEUE_TIMEOUT_SECS
+    elif CHANNEL_REJECT_SECS and silence >= CHANNEL_REJECT_SECS:
+        raise ZombieChannelException(f'Channel notebook has been silent for {silence:.0f} seconds')
+    doublings = min(int(silence // CHANNEL_ZOMBIE_SECS), MAX_ZOMBIE_DOUBLINGS)
+    return max(min(DEQUEUE_TIMEOUT_SECS * 2 ** doublings, MAX_DEQUEUE_TIMEOUT_SECS), DEQUEUE_TIMEOUT_SECS)
+
+def _correlation_id(correlation_id):
+    if correlation_id is None or correlation_id == '':
+        return ''
+    elif CORRELATION_ID_PATTERN.fullmatch(correlation_id):
+        return correlation_id
+    else:
+        raise Exception(f'Correlation ID must be 1 to 128 letters, digits, or ._:- characters: {correlation_id}')
+
+def _ack_id(ack):
+    # The ack argument of a dequeue: None if the reader doesn't acknowledge messages, '' if it has none to acknowledge,
+    # or the IDs of the messages it acknowledges (separated by commas). A reply's ack argument names the requests it
+    # answers.
+    if ack is None or ack == '' or all(message_id.isdigit() for message_id in ack.split(',')):
+        return ack
+    raise Exception(f'Acknowledged message IDs must be numbers: {ack}')
+
+def _held_ids(held):
+    # The held argument of a dequeue: the IDs of the messages that the reader has received and not yet acknowledged
+    # (separated by commas), so they aren't delivered to it again
+    if held is None or held == '':
+        return ''
+    elif all(message_id.isdigit() for message_id in held.split(',')):
+        return held
+    raise Exception(f'Held message IDs must be numbers: {held}')
+
+def _batch_calls(batch, msg, encoding):
+    # Number of Cytoscape calls in a request, for statistics ... a batch request declares how many calls it contains,
+    # and the count must match the calls in its envelope (see README.md)
+    if batch is None:
+        return 1
+    calls = int(batch)
+    if calls < 1 or calls > MAX_BATCH_CALLS:
+        raise Exception(f'Batch must contain 1 to {MAX_BATCH_CALLS} calls: {batch}')
+    envelope = json.loads(_readable_message(msg, encoding, None)[0])
+    envelope_calls = envelope.get('calls') if isinstance(envelope, dict) else None
+    if not isinstance(envelope_calls, list):
+        raise Exception('Batch envelope must contain a calls array')
+    if len(envelope_calls) != calls:
+        raise Exception(f'Batch declares {calls} calls, but its envelope contains {len(envelope_calls)}')
+    return calls
+
+def _add_count(total, count):
+    # Adds a shard's count (or None) for a statistic to the total so far (or None)
+    if count is None:
+        return total
+    return (total or 0) + int(count)
+
+def _stats_date(date, unbounded):
+    # A /stats date argument (e.g., 2024-01-31) as a statistics index score
+    if date is None:
+        return unbounded
+    elif re.fullmatch(r'\d{4}-\d{2}-\d{2}', date):
+        time.strptime(date, '%Y-%m-%d') # Raises if there's no such day
+        return _statistic_day(f'{STATISTIC}:{date}')
+    else:
+        raise Exception(f'Date must be YYYY-MM-DD: {date}')
+
+def _dequeue_timeout_secs(timeout):
+    # Caller's timeout (if any) capped at the longest timeout allowed
+    if timeout is None:
+        return DEQUEUE_TIMEOUT_SECS
+    timeout_secs = float(timeout)
+    if not timeout_secs > 0:
+        raise Exception(f'Timeout must be greater than 0: {timeout}')
+    return min(timeout_secs, MAX_DEQUEUE_TIMEOUT_SECS)
+
+def _dequeue_response(message, encoding, correlation_id, valid_reader, pad, accept_encoding, content_type=JSON_TYPE, ack_id=''):
+    if valid_reader:
+        if message is None:
+            return Response('', status=HTTP_TIMEOUT, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+        elif isinstance(message, StreamedMessage):
+            sent_encoding = _sent_encoding(encoding, accept_encoding) if encoding else ''
+            return Response(_stream_chunks(message, encoding, sent_encoding), status=HTTP_OK, content_type=content_type,
+                            headers=_message_headers(correlation_id, sent_encoding, ack_id))
+        elif isinstance(message, SpooledMessage):
+            # The file is sent by nginx or by the WSGI server's file wrapper, so its bytes never pass through Python
+            # (unless the reader needs them decompressed)
+            sent_encoding = _sent_encoding(encoding, accept_encoding) if encoding else ''
+            headers = _message_headers(correlation_id, sent_encoding, ack_id)
+            if SPOOL_ACCEL_PREFIX and sent_encoding == encoding and content_type == JSON_TYPE: # nginx sends it as JSON
+                headers['X-Accel-Redirect'] = _accel_redirect(message)
+                return Response('', status=HTTP_OK, content_type=content_type, headers=headers)
+            spool_file = _spooled_file(message)
+            if sent_encoding == encoding:
+                body = wrap_file(request.environ, spool_file, STREAM_CHUNK_BYTES)
+            else:
+                body = _file_chunks(spool_file, _decompressor(encoding))
+            return Response(body, status=HTTP_OK, content_type=content_type, headers=headers, direct_passthrough=True)
+        else:
+            # Padding can't follow a compressed message, and a compressed message is too long to need it. Only JSON
+            # can be padded without changing what the reader gets.
+            message, encoding = _readable_message(message, encoding, accept_encoding)
+            return Response(_message_chunks(message, pad and not encoding and content_type == JSON_TYPE), status=HTTP_OK, content_type=content_type,
+                            headers=_message_headers(correlation_id, encoding, ack_id))
+    else:
+        return Response('', status=HTTP_TOO_MANY, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+
+def _channel_full_response(e):
+    return Response(str(e), status=HTTP_TOO_MANY, content_type='text/plain',
+                    headers={'Access-Control-Allow-Origin': '*', 'Access-Control-Expose-Headers': 'Retry-After',
+                             'Retry-After': str(QUEUE_FULL_RETRY_SECS)})
+
+def _zombie_channel_response(e):
+    # The browser stops polling when its dequeue gets an HTTP 429
+    return Response(str(e), status=HTTP_TOO_MANY, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
+
+def _message_headers(correlation_id, encoding, ack_id=''):
+    headers = {'Access-Control-Allow-Origin': '*', 'Access-Control-Expose-Headers': f'{CORRELATION_ID_HEADER}, {MESSAGE_ID_HEADER}',
+               'Vary': 'Accept-Encoding'}
+    if correlation_id:
+        headers[CORRELATION_ID_HEADER] = correlation_id
+    if ack_id:
+        headers[MESSAGE_ID_HEADER] = ack_id
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return headers
+
+def _reply_content_type(header, arg):
+    # The content type a reply is stored with, or None if replies can't have the sender's content type. A plain reply
+    # is the browser's JSON envelope, and a framed reply is returned with its own content type. The sender's content
+    # type is given by the Content-Type header or by the type argument, which lets a browser send a framed reply
+    # without triggering a CORS preflight.
+    content_type = (arg or header or '').strip().lower()
+    if content_type.startswith(PLAIN_TYPE):
+        return ''
+    elif content_type.startswith(FRAMED_REPLY_TYPE):
+        return FRAMED_REPLY_TYPE
+    else:
+        return None
+
+def _content_encoding(header, arg):
+    # The sender's encoding is given by the Content-Encoding header or by the encoding argument, which lets a browser
+    # send a compressed message without triggering a CORS preflight
+    encoding = (arg or header or '').strip().lower()
+    if encoding in ('', 'identity'):
+        return ''
+    elif encoding == GZIP or (encoding == ZSTD and zstandard):
+        return encoding
+    else:
+        raise Exception(f'Unsupported content encoding: {encoding}')
+
+def _accepted_encodings(accept_encoding):
+    # Encodings listed in an Accept-Encoding header, less any that the reader refuses (i.e., q=0)
+    accepted = set()
+    for coding in (accept_encoding or '').split(','):
+        name, _, quality = coding.partition(';')
+        quality = quality.replace(' ', '').lower()
+        if not re.fullmatch(r'q=0(\.0*)?', quality):
+            accepted.add(name.strip().lower())
+    return accepted
+
+def _stored_request(msg, encoding, batch):
+    # Returns a request and its encoding as it should be stored (see _stored_message), and the number of Cytoscape
+    # calls it contains (see _batch_calls)
+    calls = _batch_calls(batch, msg, encoding)
+    return (*_stored_message(msg, encoding), calls)
+
+def _stored_message(msg, encoding):
+    # Returns a message and its encoding as it should be stored ... large uncompressed messages are compressed, and
+    # compressed messages are stored as they came
+    if not encoding and COMPRESS_MIN_BYTES and len(msg) >= COMPRESS_MIN_BYTES:
+        return gzip.compress(msg, compresslevel=COMPRESS_LEVEL), GZIP
+    return msg, encoding
+
+def _sent_encoding(encoding, accept_encoding):
+    # A message is sent in its stored encoding if the reader accepts it, and decompressed otherwise
+    accepted = _accepted_encodings(accept_encoding)
+    return encoding if encoding in accepted or '*' in accepted else ''
+
+def _readable_message(msg, encoding, accept_encoding):
+    # Returns a stored message and its encoding as it should be sent
+    if not encoding or _sent_encoding(encoding, accept_encoding):
+        return msg, encoding
+    elif encoding == GZIP:
+        return gzip.decompress(msg), ''
+    elif encoding == ZSTD and zstandard:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(msg), ''
+    else:
+        raise Exception(f'Unsupported content encoding: {encoding}')
+
+def _decompressor(encoding):
+    if encoding == GZIP:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == ZSTD and zstandard:
+        return zstandard.ZstdDecompressor().decompressobj()
+    else:
+        raise Exception(f'Unsupported content encoding: {encoding}')
+
+class StreamedMessage:
+    """A message that is appended to a list of chunks as it is uploaded, instead of being stored whole. The chunks
+    are kept in the same store as the channel they're sent on."""
+    def __init__(self, key, channel):
+        self.key = key
+        self.channel = channel
+
+    def __repr__(self):
+        return f'StreamedMessage({self.key!r})'
+
+class SpooledMessage:
+    """A message that is held in a file in SPOOL_DIR, instead of in redis"""
+    def __init__(self, name, size=0):
+        self.name = name
+        self.size = size
+
+    def __repr__(self):
+        return f'SpooledMessage({self.name!r}, {self.size})'
+
+def _spoolable(msg):
+    return SPOOL_DIR and isinstance(msg, bytes) and len(msg) >= SPOOL_MIN_BYTES
+
+def _spool_message(msg):
+    # Writes a message to a file of its own and returns a reference to it. The sweeper discards the file if the
+    # message is never dequeued.
+    _start_spool_sweeper()
+    message = SpooledMessage(uuid.uuid4().hex, len(msg))
+    with open(_spool_path(message.name), 'wb') as spool_file:
+        spool_file.write(msg)
+    return message
+
+def _unspool_message(message):
+    try:
+        os.remove(_spool_path(message.name))
+    except FileNotFoundError:
+        pass
+
+def _spool_path(name):
+    return os.path.join(SPOOL_DIR, name)
+
+def _spooled_file(message):
+    # Opens a spooled message's file and discards it ... the open file stays readable until it's closed
+    try:
+        spool_file = open(_spool_path(message.name), 'rb')
+    except FileNotFoundError:
+        raise Exception(f'Spooled message {message.name} has expired')
+    os.remove(spool_file.name)
+    return spool_file
+
+def _accel_redirect(message):
+    # Moves a spooled message's file to where nginx will find it, and returns the location nginx should send. The
+    # sweeper discards the file once nginx has surely opened it.
+    sent_path = os.path.join(SPOOL_DIR, SPOOL_SENT_DIR, message.name)
+    try:
+        os.replace(_spool_path(message.name), sent_path)
+    except FileNotFoundError:
+        raise Exception(f'Spooled message {message.name} has expired')
+    os.utime(sent_path)
+    return f'{SPOOL_ACCEL_PREFIX}{SPOOL_SENT_DIR}/{message.name}'
+
+def _file_chunks(spool_file, decompressor):
+    # Yields a spooled message's file in chunks, decompressing them
+    with spool_file:
+        while True:
+            chunk = spool_file.read(STREAM_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+
+spool_sweeper_lock = threading.Lock()
+spool_sweeper = None
+
+def _start_spool_sweeper():
+    # Each process that spools a message starts a sweeper thread, and the sweepers take turns sweeping the spool
+    global spool_sweeper
+    with spool_sweeper_lock:
+        if spool_sweeper is None:
+            spool_sweeper = threading.Thread(target=_sweep_spool_forever, name='spool-sweeper', daemon=True)
+            spool_sweeper.start()
+
+def _sweep_spool_forever():
+    while True:
+        time.sleep(SPOOL_SWEEP_SECS)
+        try:
+            if redis_db.set(SPOOL_SWEEP_KEY, os.getpid(), nx=True, ex=SPOOL_SWEEP_SECS):
+                _sweep_spool(time.time())
         except Exception as e:
-            logger.debug(f'dequeue_reply ({local_transaction}) exception {e!r}')
-            return Response(_exception_message(e), status=HTTP_SYS_ERR, content_type='text/plain', headers={'Access-Control-Allow-Origin': '*'})
-        finally:
-            logger.debug(f'out of dequeue_reply ({local_transaction})')
+            logger.debug(f'_sweep_spool exception {e!r}')
 
-def _enqueue(local_transaction, operation, channel, msg):
-    key = f'{channel}:{operation}'
-    logger.debug(f' into _enqueue ({local_transaction}): key: {key}')
-    logger.debug(f'  _enqueue ({local_transaction}) sends: {msg}')
+def _sweep_spool(now):
+    # Discards spooled messages that have waited as long as an idle key lives, and messages that nginx has opened
+    swept = 0
+    for directory, expire_secs in [(SPOOL_DIR, EXPIRE_SECS), (os.path.join(SPOOL_DIR, SPOOL_SENT_DIR), SPOOL_SENT_SECS)]:
+        for entry in os.scandir(directory):
+            try:
+                if entry.is_file() and now - entry.stat().st_mtime > expire_secs:
+                    os.remove(entry.path)
+                    swept += 1
+            except FileNotFoundError: # Dequeued while sweeping
+                pass
+    logger.debug(f'_sweep_spool discarded {swept} spooled messages')
+
+def _enqueue_reply(local_transaction, channel, correlation_id, content_type='', ack='', side=''):
+    # Queues the reply in the request body. A long reply is queued before it is uploaded, and its chunks are stored
+    # as they arrive so that the reader can start on them right away. The requests named by ack are acknowledged as
+    # the reply is queued, and the activity of the side (if given) is recorded.
+    encoding = _content_encoding(request.headers.get('Content-Encoding'), request.args.get('encoding'))
+    if not _streams_reply(request.content_length):
+        message, encoding = _stored_message(request.get_data(), encoding)
+        with _channel_mutex(channel):
+            _enqueue(local_transaction, REPLY, channel, message, correlation_id, encoding=encoding, content_type=content_type, ack=ack, side=side)
+    else:
+        message, stored_encoding, compress = _reply_stream(channel, encoding)
+        with _channel_mutex(channel):
+            _enqueue(local_transaction, REPLY, channel, message, correlation_id, encoding=stored_encoding, content_type=content_type, ack=ack,
+                     side=side)
+        _stream_message(local_transaction, REPLY, message, request.stream, compress)
+
+def _streams_reply(content_length):
+    # Whether a reply of this length (None if unknown) is streamed rather than read whole before it's queued
+    return content_length is None or content_length >= STREAM_MIN_BYTES
+
+def _reply_stream(channel, encoding):
+    # Returns the StreamedMessage that stands for a reply in its queue, the encoding it's stored in, and whether it's
+    # compressed as it's streamed (unless it arrives compressed)
+    compress = not encoding and COMPRESS_MIN_BYTES > 0
+    return StreamedMessage(_stream_key(channel, REPLY), channel), GZIP if compress else encoding, compress
+
+def _stream_key(channel, operation):
+    return f'{channel}:{operation}:{STREAM.decode()}:{uuid.uuid4().hex}'
+
+def _stream_message(local_transaction, operation, message, stream, compress):
+    # Stores a message's chunks as they're read, compressing them if asked
+    logger.debug(f' into _stream_message ({local_transaction}): key: {message.key}, compress: {compress}')
+    writer = _StreamWriter(compress)
+    end_tag = STREAM_ABORTED
+    try:
+        more = True
+        while more:
+            data = stream.read(STREAM_CHUNK_BYTES)
+            more = bool(data)
+            for chunk in writer.chunks(data, more):
+                _push_chunk(message, chunk)
+        end_tag = STREAM_END
+    finally:
+        _push_chunk(message, end_tag) # If the upload fails, the reader must not wait for the rest of it
+        _channel_store(message.channel).hincrby(writer.statistics_key, operation, writer.stream_bytes)
+        logger.debug(f' out of _stream_message ({local_transaction}): {writer.stream_bytes} bytes, end: {end_tag}')
+
+def _push_chunk(message, chunk):
+    pipeline = _channel_store(message.channel).pipeline(transaction=False)
+    pipeline.rpush(message.key, chunk)
+    pipeline.expire(message.key, EXPIRE_SECS)
+    pipeline.execute()
+
+def _stream_chunks(message, stored_encoding, sent_encoding):
+    # Yields a streamed message's chunks as they arrive. The chunks are discarded as they're taken, and the rest are
+    # discarded if the reader goes away.
+    reader = _StreamReader(message, stored_encoding, sent_encoding)
+    store = _channel_store(message.channel)
     try:
-        cur_value = redis_db.hgetall(key)
-        if len(cur_value) == 0 or not MESSAGE in cur_value:
-            _set_key_value(key, {MESSAGE: msg, PICKUP_TIME: '', POSTED_TIME: time.asctime()})
-            _expire(key)
+        while not reader.ended:
+            yield reader.data(store.blpop(message.key, timeout=STREAM_CHUNK_TIMEOUT_SECS))
+    except Exception as e:
+        logger.debug(f'_stream_chunks exception {e!r}')
+        raise
+    finally:
+        store.delete(message.key)
+
+class _StreamWriter:
+    """Cuts a message's body into the tagged chunks that are stored for its reader, as the body is read.
+
+    The body's data is added as it arrives, in pieces of any size, and it's stored in chunks of at least
+    STREAM_CHUNK_BYTES (except for the last), compressed if asked. Chunks are small enough to compress in line.
+    """
 
-            _update_stats(operation, msg)
+    def __init__(self, compress):
+        self.compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+        self.statistics_key = time.strftime(f'{STATISTIC}:%Y-%m-%d') # The day the message was queued
+        self.stream_bytes = 0
+        self.pending = bytearray()
 
+    def chunks(self, data, more):
+        # Adds data to the body, and returns the chunks that are ready to store ... all of them if no more is coming
+        self.pending += data
+        chunks = []
+        if len(self.pending) >= STREAM_CHUNK_BYTES or not more:
+            chunk = self.compressor.compress(self.pending) if self.compressor else bytes(self.pending)
+            self.pending = bytearray()
+            if chunk:
+                chunks.append(chunk)
+        if not more and self.compressor:
+            chunks.append(self.compressor.flush())
+        self.stream_bytes += sum(len(chunk) for chunk in chunks)
+        return [STREAM_DATA + chunk for chunk in chunks]
+
+class _StreamReader:
+    """Turns the tagged chunks of a streamed message back into its body, as its reader takes them.
+
+    The chunks are decompressed unless they're sent in their stored encoding. The body ends at the end tag, and a
+    missing chunk or an aborted upload fails it.
+    """
+
+    def __init__(self, message, stored_encoding, sent_encoding):
+        self.key = message.key
+        self.decompressor = _decompressor(stored_encoding) if stored_encoding and not sent_encoding else None
+        self.ended = False
+
+    def data(self, result):
+        # Given what BLPOP returned for the next chunk, returns the body's data in it
+        if result is None:
+            raise Exception(f'Timed out waiting for chunk of {self.key}')
+        chunk = result[1]
+        if chunk[:1] == STREAM_DATA:
+            return self.decompressor.decompress(chunk[1:]) if self.decompressor else chunk[1:]
+        elif chunk[:1] == STREAM_END:
+            self.ended = True
+            return self.decompressor.flush() if self.decompressor else b''
         else:
-            raise Exception(f'Channel {key} contains unprocessed message')
+            raise Exception(f'Sender stopped sending {self.key}')
+
+def _enqueue_request(local_transaction, route, channel, msg, correlation_id, calls=1, encoding='', side=''):
+    last_reply = _enqueue(local_transaction, REQUEST, channel, msg, correlation_id, discard_key=_request_discard_key(channel, correlation_id),
+                          calls=calls, encoding=encoding, side=side)
+    _log_discarded_reply(local_transaction, route, last_reply, msg)
+
+def _request_discard_key(channel, correlation_id):
+    # A request without a correlation ID replaces the reply to the previous request if it wasn't picked up. A request
+    # with a correlation ID leaves other requests' replies alone.
+    return None if correlation_id else f'{channel}:{REPLY}'
+
+def _log_discarded_reply(local_transaction, route, last_reply, msg):
+    if last_reply:
+        logger.debug(f'Warning: {route} ({local_transaction}) Reply not picked up before new request. Reply: {_loggable(last_reply)}, Request: {_loggable(msg)}')
+
+def _enqueue(local_transaction, operation, channel, msg, correlation_id='', discard_key=None, calls=1, encoding='', content_type='', ack='', side=''):
+    key = f'{channel}:{operation}'
+    logger.debug(f' into _enqueue ({local_transaction}): key: {key}, correlation_id: {correlation_id}, encoding: {encoding}, content_type: {content_type}, ack: {ack}, side: {side}')
+    logger.debug(f'  _enqueue ({local_transaction}) sends: {_loggable(msg)}')
+    try:
+        spooled = _spool_message(msg) if _spoolable(msg) else None
+        try:
+            params = _enqueue_params(key, operation, spooled or msg, correlation_id, discard_key, calls, encoding, content_type, ack, side)
+            started = time.monotonic()
+            result = enqueue_script(**params, client=_channel_store(channel))
+            _observe_enqueue(operation, params, started)
+            return _enqueue_result(key, result)
+        except Exception:
+            if spooled:
+                _unspool_message(spooled)
+            raise
     finally:
         logger.debug(f' out of _enqueue ({local_transaction})')
 
-def _dequeue(local_transaction, operation, channel, reset_first):
-    key = f'{channel}:{operation}'
-    logger.debug(f' into _dequeue ({local_transaction}): key: {key}, reset_first: {reset_first}')
-    message = None
-    valid_reader = True
+def _dequeue(local_transaction, operation, channel, reset_first, timeout_secs=DEQUEUE_TIMEOUT_SECS, correlation_id='', ack=None, side='', held=''):
+    dequeue = _DequeueState(local_transaction, operation, channel, reset_first, timeout_secs, correlation_id, ack, side, held)
+    channel_mutex = _channel_mutex(channel)
+    store = _channel_store(channel)
     try:
-        dequeue_busy = redis_db.hget(key, DEQUEUE_BUSY) or DEQUEUE_IDLE_STATUS
-        if dequeue_busy == DEQUEUE_BUSY_STATUS:
-            valid_reader = False
-            logger.debug(f'  _dequeue ({local_transaction}) detected redundant reader: {operation}, channel: {channel}')
-        else:
-            _set_key_value(key, {DEQUEUE_BUSY: DEQUEUE_BUSY_STATUS})
-            if reset_first: # Clear out any (presumably dead) reader ... assume first dequeue precedes first enqueue
-                _del_message(key, permissive=True)
-            _set_key_value(key, {PICKUP_TIME: ''})
-            _expire(key) # Needed in case nothing ever adds to this queue (via _enqueue)
-
-            # Use a heuristic to figure out how often to poll redis for a request or reply. This is useful because
-            # there are known to be zombie waiters, particularly because the browser create virtual machines
-            # that keep executing, but on behalf of no client. Zombies could also exist simply because a user
-            # isn't calling Cytoscape, or Cytoscape is taking a long time to return a result. If we allow
-            # zombies to poll rapidly, redis bandwidth for legitimate users is unavailable. For this heuristic,
-            # we allow fast polling for some number of _dequeue calls, but then drop down to a much slower
-            # polling after that. All of this can go away if we wait asynchronously for a key value, but that's
-            # for another day.
-            fast_polls_left = redis_db.hget(key, REPLY_FAST_POLLS_LEFT)
-            if fast_polls_left is None:
-                fast_polls_left = ALLOWED_FAST_DEQUEUE_POLLS
-            else:
-                fast_polls_left = int(fast_polls_left.decode('utf-8'))
-            if fast_polls_left > 0:
-                fast_polls_left -= 1
-                _set_key_value(key, {REPLY_FAST_POLLS_LEFT: fast_polls_left})
-                dequeue_polling_secs = FAST_DEQUEUE_POLLING_SECS
-            else:
-                dequeue_polling_secs = SLOW_DEQUEUE_POLLING_SECS
-
-            # Keep trying to read a message until we have to give up ... meanwhile, let other threads execute
-            message = redis_db.hget(key, MESSAGE)
-            dequeue_timeout_secs_left = DEQUEUE_TIMEOUT_SECS
-            while message is None and dequeue_timeout_secs_left > 0:
-                global_mutex.release()
-                time.sleep(dequeue_polling_secs)
-                global_mutex.acquire()
-                dequeue_timeout_secs_left -= dequeue_polling_secs
-                message = redis_db.hget(key, MESSAGE)
-            # TODO: Polling is good enough for now, but for scaling, replace with await
-
-            if message:
-                logger.debug(f'  _dequeue ({local_transaction}) returns: {message}')
-                _del_message(key)
-                _set_key_value(key, {PICKUP_TIME: time.asctime(), REPLY_FAST_POLLS_LEFT: ALLOWED_FAST_DEQUEUE_POLLS})
-            else:
-                logger.debug(f'  _dequeue ({local_transaction}) timed out: {operation}, channel: {channel}, fast polls left: {fast_polls_left}, polling seconds: {dequeue_polling_secs}')
+        # Wait for _enqueue to announce a message on this key instead of polling redis for it. Registering for the
+        # wakeup before the claim guarantees that a message posted between the claim and the wait still wakes us up.
+        # Other threads can execute while we wait. Zombie waiters (e.g., browser virtual machines that keep executing
+        # on behalf of no client) cost an idle event instead of a stream of redis reads. A drain announcement ends
+        # the wait, too. The attempt after the last wait releases the key.
+        wakeups.start()
+        event = wakeups.add(dequeue.key, store)
+        try:
+            if dequeue.claimed(_dequeue_attempt(store, dequeue.claim(_draining()))):
+                _count_waiter(operation, 1)
+                try:
+                    while dequeue.waiting():
+                        channel_mutex.release()
+                        try:
+                            if not wakeups.start(): # Listeners that had to be restarted may have missed the wakeup
+                                wakeups.wait(event, dequeue.remaining_secs())
+                        finally:
+                            channel_mutex.acquire()
+                        dequeue.checked_drain(_draining())
+                        dequeue.took(_dequeue_attempt(store, dequeue.attempt()))
+                    if not dequeue.released:
+                        dequeue.took(_dequeue_attempt(store, dequeue.attempt(release=True)))
+                finally:
+                    _count_waiter(operation, -1)
+        finally:
+            wakeups.remove(dequeue.key, event)
     finally:
-        if valid_reader:
-            _set_key_value(key, {DEQUEUE_BUSY: DEQUEUE_IDLE_STATUS})
+        if not dequeue.released: # Something went wrong while waiting ... let the next reader in
+            store.hset(dequeue.key, DEQUEUE_BUSY, DEQUEUE_IDLE_STATUS)
         logger.debug(f' out of _dequeue ({local_transaction})')
 
-    return message, valid_reader
+    return dequeue.result()
 
-def _add_padding(message):
-    if PAD_MESSAGE:
-        if isinstance(message, str):
-            message += ' ' * 1500
-        elif isinstance(message, bytes):
-            message += (' ' * 1500).encode('ascii')
-    return message
+def _dequeue_attempt(store, params):
+    # Returns the message (or None), its encoding, its correlation ID, whether the reader has the key, the message's
+    # content type, the ID the reader acknowledges it by (or '' if it needn't), and the channel's liveness (or None
+    # if the attempt didn't touch it)
+    started = time.monotonic()
+    result = dequeue_script(**params, client=store)
+    _observe('jupyter_bridge_redis_seconds', 'script="dequeue"', time.monotonic() - started)
+    return _dequeue_result(params['keys'][0], result)
+
+# Like _StreamWriter and _StreamReader, the dequeue state and the script parameters and results below are shared with
+# asgi.py, whose coroutines differ from their namesakes here only in how they make their redis calls and how they wait
+
+class _DequeueState:
+    """Where a dequeue stands: the message it has taken (if any), whether it holds its key, and how long it waits.
+
+    The dequeue claims its key for its reader and takes any waiting message. Also, the claim sets the key's expiration
+    in case nothing ever adds to its queue (via _enqueue). If there's no message, the dequeue holds the key while it
+    waits for one, and releases it if none comes. A draining process doesn't hold long polls.
+
+    A dequeue on behalf of a side (NOTEBOOK or BROWSER) touches the channel's liveness in the same script as its claim.
+    A browser's wait then depends on how long its notebook has been silent (see _browser_hold_secs).
+    """
+
+    def __init__(self, local_transaction, operation, channel, reset_first, timeout_secs, correlation_id, ack, side='', held=''):
+        self.local_transaction = local_transaction
+        self.operation = operation
+        self.channel = channel
+        self.key = f'{channel}:{operation}'
+        self.reset_first = reset_first
+        self.timeout_secs = timeout_secs
+        self.correlation_id = correlation_id
+        self.ack = ack
+        self.side = side
+        self.held = held
+        self.draining = False
+        self.message = None
+        self.encoding = ''
+        self.message_id = ''
+        self.valid_reader = True
+        self.content_type = JSON_TYPE
+        self.ack_id = ''
+        self.released = True
+        self.releasing = False
+        self.wait_started = None
+        self.deadline = None
+        logger.debug(f' into _dequeue ({local_transaction}): key: {self.key}, reset_first: {reset_first}, timeout_secs: {timeout_secs}, correlation_id: {correlation_id}, ack: {ack}, side: {side}, held: {held}')
+
+    def claim(self, draining):
+        # Returns the parameters of the attempt that claims the key. A browser's wait isn't known until the claim
+        # returns its channel's liveness, so its claim lasts for the longest wait.
+        self.draining = draining
+        if self.side == BROWSER:
+            self.timeout_secs = MAX_DEQUEUE_TIMEOUT_SECS
+        if draining:
+            self.timeout_secs = min(self.timeout_secs, DRAIN_POLL_SECS)
+        return _dequeue_params(self.key, self.correlation_id, True, self.reset_first, False, self.timeout_secs, self.ack, self.side, self.held)
+
+    def attempt(self, release=False):
+        # Returns the parameters of an attempt by the key's reader, which releases the key if asked or if the wait
+        # is over, as this is the last attempt
+        self.releasing = release or time.monotonic() >= self.deadline
+        return _dequeue_params(self.key, self.correlation_id, False, False, self.releasing, 0, self.ack, held=self.held)
+
+    def claimed(self, result):
+        # Given the claim's result (see _dequeue_attempt), returns whether to wait for a message. A zombie browser
+        # that has no message is rejected with ZombieChannelException, after which the key is released.
+        self.took(result)
+        self.valid_reader = result[3]
+        self.released = self.message is not None or not self.valid_reader
+        if self.side == BROWSER and self.message is None:
+            self.timeout_secs = _browser_hold_secs(result[6], time.time())
+            if self.draining:
+                self.timeout_secs = min(self.timeout_secs, DRAIN_POLL_SECS)
+        if not self.valid_reader:
+            logger.debug(f'  _dequeue ({self.local_transaction}) detected redundant reader: {self.operation}, channel: {self.channel}')
+            return False
+        return not self.released
+
+    def took(self, result):
+        self.message, self.encoding, self.message_id, _, self.content_type, self.ack_id, _ = result
+        self.released = self.message is not None or self.releasing
+
+    def waiting(self):
+        # Returns whether to wait (again) for a message ... the wait starts at the first call
+        if self.deadline is None:
+            self.wait_started = time.monotonic()
+            self.deadline = self.wait_started + self.timeout_secs
+        return self.message is None and time.monotonic() < self.deadline
+
+    def remaining_secs(self):
+        return self.deadline - time.monotonic()
+
+    def checked_drain(self, draining):
+        if draining: # Stop holding the poll
+            self.deadline = min(self.deadline, self.wait_started + DRAIN_POLL_SECS)
+
+    def result(self):
+        # Returns the message (or None), its encoding, its correlation ID (or the caller's), whether the reader has the
+        # key, the message's content type, and the ID the reader acknowledges it by
+        if self.message is not None:
+            logger.debug(f'  _dequeue ({self.local_transaction}) returns: {_loggable(self.message)}, correlation_id: {self.message_id}, encoding: {self.encoding}, ack_id: {self.ack_id}')
+            return self.message, self.encoding, self.message_id, self.valid_reader, self.content_type, self.ack_id
+        elif self.valid_reader:
+            logger.debug(f'  _dequeue ({self.local_transaction}) timed out: {self.operation}, channel: {self.channel}')
+        return None, self.encoding, self.correlation_id, self.valid_reader, self.content_type, self.ack_id
+
+def _enqueue_params(key, operation, msg, correlation_id, discard_key, calls, encoding, content_type='', ack='', side=''):
+    # A reply acknowledges the requests it answers (see _ack_id) once it's stored. A message sent on behalf of a side
+    # touches the channel's liveness, too (see _touch_channel).
+    statistics_key = time.strftime(f'{STATISTIC}:%Y-%m-%d')
+    channel = key.rpartition(':')[0]
+    keys = [key, statistics_key, STATISTIC_DAYS]
+    if side:
+        keys += [f'{channel}:{LIVENESS}', CHANNELS]
+    if discard_key:
+        keys.append(discard_key)
+    elif ack:
+        keys.append(f'{channel}:{REQUEST}')
+    if isinstance(msg, StreamedMessage): # Its bytes are counted as they're streamed
+        stored, storage, size = msg.key, STREAM, 0
+    elif isinstance(msg, SpooledMessage):
+        stored, storage, size = msg.name, SPOOL, msg.size
+    else:
+        stored, storage, size = msg, b'', len(msg)
+    return {'keys': keys, 'args': [stored, correlation_id, time.asctime(), EXPIRE_SECS, operation,
+                                   CHANNEL_QUEUE_DEPTH, calls, encoding, storage, size, repr(time.monotonic()),
+                                   _statistic_day(statistics_key), content_type, '' if discard_key else ack, side, time.time(),
+                                   channel]}
+
+def _enqueue_result(key, result):
+    stored, discarded = result
+    if stored == 0:
+        raise Exception(f'Channel {key} contains unprocessed message')
+    elif stored < 0:
+        raise ChannelFullException(f'Channel {key} already has {CHANNEL_QUEUE_DEPTH} messages waiting')
+    return discarded
+
+def _dequeue_params(key, correlation_id, claim, reset_first, release, lease_secs=0, ack=None, side='', held=''):
+    # A claim lasts for the reader's wait, and then some. A reader that acknowledges messages passes ack (see _ack_id)
+    # and the messages it holds (see _held_ids).
+    # A claim on behalf of a side touches the channel's liveness, too (see _touch_channel).
+    now = time.time()
+    channel = key.rpartition(':')[0]
+    keys = [key, f'{channel}:{LIVENESS}', CHANNELS] if side else [key]
+    return {'keys': keys, 'args': [int(claim), int(reset_first), int(release), time.asctime(), EXPIRE_SECS, correlation_id,
+                                   now, now + lease_secs + DEQUEUE_LEASE_GRACE_SECS, int(ack is not None), ack or '',
+                                   side, channel, held]}
+
+def _dequeue_result(key, result):
+    liveness = _liveness_result(result[-1]) if result[-1] else None
+    if result[0] == DEQUEUE_SCRIPT_BUSY:
+        return None, '', '', False, JSON_TYPE, '', liveness
+    elif result[0] == DEQUEUE_SCRIPT_MESSAGE:
+        if result[5]: # Monotonic time is shared by the processes on a machine
+            _observe('jupyter_bridge_queue_wait_seconds', f'operation="{key.rpartition(":")[2]}"', time.monotonic() - float(result[5]))
+        if result[4] == STREAM:
+            message = StreamedMessage(result[1].decode('utf-8'), key.rpartition(':')[0])
+        elif result[4] == SPOOL:
+            message = SpooledMessage(result[1].decode('utf-8'))
+        else:
+            message = result[1]
+        return message, result[3].decode('utf-8'), result[2].decode('utf-8'), True, result[6].decode('utf-8') or JSON_TYPE, result[7].decode('utf-8'), liveness
+    else:
+        return None, '', '', True, JSON_TYPE, '', liveness
+
+# A process is draining once its node has been drained (see /admin/drain) since the process started. It checks at
+# most every DRAIN_CHECK_SECS, or sooner if a drain is announced while it's waiting. (A uWSGI worker's start is its
+# master's, which imported this module.)
+process_started = time.time()
+draining = False
+drain_checked = 0.0
+
+def _draining():
+    if _drain_check_due():
+        _drain_result(redis_db.get(f'{DRAIN}:{NODE}'))
+    return draining
+
+def _drain_check_due():
+    # Returns whether to read this process's node's drain time now (see _drain_result), and if so, restarts the wait
+    # for the next check
+    global drain_checked
+    if not draining and time.monotonic() - drain_checked >= DRAIN_CHECK_SECS:
+        drain_checked = time.monotonic()
+        return True
+    return False
+
+def _drain_result(drained):
+    # Given when this process's node was drained (or None), returns whether this process is draining
+    global draining
+    if drained is not None and float(drained) >= process_started:
+        draining = True
+    return draining
+
+def _drain_announced(wakeup):
+    # Given a wakeup, makes the next _draining check read the node's drain time if the wakeup announced a drain
+    global drain_checked
+    if wakeup and wakeup['type'] == 'message' and wakeup['channel'] == DRAIN.encode('utf-8'):
+        drain_checked = 0.0
+
+class _WakeupFanout:
+    """Fans out the wakeups that _enqueue publishes to the waiters in this process.
+
+    A listener per store holds a single subscription, so waiters don't each take a redis connection for a subscription
+    of their own. On it, the listener subscribes to the drain announcements and to exactly the request and reply keys
+    that this process's waiters are waiting on, so a process isn't sent the wakeups for other processes' keys. A key
+    is subscribed to when its first waiter is added, and unsubscribed from when its last waiter is removed. A waiter
+    that subscribes to a key doesn't read the key until the subscription is confirmed (redis confirms each SUBSCRIBE
+    in order), so a message posted right after the read still wakes it up. A drain announcement wakes every waiter, so
+    that they can see whether this process is draining. If a listener fails, every waiter is woken to re-read its key,
+    and the listeners that replace it subscribe to every key still waited on. Subclasses run the listeners, send the
+    commands on their subscriptions, and make the events their waiters wait on (threads here, and coroutines in
+    asgi.py). Except as noted, the methods here are called with the lock held.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = {} # key -> set of events
+        self.key_stores = {} # key -> store that the key is kept in
+        self.subscriptions = {} # id of a store -> its listener's subscription
+        self.confirmations = {} # id of a subscription -> {key -> events set as its SUBSCRIBEs are confirmed, oldest first}
+
+    def _event(self):
+        raise NotImplementedError()
+
+    def _added(self, key, store, event):
+        # Adds a waiter, and returns the subscription to subscribe to its key on (or None, unless it's the key's first
+        # waiter) and the confirmation to wait for before reading the key (or None, if its subscription is confirmed
+        # or its store's listener must be restarted first)
+        self.waiters.setdefault(key, set()).add(event)
+        self.key_stores[key] = store
+        subscription = self.subscriptions.get(id(store))
+        if subscription is None:
+            return None, None
+        confirmations = self.confirmations[id(subscription)]
+        if len(self.waiters[key]) == 1:
+            confirmations.setdefault(key, []).append(self._event())
+            return subscription, confirmations[key][-1]
+        return None, confirmations[key][-1] if confirmations.get(key) else None
+
+    def _removed(self, key, event):
+        # Removes a waiter, and returns the subscription to unsubscribe from its key on if it was the key's last waiter
+        waiters = self.waiters.get(key)
+        if waiters:
+            waiters.discard(event)
+            if not waiters:
+                del self.waiters[key]
+                return self.subscriptions.get(id(self.key_stores.pop(key)))
+        return None
+
+    def _registered(self, store, subscription):
+        # Registers a store's listener's subscription, and returns the channels it subscribes to first ... the keys
+        # already waited on in its store, and then the drain announcements (confirmed after the keys are)
+        keys = [key for key, key_store in self.key_stores.items() if key_store is store]
+        self.subscriptions[id(store)] = subscription
+        self.confirmations[id(subscription)] = {key: [self._event()] for key in keys}
+        return keys + [DRAIN]
+
+    def _unregistered(self):
+        # Forgets the listeners' subscriptions (when the listeners are replaced), and lets go of the waiters that are
+        # waiting for confirmations that won't come ... they re-read their keys once the listeners are replaced
+        for confirmations in self.confirmations.values():
+            for events in confirmations.values():
+                for event in events:
+                    event.set()
+        self.subscriptions = {}
+        self.confirmations = {}
+
+    def _wake(self, key=None):
+        # Wakes the waiters on a key, or all waiters (called without the lock)
+        with self.lock:
+            events = list(self.waiters.get(key, ())) if key else [event for waiters in self.waiters.values() for event in waiters]
+        for event in events:
+            event.set()
+
+    def _received(self, message, subscription):
+        # Wakes the waiters that a listener's message is for, and returns whether it confirmed the listener's
+        # subscription to the drain announcements (called without the lock)
+        channel = (message.get('channel') or b'').decode('utf-8')
+        if message['type'] == 'message' and channel == DRAIN:
+            _drain_announced(message)
+            self._wake()
+        elif message['type'] == 'message':
+            self._wake(channel)
+        elif message['type'] == 'subscribe' and channel != DRAIN:
+            with self.lock:
+                confirmations = self.confirmations.get(id(subscription), {})
+                if confirmations.get(channel):
+                    confirmations[channel].pop(0).set()
+                    if not confirmations[channel]:
+                        del confirmations[channel]
+        return message['type'] == 'subscribe' and channel == DRAIN
+
+class _Wakeups(_WakeupFanout):
+    """Runs a listener thread per store (and per process ... uWSGI forks its workers after this module is loaded) for
+    the threads waiting in _dequeue. Waiters send their keys' SUBSCRIBEs and UNSUBSCRIBEs on the listeners'
+    subscriptions themselves. If a listener fails, the next waiter starts new listeners.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.pid = None
+        self.generation = 0 # Listeners of an older generation stop
+        self.running = False
+        self.subscribing = 0 # Listeners that haven't subscribed yet
+        self.started = threading.Event()
+
+    def start(self):
+        # Starts this process's listeners if they aren't running, and returns whether it did
+        restarted = False
+        with self.lock:
+            if self.pid != os.getpid() or not self.running:
+                restarted = True
+                self.pid = os.getpid()
+                self.generation += 1
+                self.running = True
+                self.subscribing = len(channel_stores.stores())
+                self.started = threading.Event()
+                self._unregistered()
+                for store in channel_stores.stores():
+                    threading.Thread(target=self._listen, args=(store, self.generation), name='wakeup-listener', daemon=True).start()
+            started = self.started
+        if not started.wait(WAKEUP_START_SECS) or not self.running:
+            raise Exception('Could not subscribe to wakeups')
+        return restarted
+
+    def add(self, key, store):
+        # Adds a waiter on a key kept in the given store, and returns the event it waits on once the key's
+        # subscription is confirmed
+        event = self._event()
+        try:
+            with self.lock:
+                subscription, confirmation = self._added(key, store, event)
+                if subscription is not None:
+                    subscription.subscribe(key)
+            if confirmation is not None and not confirmation.wait(WAKEUP_START_SECS):
+                raise Exception(f'Could not subscribe to wakeups on {key}')
+        except Exception:
+            self.remove(key, event)
+            raise
+        return event
+
+    def remove(self, key, event):
+        with self.lock:
+            subscription = self._removed(key, event)
+            if subscription is not None:
+                try:
+                    subscription.unsubscribe(key)
+                except Exception as e: # The listener fails, too, and its replacement won't subscribe to the key
+                    logger.debug(f'wakeup unsubscribe exception {e!r}')
+
+    def wait(self, event, timeout):
+        event.wait(timeout)
+        event.clear()
+
+    def _event(self):
+        return threading.Event()
+
+    def _listen(self, store, generation):
+        wakeup = store.pubsub()
+        try:
+            with self.lock:
+                if self.generation == generation:
+                    wakeup.subscribe(*self._registered(store, wakeup))
+            while self.generation == generation:
+                message = wakeup.get_message(timeout=WAKEUP_LISTEN_SECS)
+                if message is not None and self._received(message, wakeup):
+                    with self.lock:
+                        if self.generation == generation:
+                            self.subscribing -= 1
+                            if self.subscribing <= 0:
+                                self.started.set()
+        except Exception as e:
+            logger.debug(f'wakeup listener exception {e!r}')
+            with self.lock:
+                if self.generation == generation: # The next waiter starts new listeners
+                    self.running = False
+                    self.generation += 1
+                    self._unregistered()
+                    self.started.set()
+            self._wake() # Current waiters re-read their keys
+        finally:
+            wakeup.close()
+
+wakeups = _Wakeups()
+
+metrics_buffer = collections.Counter()
+metrics_lock = threading.Lock()
+metrics_flusher_pid = None
+waiter_counts = collections.Counter() # Gauge field -> dequeue calls waiting in this process
+
+def _observe(name, labels, value):
+    # Adds an observation to a histogram
+    _start_metrics_flusher()
+    with metrics_lock:
+        for le in METRICS[name][2]:
+            if value <= le:
+                metrics_buffer[f'{name}_bucket{{{labels},le="{le}"}}'] += 1
+        metrics_buffer[f'{name}_bucket{{{labels},le="+Inf"}}'] += 1
+        metrics_buffer[f'{name}_sum{{{labels}}}'] += float(value)
+        metrics_buffer[f'{name}_count{{{labels}}}'] += 1
+
+def _observe_route(route, status, started):
+    if route: # Unknown routes would make a label for every URL probed
+        _start_metrics_flusher()
+        with metrics_lock:
+            metrics_buffer[f'jupyter_bridge_responses_total{{route="{route}",status="{status}"}}'] += 1
+        _observe('jupyter_bridge_route_seconds', f'route="{route}"', time.monotonic() - started)
+
+def _observe_enqueue(operation, params, started):
+    _observe('jupyter_bridge_redis_seconds', 'script="enqueue"', time.monotonic() - started)
+    if params['args'][8] != STREAM: # A streamed message's size isn't known when it's queued
+        _observe('jupyter_bridge_message_bytes', f'operation="{operation}"', params['args'][9])
+
+def _count_waiter(operation, increment):
+    _start_metrics_flusher()
+    with metrics_lock:
+        waiter_counts[_waiters_field(operation)] += increment
+
+def _waiters_field(operation):
+    return f'jupyter_bridge_waiters{{operation="{operation}"}}'
+
+def _waiter_samples():
+    # Adds up the waiter counts of the processes that are still flushing them, and forgets the others. Both gauges are
+    # reported even if no process has waited.
+    live_since = time.time() - WAITERS_EXPIRE_SECS
+    redis_db.zremrangebyscore(WAITERS_KEY, '-inf', live_since)
+    keys = redis_db.zrangebyscore(WAITERS_KEY, live_since, '+inf')
+    pipeline = redis_db.pipeline(transaction=False)
+    for key in keys:
+        pipeline.hgetall(key)
+    totals = collections.Counter({_waiters_field(operation).encode('utf-8'): 0 for operation in (REQUEST, REPLY)})
+    for counts in pipeline.execute() if keys else []:
+        for field, count in counts.items():
+            totals[field] += int(count)
+    return {field: str(count).encode('utf-8') for field, count in totals.items()}
+
+def _start_metrics_flusher():
+    # uWSGI forks its workers after this module is loaded, so each process starts its own flusher when it first
+    # observes something
+    global metrics_flusher_pid
+    if metrics_flusher_pid != os.getpid():
+        with metrics_lock:
+            if metrics_flusher_pid != os.getpid():
+                metrics_buffer.clear() # Observations made before a fork belong to the parent
+                waiter_counts.clear()
+                threading.Thread(target=_flush_metrics_forever, name='metrics-flusher', daemon=True).start()
+                metrics_flusher_pid = os.getpid()
+
+def _flush_metrics_forever():
+    while True:
+        time.sleep(METRICS_FLUSH_SECS)
+        try:
+            _flush_metrics()
+        except Exception as e:
+            logger.debug(f'_flush_metrics exception {e!r}')
+
+def _flush_metrics():
+    # Adds this process's observations to the totals in redis, and replaces its waiter counts (if it has had waiters)
+    with metrics_lock:
+        increments = dict(metrics_buffer)
+        metrics_buffer.clear()
+        waiters = dict(waiter_counts)
+    if increments or waiters:
+        pipeline = redis_db.pipeline(transaction=False)
+        for field, increment in increments.items():
+            if isinstance(increment, float):
+                pipeline.hincrbyfloat(METRICS_KEY, field, increment)
+            else:
+                pipeline.hincrby(METRICS_KEY, field, increment)
+        if waiters:
+            waiters_key = f'{WAITERS_KEY}:{NODE}:{os.getpid()}'
+            pipeline.hset(waiters_key, mapping=waiters)
+            pipeline.expire(waiters_key, WAITERS_EXPIRE_SECS)
+            pipeline.zadd(WAITERS_KEY, {waiters_key: time.time()})
+        pipeline.execute()
+
+def _metrics_text(samples):
+    # Metrics in the Prometheus text format. Every bucket of a histogram is listed, even if nothing has landed in it.
+    samples = {field.decode('utf-8'): value.decode('utf-8') for field, value in samples.items()}
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        if buckets:
+            count_prefix = f'{name}_count{{'
+            for labels in sorted({field[len(count_prefix):-1] for field in samples if field.startswith(count_prefix)}):
+                for le in buckets + ['+Inf']:
+                    field = f'{name}_bucket{{{labels},le="{le}"}}'
+                    lines.append(f'{field} {samples.get(field, 0)}')
+                for suffix in ['_sum', '_count']:
+                    field = f'{name}{suffix}{{{labels}}}'
+                    lines.append(f'{field} {samples.get(field, 0)}')
+        else:
+            lines.extend(f'{field} {samples[field]}' for field in sorted(samples) if field.partition('{')[0] == name)
+    return '\n'.join(lines) + '\n'
+
+def _pad_message(pad):
+    # Caller's choice of padding (if any), or the server default
+    if pad is None:
+        return PAD_MESSAGE
+    elif pad in ('0', '1'):
+        return pad == '1'
+    else:
+        raise Exception(f'Pad must be 0 or 1: {pad}')
+
+def _message_chunks(message, pad):
+    # The padding is sent as a separate chunk so that the message isn't copied to make room for it
+    return [message, MESSAGE_PADDING] if pad else [message]
 
 def _exception_message(e):
     try:
@@ -353,33 +2061,50 @@ def _exception_message(e):
     except:
         return str(e)
 
-def _set_key_value(key, value):
-    if not redis_db.hmset(key, value):
-        raise Exception(f'redis failed setting {key} to {value}')
+def _channel_stripe(channel):
+    return zlib.crc32(channel.encode('utf-8')) % CHANNEL_MUTEX_COUNT
 
-def _del_message(key, permissive=False):
-    if redis_db.hdel(key, MESSAGE) != 1 and not permissive:
-        raise Exception(f'redis failed deleting {key} subkey {MESSAGE}')
+def _channel_mutex(channel):
+    return channel_mutexes[_channel_stripe(channel)]
 
-def _update_stats(operation, msg):
-    stat_key = time.strftime(f'{STATISTIC}:%Y-%m-%d')
-    redis_db.hincrby(stat_key, f'{COUNT}:{operation}', 1)
-    redis_db.hincrby(stat_key, operation, len(msg))
+def _channel_store(channel):
+    return channel_stores.store(channel)
 
-def _expire(key):
-    if redis_db.expire(key, EXPIRE_SECS) != 1:
-        raise Exception(f'redis failed expiring {key}')
+transaction_ids = itertools.count(1) # useful for matching messages during debug
 
-import os
-transaction_id = 0 # useful for matching messages during debug
+def _begin_route_log(route):
+    # Chooses how a route transaction is logged, per the JUPYTER_LOG_LEVEL_<ROUTE> and JUPYTER_LOG_SAMPLE_<ROUTE>
+    # settings (e.g., JUPYTER_LOG_SAMPLE_PING=0.01 logs one ping in a hundred)
+    if route not in route_log_settings:
+        setting = (route or '').upper()
+        route_log_settings[route] = (logging.getLevelName(os.environ.get(f'JUPYTER_LOG_LEVEL_{setting}', LOG_LEVEL).upper()),
+                                     float(os.environ.get(f'JUPYTER_LOG_SAMPLE_{setting}', 1)))
+    level, sample = route_log_settings[route]
+    deferred = [] if route in DEQUEUE_ROUTES and LOG_SAMPLE_TIMEOUT < 1 else None
+    route_log.set(_RouteLog(level, random.random() < sample, deferred))
+
+def _end_route_log(status):
+    # Writes a dequeue transaction's held records unless it timed out and isn't sampled
+    transaction_log = route_log.get()
+    route_log.set(None)
+    if transaction_log and transaction_log.deferred:
+        if status != HTTP_TIMEOUT or random.random() < LOG_SAMPLE_TIMEOUT:
+            for record in transaction_log.deferred:
+                for handler in logger.handlers:
+                    handler.handle(record)
+
+def _loggable(payload):
+    # A payload as it should be logged ... long payloads are truncated so that logging them costs little
+    if isinstance(payload, (bytes, str)) and len(payload) > LOG_PAYLOAD_BYTES:
+        return f'{payload[:LOG_PAYLOAD_BYTES]}... ({len(payload)} bytes)'
+    return payload
 
 def _get_transaction_id():
-    # A server may instantiate this service for each thread it creates. So,
-    # creating an increasing transaction ID isn't enough, as each thread gets
-    # its own copy. To create a unique ID, include the process ID, too.
-    global transaction_id
-    transaction_id += 1
-    return f'{os.getpid()}:{transaction_id}'
+    # A server may instantiate this service for each process it creates. So,
+    # creating an increasing transaction ID isn't enough, as each process gets
+    # its own copy. To create a unique ID, include the process ID, too. Within
+    # a process, next() on a counter is atomic, so threads get distinct IDs.
+    return f'{os.getpid()}:{next(transaction_ids)}'
 
 
 
@@ -0,0 +1,576 @@
+"""Message stores for Jupyter-bridge.
+
+Jupyter-bridge keeps its channel queues, statistics and metrics in a message store, which it calls through the subset
+of the redis-py client interface that it needs: hash, list, sorted set and key commands, pipelines, pub/sub wakeups
+and the Lua scripts that perform channel state transitions.
+
+open_store() returns a redis client connected by URL (e.g., redis://localhost:6379/0, or unix:///run/redis.sock for a
+unix socket), optionally through a bounded connection pool. It returns a LocalStore for the URL 'local'.
+
+A ShardRing spreads keys (e.g., channel IDs) across several stores by consistent hashing, so every process that is
+given the same stores assigns each key to the same one, and adding a store moves only the keys it takes over.
+
+A LocalStore keeps everything in dicts in this process, and each waiting reader has a condition variable of its own,
+which is notified as soon as a message is published or pushed to a key it waits on (so a message wakes only its own
+readers). It can only serve a single process (e.g., uWSGI with processes = 1 and several
+threads, or a development server), but that process doesn't need a redis server. Because a LocalStore can't run Lua,
+each script is given a Python implementation that performs the same transition while holding the store's lock.
+
+"""
+import bisect
+import collections
+import fnmatch
+import hashlib
+import re
+import threading
+import time
+
+LOCAL_STORE = 'local'
+POOL_TIMEOUT_SECS = 20 # How long a caller waits for a connection when all of a bounded pool's connections are in use
+PURGE_SECS = 1 # How often a LocalStore drops expired keys that haven't been read since they expired
+SHARD_POINTS = 160 # Points each shard has on a ShardRing ... more points spread keys more evenly
+
+
+def open_store(url, pool_size, local_scripts):
+    # Returns a redis client for the URL, or a LocalStore (with Python implementations of the Lua scripts, keyed by
+    # script) if the URL is 'local'
+    if url == LOCAL_STORE:
+        return LocalStore(local_scripts)
+    import redis
+    if pool_size:
+        return redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(url, max_connections=pool_size, timeout=POOL_TIMEOUT_SECS))
+    return redis.Redis.from_url(url)
+
+
+class ShardRing:
+    """Assigns keys to shards by consistent hashing.
+
+    Each shard is placed at SHARD_POINTS points on a ring of hashes, by its name, and a key belongs to the shard at
+    the first point at or after the key's hash. So the assignment depends only on the shards' names (e.g., their
+    URLs), not on their order or on the process, and a shard that is added takes over keys only from the shards
+    whose points it lands between.
+    """
+
+    def __init__(self, shards):
+        # shards is a dict of name -> store
+        self.shards = dict(shards)
+        points = sorted((_ring_hash(f'{name}#{point}'), name) for name in self.shards for point in range(SHARD_POINTS))
+        self.hashes = [point_hash for point_hash, _ in points]
+        self.names = [name for _, name in points]
+
+    def name(self, key):
+        if len(self.shards) == 1:
+            return next(iter(self.shards))
+        return self.names[bisect.bisect_left(self.hashes, _ring_hash(key)) % len(self.names)]
+
+    def store(self, key):
+        return self.shards[self.name(key)]
+
+    def stores(self):
+        return list(self.shards.values())
+
+def _ring_hash(key):
+    return int.from_bytes(hashlib.md5(_encode(key)).digest()[:8], 'big')
+
+
+def _encode(value):
+    # Values are returned as bytes, as redis returns them
+    if isinstance(value, bytes):
+        return value
+    elif isinstance(value, str):
+        return value.encode('utf-8')
+    elif isinstance(value, float):
+        return repr(value).encode('utf-8')
+    else:
+        return str(value).encode('utf-8')
+
+def _score(bound):
+    return float(_encode(bound))
+
+
+class LocalStore:
+    """An in-process message store that answers the redis commands Jupyter-bridge uses"""
+
+    def __init__(self, scripts):
+        self.scripts = scripts
+        self.data = {}
+        self.expires = {}
+        self.subscribers = collections.defaultdict(set) # channel -> _LocalPubSub
+        self.pattern_subscribers = collections.defaultdict(set) # pattern -> _LocalPubSub
+        self.readers = collections.defaultdict(set) # list key -> threading.Condition of each blpop waiting on it
+        self.lock = threading.RLock()
+        self.purged = time.monotonic()
+
+    # Keys
+
+    def _get(self, key, kind=None):
+        key = _encode(key)
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self._remove(key)
+        value = self.data.get(key)
+        if kind is not None and value is not None and not isinstance(value, kind):
+            raise Exception('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def _create(self, key, kind):
+        value = self._get(key, kind)
+        if value is None:
+            value = self.data[_encode(key)] = kind()
+        return value
+
+    def _remove(self, key):
+        self.expires.pop(key, None)
+        return self.data.pop(key, None) is not None
+
+    def _removed_if_empty(self, key):
+        if not self.data.get(key):
+            self._remove(key)
+
+    def delete(self, *keys):
+        with self.lock:
+            return sum(self._get(key) is not None and self._remove(_encode(key)) for key in keys)
+
+    unlink = delete
+
+    def _purge(self):
+        now = time.monotonic()
+        for key in [key for key, deadline in self.expires.items() if deadline <= now]:
+            self._remove(key)
+        self.purged = now
+
+    def expire(self, key, seconds):
+        with self.lock:
+            if time.monotonic() - self.purged >= PURGE_SECS:
+                self._purge()
+            if self._get(key) is None:
+                return False
+            self.expires[_encode(key)] = time.monotonic() + float(seconds)
+            return True
+
+    def ttl(self, key):
+        # Seconds until the key expires, -1 if it doesn't, or -2 if there's no such key
+        with self.lock:
+            if self._get(key) is None:
+                return -2
+            deadline = self.expires.get(_encode(key))
+            return -1 if deadline is None else max(0, round(deadline - time.monotonic()))
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key, bytes)
+
+    def set(self, key, value, nx=False, ex=None):
+        with self.lock:
+            if nx and self._get(key) is not None:
+                return None
+            key = _encode(key)
+            self.data[key] = _encode(value)
+            self.expires.pop(key, None)
+            if ex:
+                self.expires[key] = time.monotonic() + float(ex)
+            return True
+
+    def scan_iter(self, match=None, count=None):
+        with self.lock:
+            self._purge()
+            keys = list(self.data)
+        return (key for key in keys if match is None or fnmatch.fnmatchcase(key.decode('utf-8', 'replace'), _encode(match).decode('utf-8')))
+
+    def keys(self, pattern='*'):
+        return list(self.scan_iter(match=pattern))
+
+    # Hashes
+
+    def hget(self, key, field):
+        with self.lock:
+            return (self._get(key, dict) or {}).get(_encode(field))
+
+    def hmget(self, key, fields, *more_fields):
+        with self.lock:
+            values = self._get(key, dict) or {}
+            fields = [fields] if isinstance(fields, (str, bytes)) else list(fields)
+            return [values.get(_encode(field)) for field in fields + list(more_fields)]
+
+    def hgetall(self, key):
+        with self.lock:
+            return dict(self._get(key, dict) or {})
+
+    def hexists(self, key, field):
+        with self.lock:
+            return _encode(field) in (self._get(key, dict) or {})
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        with self.lock:
+            values = self._create(key, dict)
+            items = dict(mapping or {})
+            if field is not None:
+                items[field] = value
+            added = 0
+            for field, value in items.items():
+                field = _encode(field)
+                added += field not in values
+                values[field] = _encode(value)
+            return added
+
+    def hsetnx(self, key, field, value):
+        with self.lock:
+            values = self._create(key, dict)
+            if _encode(field) in values:
+                return False
+            values[_encode(field)] = _encode(value)
+            return True
+
+    def hdel(self, key, *fields):
+        with self.lock:
+            values = self._get(key, dict)
+            if values is None:
+                return 0
+            deleted = sum(values.pop(_encode(field), None) is not None for field in fields)
+            self._removed_if_empty(_encode(key))
+            return deleted
+
+    def hincrby(self, key, field, amount=1):
+        with self.lock:
+            values = self._create(key, dict)
+            total = int(values.get(_encode(field), 0)) + int(amount)
+            values[_encode(field)] = _encode(total)
+            return total
+
+    def hincrbyfloat(self, key, field, amount=1.0):
+        with self.lock:
+            values = self._create(key, dict)
+            total = float(values.get(_encode(field), 0)) + float(amount)
+            values[_encode(field)] = _encode(total)
+            return total
+
+    # Lists
+
+    def rpush(self, key, *values):
+        with self.lock:
+            items = self._create(key, collections.deque)
+            items.extend(_encode(value) for value in values)
+            for reader in self.readers.get(_encode(key), ()):
+                reader.notify()
+            return len(items)
+
+    def blpop(self, keys, timeout=0):
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        deadline = time.monotonic() + float(timeout) if timeout else None
+        with self.lock:
+            pushed = threading.Condition(self.lock)
+            for key in keys:
+                self.readers[_encode(key)].add(pushed)
+            try:
+                while True:
+                    for key in keys:
+                        items = self._get(key, collections.deque)
+                        if items:
+                            value = items.popleft()
+                            self._removed_if_empty(_encode(key))
+                            return _encode(key), value
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return None
+                    pushed.wait(remaining)
+            finally:
+                for key in keys:
+                    self.readers[_encode(key)].discard(pushed)
+                    if not self.readers[_encode(key)]:
+                        del self.readers[_encode(key)]
+
+    # Sorted sets
+
+    def zadd(self, key, mapping, nx=False):
+        with self.lock:
+            scores = self._create(key, _SortedSet)
+            added = 0
+            for member, score in mapping.items():
+                member = _encode(member)
+                if member not in scores:
+                    added += 1
+                elif nx:
+                    continue
+                scores[member] = float(score)
+            return added
+
+    def zrangebyscore(self, key, min, max):
+        with self.lock:
+            scores = self._get(key, _SortedSet) or {}
+            return [member for member, score in sorted(scores.items(), key=lambda item: (item[1], item[0]))
+                    if _score(min) <= score <= _score(max)]
+
+    def zrevrangebyscore(self, key, max, min):
+        return list(reversed(self.zrangebyscore(key, min, max)))
+
+    def zremrangebyscore(self, key, min, max):
+        with self.lock:
+            scores = self._get(key, _SortedSet) or {}
+            removed = [member for member, score in scores.items() if _score(min) <= score <= _score(max)]
+            for member in removed:
+                del scores[member]
+            self._removed_if_empty(_encode(key))
+            return len(removed)
+
+    # Pub/sub
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = self.subscribers.get(_encode(channel), ())
+            for subscriber in subscribers:
+                subscriber.messages.append({'type': 'message', 'channel': _encode(channel), 'data': _encode(message)})
+                subscriber.arrived.notify()
+            received = len(subscribers)
+            for pattern, pattern_subscribers in self.pattern_subscribers.items():
+                if fnmatch.fnmatchcase(_encode(channel).decode('utf-8', 'replace'), pattern.decode('utf-8')):
+                    for subscriber in pattern_subscribers:
+                        subscriber.messages.append({'type': 'pmessage', 'pattern': pattern, 'channel': _encode(channel),
+                                                    'data': _encode(message)})
+                        subscriber.arrived.notify()
+                    received += len(pattern_subscribers)
+            return received
+
+    def pubsub(self):
+        return _LocalPubSub(self)
+
+    # Pipelines and scripts
+
+    def pipeline(self, transaction=True):
+        return _LocalPipeline(self)
+
+    def register_script(self, script):
+        implementation = self.scripts[script]
+        def call(keys=(), args=(), client=None): # A LocalStore can't be sharded, so the client is always this store
+            with self.lock:
+                return implementation(self, [_encode(key) for key in keys], [_encode(arg) for arg in args])
+        return call
+
+
+class _SortedSet(dict):
+    """Members and their scores"""
+    pass
+
+
+class _LocalPubSub:
+    """A subscription to LocalStore channels, whose messages are delivered when get_message is called"""
+
+    def __init__(self, store):
+        self.store = store
+        self.channels = set()
+        self.patterns = set()
+        self.messages = collections.deque()
+        self.arrived = threading.Condition(store.lock)
+
+    def subscribe(self, *channels):
+        with self.store.lock:
+            for channel in channels:
+                self.channels.add(_encode(channel))
+                self.store.subscribers[_encode(channel)].add(self)
+                self.messages.append({'type': 'subscribe', 'channel': _encode(channel), 'data': len(self.channels) + len(self.patterns)})
+            self.arrived.notify() # A listener may already be waiting for messages
+
+    def unsubscribe(self, *channels):
+        with self.store.lock:
+            for channel in channels:
+                self.channels.discard(_encode(channel))
+                self.store.subscribers[_encode(channel)].discard(self)
+                if not self.store.subscribers[_encode(channel)]:
+                    del self.store.subscribers[_encode(channel)]
+                self.messages.append({'type': 'unsubscribe', 'channel': _encode(channel), 'data': len(self.channels) + len(self.patterns)})
+            self.arrived.notify()
+
+    def psubscribe(self, *patterns):
+        with self.store.lock:
+            for pattern in patterns:
+                self.patterns.add(_encode(pattern))
+                self.store.pattern_subscribers[_encode(pattern)].add(self)
+                self.messages.append({'type': 'psubscribe', 'channel': _encode(pattern), 'data': len(self.channels) + len(self.patterns)})
+
+    def get_message(self, timeout=0.0):
+        with self.store.lock:
+            if not self.messages and timeout and timeout > 0:
+                self.arrived.wait_for(lambda: self.messages, timeout)
+            return self.messages.popleft() if self.messages else None
+
+    def close(self):
+        with self.store.lock:
+            for channel in self.channels:
+                self.store.subscribers[channel].discard(self)
+                if not self.store.subscribers[channel]:
+                    del self.store.subscribers[channel]
+            for pattern in self.patterns:
+                self.store.pattern_subscribers[pattern].discard(self)
+                if not self.store.pattern_subscribers[pattern]:
+                    del self.store.pattern_subscribers[pattern]
+            self.channels.clear()
+            self.patterns.clear()
+
+
+class _LocalPipeline:
+    """Queues commands, and executes them all at once"""
+
+    def __init__(self, store):
+        self.store = store
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.store, name)
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        with self.store.lock:
+            commands, self.commands = self.commands, []
+            return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+# Python implementations of jupyter_bridge's Lua scripts, for a LocalStore. Each takes the store, and the script's
+# KEYS and ARGV as bytes, and follows its script line for line.
+
+def _clear_pending(store, key):
+    for seq in (store.hget(key, 'unacked') or b'').split():
+        seq = seq.decode()
+        store.hdel(key, f'message:{seq}', f'id:{seq}', f'encoding:{seq}', f'type:{seq}', f'storage:{seq}', f'posted:{seq}', f'delivered:{seq}')
+    store.hdel(key, 'unacked')
+    head = int(store.hget(key, 'head') or 0)
+    tail = int(store.hget(key, 'tail') or 0)
+    first = None
+    if tail > head:
+        for seq in range(head + 1, tail + 1):
+            message = store.hget(key, f'message:{seq}')
+            if message is not None and store.hget(key, f'storage:{seq}') == b'stream':
+                store.delete(message)
+            if first is None:
+                first = message
+            store.hdel(key, f'message:{seq}', f'id:{seq}', f'encoding:{seq}', f'type:{seq}', f'storage:{seq}', f'posted:{seq}')
+        store.hset(key, mapping={'head': tail, 'pending': 0})
+    return first
+
+def _acknowledge(store, key, seqs):
+    acked = set()
+    for seq in re.findall(rb'\d+', seqs):
+        if store.hdel(key, b'delivered:' + seq):
+            seq = seq.decode()
+            store.hdel(key, f'message:{seq}', f'id:{seq}', f'encoding:{seq}', f'type:{seq}', f'storage:{seq}', f'posted:{seq}')
+            acked.add(seq.encode())
+    if acked:
+        store.hset(key, 'unacked', b' '.join(seq for seq in (store.hget(key, 'unacked') or b'').split() if seq not in acked))
+
+def enqueue_script(store, keys, args):
+    other_key = keys[3] if len(keys) > 3 else None
+    if args[14] != b'':
+        _touch_channel(store, keys[3], keys[4], args[14], args[15], args[3], args[16])
+        other_key = keys[5] if len(keys) > 5 else None
+    discarded = _clear_pending(store, other_key) if other_key and args[13] == b'' else None
+    pending = int(store.hget(keys[0], 'pending') or 0)
+    if args[1] == b'':
+        if pending > 0:
+            return [0, discarded or b'']
+    elif pending >= int(args[5]):
+        return [-1, discarded or b'']
+    seq = store.hincrby(keys[0], 'tail', 1)
+    store.hincrby(keys[0], 'pending', 1)
+    store.hset(keys[0], mapping={f'message:{seq}': args[0], f'id:{seq}': args[1], f'encoding:{seq}': args[7],
+                                 f'type:{seq}': args[12], f'storage:{seq}': args[8], f'posted:{seq}': args[10], 'pickup_time': '', 'posted_time': args[2]})
+    store.expire(keys[0], int(args[3]))
+    store.publish(keys[0], 'message')
+    store.hincrby(keys[1], b'count:' + args[4], int(args[6]))
+    store.hincrby(keys[1], args[4], int(args[9]))
+    store.zadd(keys[2], {keys[1]: float(args[11])})
+    if other_key and args[13] != b'':
+        _acknowledge(store, other_key, args[13])
+    return [1, discarded or b'']
+
+def dequeue_script(store, keys, args):
+    liveness = None
+    if args[0] == b'1' and args[10] != b'':
+        liveness = _touch_channel(store, keys[1], keys[2], args[10], args[6], args[4], args[11])
+    if args[0] == b'1':
+        if store.hget(keys[0], 'dequeue_busy') == b'busy' and float(store.hget(keys[0], 'busy_until') or 0) > float(args[6]):
+            return [b'busy', liveness]
+        store.hset(keys[0], mapping={'dequeue_busy': 'busy', 'busy_until': args[7], 'pickup_time': ''})
+        if args[1] == b'1':
+            _clear_pending(store, keys[0])
+        _acknowledge(store, keys[0], args[9])
+        store.expire(keys[0], int(args[4]))
+    head = int(store.hget(keys[0], 'head') or 0)
+    tail = int(store.hget(keys[0], 'tail') or 0)
+    seq = None
+    redelivered = False
+    if args[8] == b'1':
+        # Deliver again what the reader hasn't acknowledged and doesn't hold
+        held = set(re.findall(rb'\d+', args[12]))
+        for candidate in (store.hget(keys[0], 'unacked') or b'').split():
+            if candidate not in held and (args[5] == b'' or store.hget(keys[0], b'id:' + candidate) == args[5]):
+                seq = int(candidate)
+                redelivered = True
+                break
+    if redelivered:
+        pass
+    elif args[5] == b'':
+        # Skip over messages already taken by correlation ID (or delivered and not yet acknowledged)
+        next_head = head
+        while next_head < tail and seq is None:
+            next_head += 1
+            if store.hexists(keys[0], f'message:{next_head}') and not store.hexists(keys[0], f'delivered:{next_head}'):
+                seq = next_head
+        if next_head != head:
+            store.hset(keys[0], 'head', next_head)
+    else:
+        for candidate in range(head + 1, tail + 1):
+            if store.hget(keys[0], f'id:{candidate}') == args[5] and not store.hexists(keys[0], f'delivered:{candidate}'):
+                seq = candidate
+                break
+    if seq is not None:
+        message, id, encoding, storage, posted, content_type = store.hmget(keys[0], [f'message:{seq}', f'id:{seq}', f'encoding:{seq}',
+                                                                                     f'storage:{seq}', f'posted:{seq}', f'type:{seq}'])
+        ack = b''
+        if redelivered:
+            ack = str(seq).encode()
+        elif args[8] == b'1' and not storage:
+            ack = str(seq).encode()
+            store.hset(keys[0], f'delivered:{seq}', args[6])
+            unacked = store.hget(keys[0], 'unacked') or b''
+            store.hset(keys[0], 'unacked', unacked + b' ' + ack if unacked else ack)
+            store.hincrby(keys[0], 'pending', -1)
+        else:
+            store.hdel(keys[0], f'message:{seq}', f'id:{seq}', f'encoding:{seq}', f'type:{seq}', f'storage:{seq}', f'posted:{seq}')
+            store.hincrby(keys[0], 'pending', -1)
+        store.hset(keys[0], mapping={'pickup_time': args[3], 'dequeue_busy': 'idle'})
+        return [b'message', message, id, encoding or b'', storage or b'', posted or b'', content_type or b'', ack, liveness]
+    if args[2] == b'1':
+        store.hset(keys[0], 'dequeue_busy', 'idle')
+    return [b'empty', liveness]
+
+def rate_limit_script(store, keys, args):
+    now = float(args[0])
+    levels = []
+    wait = 0.0
+    for i, key in enumerate(keys):
+        rate, capacity = float(args[2 * i + 1]), float(args[2 * i + 2])
+        tokens, last = store.hmget(key, ['tokens', 'time'])
+        tokens = capacity if tokens is None else float(tokens)
+        last = now if last is None else float(last)
+        levels.append(min(capacity, tokens + max(0.0, now - last) * rate))
+        if levels[i] < 1:
+            wait = max(wait, (1 - levels[i]) / rate)
+    for i, key in enumerate(keys):
+        rate, capacity = float(args[2 * i + 1]), float(args[2 * i + 2])
+        if wait == 0:
+            levels[i] -= 1
+        store.hset(key, mapping={'tokens': levels[i], 'time': now})
+        store.expire(key, -(-capacity // rate) + 1)
+    return _encode(wait)
+
+def _touch_channel(store, liveness_key, index_key, side, now, expire_secs, channel):
+    store.hsetnx(liveness_key, 'since', now)
+    store.hset(liveness_key, side, now)
+    store.expire(liveness_key, int(expire_secs))
+    store.zadd(index_key, {channel: float(now)})
+    store.zremrangebyscore(index_key, '-inf', float(now) - float(expire_secs))
+    return store.hmget(liveness_key, ['notebook', 'browser', 'since', 'evicted'])
+
+def touch_channel_script(store, keys, args):
+    return _touch_channel(store, keys[0], keys[1], args[0], args[1], args[2], args[3])
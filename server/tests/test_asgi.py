@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+""" Test the ASGI entry point by calling its app directly.
+"""
+
+"""License:
+    Copyright 2020 The Cytoscape Consortium
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+    documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+    the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+    and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all copies or substantial portions
+    of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+    WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+    OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+    OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import unittest
+
+from server.test_utils import *
+import asyncio
+import gzip
+import json
+import os
+import sys
+import time
+import unittest.mock
+
+# The ASGI server needs a redis store, and jupyter_bridge clears a store's channel keys when it's imported ... so
+# both of them are given a fakeredis store (which runs the Lua scripts) instead of the redis server on this machine
+if 'jupyter_bridge' in sys.modules:
+    raise unittest.SkipTest('jupyter_bridge was already imported with another store ... run this module by itself')
+try:
+    import fakeredis
+    import fakeredis.aioredis
+    fakeredis.FakeRedis().register_script('return 1')()
+except Exception: # fakeredis or its Lua interpreter (lupa) isn't installed
+    raise unittest.SkipTest('fakeredis with Lua scripting is not installed')
+
+import redis
+import redis.asyncio
+
+server = fakeredis.FakeServer()
+test_env = {'JUPYTER_STORE_URL': 'redis://asgi-test', 'JUPYTER_STORE_SHARDS': '', 'JUPYTER_STORE_POOL_SIZE': '0',
+            'JUPYTER_DEQUEUE_TIMEOUT_SECS': '1'}
+with unittest.mock.patch.dict(os.environ, test_env), \
+        unittest.mock.patch.object(redis.Redis, 'from_url', lambda url: fakeredis.FakeRedis(server=server)), \
+        unittest.mock.patch.object(redis.asyncio.Redis, 'from_url', lambda url: fakeredis.aioredis.FakeRedis(server=server)):
+    import jupyter_bridge
+    import asgi
+
+TEST_JSON = b'{"command": "GET", "url": "http://somehost:9999/v1/version"}'
+
+loop = asyncio.new_event_loop() # The app's mutexes and listeners belong to the loop they're first used on
+
+
+def tearDownModule():
+    loop.run_until_complete(asgi.wakeups.stop())
+    loop.close()
+
+
+async def call(method, path, body=b'', headers=(), chunks=None):
+    # Calls the app as an ASGI server would, and returns the response's status, headers and body. The body is sent
+    # in chunks if there are any.
+    route, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': method, 'path': route, 'query_string': query.encode('latin-1'), 'root_path': '',
+             'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+             'http_version': '1.1', 'scheme': 'http', 'server': ('localhost', 80), 'client': ('127.0.0.1', 9999)}
+    events = [{'type': 'http.request', 'body': chunk, 'more_body': True} for chunk in chunks or []] + \
+             [{'type': 'http.request', 'body': body, 'more_body': False}]
+    response = {'body': b''}
+
+    async def receive():
+        return events.pop(0) if events else {'type': 'http.disconnect'}
+
+    async def send(event):
+        if event['type'] == 'http.response.start':
+            response['status'] = event['status']
+            response['headers'] = {name.decode('latin-1'): value.decode('latin-1') for name, value in event['headers']}
+        else:
+            response['body'] += event.get('body', b'')
+
+    await asgi.app(scope, receive, send)
+    return response['status'], response['headers'], response['body']
+
+
+class _Socket:
+    """A browser's end of a WebSocket to the app"""
+
+    def __init__(self, query):
+        self.received = asyncio.Queue()
+        self.sent = asyncio.Queue()
+        scope = {'type': 'websocket', 'path': '/websocket', 'query_string': query.encode('latin-1'), 'headers': [],
+                 'client': ('127.0.0.1', 9999)}
+        self.received.put_nowait({'type': 'websocket.connect'})
+        self.task = asyncio.ensure_future(asgi.app(scope, self.received.get, self.sent.put))
+
+    async def next_event(self, timeout=5):
+        return await asyncio.wait_for(self.sent.get(), timeout)
+
+    def send(self, text):
+        self.received.put_nowait({'type': 'websocket.receive', 'text': text})
+
+    async def close(self):
+        self.received.put_nowait({'type': 'websocket.disconnect'})
+        await asyncio.wait_for(self.task, 5)
+
+
+class AsgiTests(unittest.TestCase):
+
+    def setUp(self):
+        # Get rid of all of test keys
+        store = fakeredis.FakeRedis(server=server)
+        for key in store.keys('test:*'):
+            store.delete(key)
+
+    def run_app(self, coroutine):
+        return loop.run_until_complete(asyncio.wait_for(coroutine, 30))
+
+    @print_entry_exit
+    def test_flask_routes(self):
+        async def check():
+            # Verify that routes that don't wait are answered by the Flask app
+            status, headers, body = await call('GET', '/ping')
+            self.assertEqual(status, 200)
+            self.assertTrue(body.startswith(b'pong'))
+
+            status, headers, body = await call('POST', '/queue_request?channel=test:flask&id=f1', TEST_JSON,
+                                               [('Content-Type', 'application/json')])
+            self.assertEqual(status, 200)
+            status, headers, body = await call('GET', '/dequeue_request?channel=test:flask&pad=0')
+            self.assertEqual((status, body), (200, TEST_JSON))
+
+            # Verify that Flask answers CORS preflights for the native routes, too
+            status, headers, body = await call('OPTIONS', '/queue_reply_and_dequeue_request?channel=test:flask',
+                                               headers=[('Origin', 'http://browser'), ('Access-Control-Request-Method', 'POST')])
+            self.assertEqual(status, 200)
+            self.assertIn('access-control-allow-origin', headers)
+        self.run_app(check())
+
+    @print_entry_exit
+    def test_dequeue_routes(self):
+        async def check():
+            # Verify that a queued request is dequeued with its correlation ID, and that an empty queue times out
+            await call('POST', '/queue_request?channel=test:dq&id=d1', TEST_JSON, [('Content-Type', 'application/json')])
+            status, headers, body = await call('GET', '/dequeue_request?channel=test:dq&pad=0')
+            self.assertEqual((status, body), (200, TEST_JSON))
+            self.assertEqual(headers['x-correlation-id'], 'd1')
+
+            started = time.monotonic()
+            status, headers, body = await call('GET', '/dequeue_request?channel=test:dq&pad=0')
+            self.assertEqual(status, 408)
+            self.assertGreaterEqual(time.monotonic() - started, 0.9)
+
+            # Verify that a waiting reader is woken as soon as its message is queued
+            waiter = asyncio.ensure_future(call('GET', '/dequeue_reply?channel=test:dq&id=d2&pad=0'))
+            await asyncio.sleep(0.2)
+            started = time.monotonic()
+            await call('POST', '/queue_reply?channel=test:dq&id=d2', b'{"status": 200}', [('Content-Type', 'text/plain')])
+            status, headers, body = await waiter
+            self.assertEqual((status, body), (200, b'{"status": 200}'))
+            self.assertLess(time.monotonic() - started, 0.5)
+
+            # Verify that a route without a channel fails
+            status, headers, body = await call('GET', '/dequeue_reply')
+            self.assertEqual(status, 500)
+        self.run_app(check())
+
+    @print_entry_exit
+    def test_exchange_routes(self):
+        async def check():
+            # Verify that a notebook's request reaches the browser, and that the browser's reply reaches the notebook
+            notebook = asyncio.ensure_future(call('POST', '/queue_request_and_dequeue_reply?channel=test:x&id=x1&timeout=5&pad=0',
+                                                  TEST_JSON, [('Content-Type', 'application/json')]))
+            status, headers, body = await call('GET', '/dequeue_request?channel=test:x&pad=0')
+            self.assertEqual((status, body, headers['x-correlation-id']), (200, TEST_JSON, 'x1'))
+
+            status, headers, body = await call('POST', '/queue_reply_and_dequeue_request?channel=test:x&id=x1',
+                                               b'{"status": 200}', [('Content-Type', 'text/plain'), ('Content-Length', '15')])
+            self.assertEqual(status, 408) # No next request
+            status, headers, body = await notebook
+            self.assertEqual((status, body, headers['x-correlation-id']), (200, b'{"status": 200}', 'x1'))
+
+            # Verify that a batch request whose count doesn't match its envelope is refused
+            status, headers, body = await call('POST', '/queue_request_and_dequeue_reply?channel=test:x&id=x2&batch=2',
+                                               b'{"command": "batch", "calls": [' + TEST_JSON + b']}', [('Content-Type', 'application/json')])
+            self.assertEqual(status, 500)
+        self.run_app(check())
+
+    @print_entry_exit
+    def test_streamed_reply(self):
+        async def check():
+            # Verify that a reply of unknown length is streamed to the notebook as it's uploaded in pieces, and that
+            # it's compressed on the way unless the notebook can't accept that
+            text = json.dumps({'status': 200, 'text': 'x' * 100000}).encode('utf-8')
+            pieces = [text[start:start + 30000] for start in range(0, len(text), 30000)]
+            for accept_encoding in ('gzip', ''):
+                await call('POST', '/queue_request?channel=test:s&id=s1', TEST_JSON, [('Content-Type', 'application/json')])
+                await call('GET', '/dequeue_request?channel=test:s')
+                notebook = asyncio.ensure_future(call('GET', '/dequeue_reply?channel=test:s&id=s1',
+                                                      headers=[('Accept-Encoding', accept_encoding)]))
+                status, headers, body = await call('POST', '/queue_reply_and_dequeue_request?channel=test:s&id=s1',
+                                                   pieces[-1], [('Content-Type', 'text/plain')], chunks=pieces[:-1])
+                self.assertEqual(status, 408)
+                status, headers, body = await notebook
+                self.assertEqual(status, 200)
+                if accept_encoding:
+                    self.assertEqual(headers['content-encoding'], 'gzip')
+                    body = gzip.decompress(body)
+                else:
+                    self.assertNotIn('content-encoding', headers)
+                self.assertEqual(body, text)
+        self.run_app(check())
+
+    @print_entry_exit
+    def test_websocket(self):
+        async def check():
+            # Verify that a request is pushed to the browser as soon as it's queued, and that a reply on the socket is
+            # queued for the notebook
+            socket = _Socket('channel=test:ws')
+            self.assertEqual((await socket.next_event())['type'], 'websocket.accept')
+            await call('POST', '/queue_request?channel=test:ws&id=w1', TEST_JSON, [('Content-Type', 'application/json')])
+            event = await socket.next_event()
+            self.assertEqual(event['text'], 'w1\n' + TEST_JSON.decode('utf-8'))
+
+            socket.send('w1\n{"status": 200}')
+            status, headers, body = await call('GET', '/dequeue_reply?channel=test:ws&id=w1&pad=0')
+            self.assertEqual((status, body), (200, b'{"status": 200}'))
+
+            # Verify that a second browser on the channel is told to stop listening
+            second = _Socket('channel=test:ws')
+            self.assertEqual((await second.next_event())['type'], 'websocket.accept')
+            self.assertEqual((await second.next_event())['code'], asgi.SOCKET_SHUTDOWN)
+            await second.close()
+
+            # Verify that closing the socket lets the next reader in
+            await socket.close()
+            self.assertEqual(fakeredis.FakeRedis(server=server).hget('test:ws:request', jupyter_bridge.DEQUEUE_BUSY),
+                             jupyter_bridge.DEQUEUE_IDLE_STATUS)
+
+            # Verify that a socket without a channel is refused
+            socket = _Socket('')
+            self.assertEqual((await socket.next_event())['code'], asgi.SOCKET_POLICY_VIOLATION)
+        self.run_app(check())
+
+    @print_entry_exit
+    def test_websocket_pusher_failure(self):
+        async def check():
+            # Verify that a socket whose pusher fails is closed, so the browser falls back to long polling
+            with unittest.mock.patch.object(asgi, '_dequeue_attempt', side_effect=ConnectionError('store is down')):
+                socket = _Socket('channel=test:wsf')
+                self.assertEqual((await socket.next_event())['type'], 'websocket.accept')
+                self.assertEqual((await socket.next_event(timeout=3))['code'], asgi.SOCKET_INTERNAL_ERROR)
+                await asyncio.wait_for(socket.task, 3)
+        self.run_app(check())
+
+    @print_entry_exit
+    def test_websocket_acknowledgements(self):
+        async def check():
+            # Verify that a browser that acknowledges requests gets each one with its message ID, and that its reply
+            # acknowledges it
+            socket = _Socket('channel=test:wsa&window=2&ack=')
+            self.assertEqual((await socket.next_event())['type'], 'websocket.accept')
+            for request_id in ('a1', 'a2'):
+                await call('POST', f'/queue_request?channel=test:wsa&id={request_id}', TEST_JSON, [('Content-Type', 'application/json')])
+            headers = [(await socket.next_event())['text'].partition('\n')[0].split(' ') for request in range(2)]
+            self.assertEqual([header[0] for header in headers], ['a1', 'a2'])
+            socket.send(f'a1 {headers[0][1]}\n{{"status": 200}}')
+            status, _, body = await call('GET', '/dequeue_reply?channel=test:wsa&id=a1&pad=0')
+            self.assertEqual((status, body), (200, b'{"status": 200}'))
+            await socket.close()
+
+            # Verify that the next socket gets what wasn't acknowledged, except what the browser says it still holds
+            await call('POST', '/queue_request?channel=test:wsa&id=a3', TEST_JSON, [('Content-Type', 'application/json')])
+            socket = _Socket(f'channel=test:wsa&ack=&held={headers[1][1]}')
+            self.assertEqual((await socket.next_event())['type'], 'websocket.accept')
+            self.assertEqual((await socket.next_event())['text'].split(' ')[0], 'a3')
+            await socket.close()
+            socket = _Socket('channel=test:wsa&ack=')
+            self.assertEqual((await socket.next_event())['type'], 'websocket.accept')
+            self.assertEqual((await socket.next_event())['text'].partition('\n')[0], ' '.join(headers[1]))
+            await socket.close()
+        self.run_app(check())
+
+
+if __name__ == '__main__':
+    unittest.main()
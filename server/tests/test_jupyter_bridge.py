@@ -27,10 +27,25 @@ import redis
 import requests
 import json
 import os
+import threading
+import time
+import gzip
 
-# This test must run on the same machine as the redis instance, even if the actual
-# tests access jupyter-bridge through the normal web-based URL.
-redis_db = redis.Redis('localhost')
+BRIDGE_URL = os.environ.get('JUPYTER_BRIDGE_URL', 'https://jupyter-bridge.cytoscape.org')
+
+if os.environ.get('JUPYTER_STORE_URL') == 'local':
+    # Start a Jupyter-bridge in this process, with its messages kept in this process, too ... so the tests need
+    # neither a redis server nor a running Jupyter-bridge
+    from werkzeug.serving import make_server
+    import jupyter_bridge
+    bridge_server = make_server('127.0.0.1', 0, jupyter_bridge.app, threaded=True)
+    threading.Thread(target=bridge_server.serve_forever, daemon=True).start()
+    BRIDGE_URL = f'http://127.0.0.1:{bridge_server.server_port}'
+    redis_db = jupyter_bridge.redis_db
+else:
+    # This test must run on the same machine as the redis instance, even if the actual
+    # tests access jupyter-bridge through the normal web-based URL.
+    redis_db = redis.Redis('localhost')
 
 TEST_JSON = {"command": "POST",
              "url": "http://somehost:9999/v1/commands/session/open",
@@ -38,12 +53,13 @@ TEST_JSON = {"command": "POST",
              "data": {"file": "C:\\Program Files\\Cytoscape_v3.9.0-SNAPSHOT-May 29\\sampleData\\galFiltered.cys"},
              "headers": {"Content-Type": "application/json", "Accept": "application/json"}
              }
-BRIDGE_URL = os.environ.get('JUPYTER_BRIDGE_URL', 'https://jupyter-bridge.cytoscape.org')
 
 class JupyterBridgeTests(unittest.TestCase):
     def setUp(self):
-        # Get rid of all of test keys
-        for key in redis_db.keys('test:*'):
+        # Get rid of all of test keys, including the rate limits kept for the test channels and for this machine, so
+        # that no test starts with buckets that an earlier test emptied
+        for key in redis_db.keys('test:*') + redis_db.keys('rate:channel:test:*') + \
+                   ['rate:channel:test', 'rate:address:127.0.0.1', 'rate:address:::1']:
             redis_db.delete(key)
 
     def tearDown(self):
@@ -82,12 +98,443 @@ class JupyterBridgeTests(unittest.TestCase):
         self.assertDictEqual(message, TEST_JSON)
 
 
+    @print_entry_exit
+    def test_dequeue_wakeup(self):
+        # Post a request shortly after a reader starts waiting for it
+        def post_request():
+            time.sleep(1)
+            requests.post(f'{BRIDGE_URL}/queue_request?channel=test', json=TEST_JSON,
+                          headers={'Content-Type': 'application/json'})
+        poster = threading.Thread(target=post_request)
+        poster.start()
+
+        # Verify that the waiting reader gets the request as soon as it's posted instead of on a polling interval
+        start_time = time.monotonic()
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test')
+        elapsed_time = time.monotonic() - start_time
+        poster.join()
+        self.assertEqual(res.status_code, 200)
+        self.assertDictEqual(json.loads(res.text), TEST_JSON)
+        self.assertLess(elapsed_time, 1.5)
+
+    @print_entry_exit
+    def test_queue_reply_and_dequeue_request(self):
+        # Verify that a reply can be posted while waiting for a request that never comes
+        res = requests.post(f'{BRIDGE_URL}/queue_reply_and_dequeue_request?channel=test', json=TEST_JSON,
+                            headers={'Content-Type': 'text/plain'})
+        self.assertEqual(res.status_code, 408)
+
+        # Verify that the posted reply can be read back
+        res = requests.get(f'{BRIDGE_URL}/dequeue_reply?channel=test')
+        self.assertEqual(res.status_code, 200)
+        self.assertDictEqual(json.loads(res.text), TEST_JSON)
+
+        # Verify that a reply can be posted and a pending request returned in the same call
+        res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test', json=TEST_JSON,
+                            headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 200)
+        res = requests.post(f'{BRIDGE_URL}/queue_reply_and_dequeue_request?channel=test', json=TEST_JSON,
+                            headers={'Content-Type': 'text/plain'})
+        self.assertEqual(res.status_code, 200)
+        self.assertDictEqual(json.loads(res.text), TEST_JSON)
+        res = requests.get(f'{BRIDGE_URL}/dequeue_reply?channel=test')
+        self.assertEqual(res.status_code, 200)
+        self.assertDictEqual(json.loads(res.text), TEST_JSON)
+
+    @print_entry_exit
+    def test_queue_request_and_dequeue_reply(self):
+        # Reply to the request a few seconds after it's posted
+        def reply_to_request():
+            res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test')
+            self.assertEqual(res.status_code, 200)
+            time.sleep(3)
+            requests.post(f'{BRIDGE_URL}/queue_reply?channel=test', json=TEST_JSON,
+                          headers={'Content-Type': 'text/plain'})
+        replier = threading.Thread(target=reply_to_request)
+        replier.start()
+
+        # Verify that the request is posted and its reply returned in the same call
+        res = requests.post(f'{BRIDGE_URL}/queue_request_and_dequeue_reply?channel=test&timeout=30', json=TEST_JSON,
+                            headers={'Content-Type': 'application/json'})
+        replier.join()
+        self.assertEqual(res.status_code, 200)
+        self.assertDictEqual(json.loads(res.text), TEST_JSON)
+
+        # Verify that a timeout occurs when the caller's deadline passes before a reply is posted
+        start_time = time.monotonic()
+        res = requests.post(f'{BRIDGE_URL}/queue_request_and_dequeue_reply?channel=test&timeout=1', json=TEST_JSON,
+                            headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 408)
+        self.assertLess(time.monotonic() - start_time, 5)
+
+        # Verify that the request is still pending for the browser
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test')
+        self.assertEqual(res.status_code, 200)
+        self.assertDictEqual(json.loads(res.text), TEST_JSON)
+
+    @print_entry_exit
+    def test_correlation_ids(self):
+        # Verify that several requests with correlation IDs can be posted without waiting for replies
+        for request_id in ['r1', 'r2', 'r3']:
+            res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test&id={request_id}', json={'id': request_id},
+                                headers={'Content-Type': 'application/json'})
+            self.assertEqual(res.status_code, 200)
+
+        # Verify that the requests are dequeued in order, each with its correlation ID, and answered out of order
+        request_ids = []
+        for request_id in ['r1', 'r2', 'r3']:
+            res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.headers['X-Correlation-Id'], request_id)
+            self.assertDictEqual(json.loads(res.text), {'id': request_id})
+            request_ids.append(res.headers['X-Correlation-Id'])
+        for request_id in reversed(request_ids):
+            res = requests.post(f'{BRIDGE_URL}/queue_reply?channel=test&id={request_id}', json={'id': request_id},
+                                headers={'Content-Type': 'text/plain'})
+            self.assertEqual(res.status_code, 200)
+
+        # Verify that each reply can be picked up by its correlation ID, regardless of the order it was posted in
+        for request_id in ['r2', 'r1', 'r3']:
+            res = requests.get(f'{BRIDGE_URL}/dequeue_reply?channel=test&id={request_id}')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.headers['X-Correlation-Id'], request_id)
+            self.assertDictEqual(json.loads(res.text), {'id': request_id})
+        res = requests.get(f'{BRIDGE_URL}/dequeue_reply?channel=test')
+        self.assertEqual(res.status_code, 408)
+
+        # Verify that a full queue is rejected with a retry hint, and that a bad correlation ID is rejected
+        queue_depth = int(os.environ.get('JUPYTER_CHANNEL_QUEUE_DEPTH', 32))
+        for request_id in range(queue_depth):
+            res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test&id={request_id}', json=TEST_JSON,
+                                headers={'Content-Type': 'application/json'})
+            self.assertEqual(res.status_code, 200)
+        res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test&id=full', json=TEST_JSON,
+                            headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 429)
+        self.assertIn('Retry-After', res.headers)
+        res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test&id=bad%20id', json=TEST_JSON,
+                            headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 500)
+
+        # Verify that a reset discards all waiting requests
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test&reset')
+        self.assertEqual(res.status_code, 408)
+
+    @print_entry_exit
+    def test_acknowledgements(self):
+        for request_id in ['r1', 'r2']:
+            res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test&id={request_id}', json={'id': request_id},
+                                headers={'Content-Type': 'application/json'})
+            self.assertEqual(res.status_code, 200)
+
+        # Verify that a request that isn't acknowledged is delivered again, with the same message ID
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test&ack=')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['X-Correlation-Id'], 'r1')
+        message_id = res.headers['X-Message-Id']
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test&ack=')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['X-Correlation-Id'], 'r1')
+        self.assertEqual(res.headers['X-Message-Id'], message_id)
+
+        # Verify that acknowledging it moves on to the next request, and that acknowledging the last one empties the queue
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test&ack={message_id}')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['X-Correlation-Id'], 'r2')
+        self.assertNotEqual(res.headers['X-Message-Id'], message_id)
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test&ack={res.headers["X-Message-Id"]}')
+        self.assertEqual(res.status_code, 408)
+
+        # Verify that requests the reader still holds aren't delivered again, and that a reply acknowledges its request
+        for request_id in ['r3', 'r4']:
+            res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test&id={request_id}', json={'id': request_id},
+                                headers={'Content-Type': 'application/json'})
+            self.assertEqual(res.status_code, 200)
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test&ack=')
+        self.assertEqual(res.headers['X-Correlation-Id'], 'r3')
+        first_id = res.headers['X-Message-Id']
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test&ack=&held={first_id}')
+        self.assertEqual(res.headers['X-Correlation-Id'], 'r4')
+        second_id = res.headers['X-Message-Id']
+        res = requests.post(f'{BRIDGE_URL}/queue_reply?channel=test&id=r3&ack={first_id}', data='{"status": 200}',
+                            headers={'Content-Type': 'text/plain'})
+        self.assertEqual(res.status_code, 200)
+        res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test&id=r5', json={'id': 'r5'}, headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 200)
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test&ack=&held={second_id}')
+        self.assertEqual(res.headers['X-Correlation-Id'], 'r5')
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test&ack={res.headers["X-Message-Id"]}')
+        self.assertEqual((res.headers['X-Correlation-Id'], res.headers['X-Message-Id']), ('r4', second_id))
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test&ack={second_id}')
+        self.assertEqual(res.status_code, 408)
+        res = requests.get(f'{BRIDGE_URL}/dequeue_reply?channel=test&id=r3&pad=0')
+        self.assertEqual(res.text, '{"status": 200}')
+
+        # Verify that a reader that doesn't acknowledge gets no message ID, and that a bad message ID is rejected
+        res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test', json=TEST_JSON, headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 200)
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test')
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('X-Message-Id', res.headers)
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test&ack=bad')
+        self.assertEqual(res.status_code, 500)
+
+    @print_entry_exit
+    def test_batch(self):
+        def request_count():
+            res = requests.get(f'{BRIDGE_URL}/stats')
+            self.assertEqual(res.status_code, 200)
+            today = [line.split(',') for line in res.text.splitlines() if line.startswith(time.strftime('%Y-%m-%d'))]
+            return int(today[0][1]) if today else 0
+
+        # Verify that a batch request counts each of its calls in the statistics
+        batch = {'command': 'batch', 'calls': [TEST_JSON, TEST_JSON, TEST_JSON]}
+        start_count = request_count()
+        res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test&batch=3', json=batch,
+                            headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(request_count() - start_count, 3)
+
+        # Verify that the batch is delivered as a single request
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test')
+        self.assertEqual(res.status_code, 200)
+        self.assertDictEqual(json.loads(res.text), batch)
+
+        # Verify that a batch must contain at least one call
+        res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test&batch=0', json=batch,
+                            headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 500)
+
+        # Verify that a batch can't claim more calls than its envelope contains, and isn't counted if it does
+        start_count = request_count()
+        res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test&batch=300', json=batch,
+                            headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 500)
+        self.assertEqual(request_count(), start_count)
+
+    @print_entry_exit
+    def test_padding(self):
+        # Verify that a message is returned without padding when the caller declines it, and with it when asked
+        for pad, min_length in [('0', 0), ('1', 1500)]:
+            res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test', json=TEST_JSON,
+                                headers={'Content-Type': 'application/json'})
+            self.assertEqual(res.status_code, 200)
+            res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test&pad={pad}')
+            self.assertEqual(res.status_code, 200)
+            self.assertDictEqual(json.loads(res.text), TEST_JSON)
+            self.assertGreaterEqual(len(res.content) - len(json.dumps(TEST_JSON)), min_length)
+            if pad == '0':
+                self.assertEqual(res.content, res.content.rstrip())
+
+    @print_entry_exit
+    def test_compression(self):
+        large_json = {'rows': [{'name': f'node{i}', 'x': i} for i in range(5000)]}
+
+        # Verify that a compressed reply is returned compressed to a reader that accepts it, and decompressed otherwise
+        for accept_encoding, content_encoding in [('gzip, deflate', 'gzip'), ('identity', None)]:
+            res = requests.post(f'{BRIDGE_URL}/queue_reply?channel=test', data=gzip.compress(json.dumps(large_json).encode('utf-8')),
+                                headers={'Content-Type': 'text/plain', 'Content-Encoding': 'gzip'})
+            self.assertEqual(res.status_code, 200)
+            res = requests.get(f'{BRIDGE_URL}/dequeue_reply?channel=test', headers={'Accept-Encoding': accept_encoding})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.headers.get('Content-Encoding'), content_encoding)
+            self.assertDictEqual(json.loads(res.text), large_json)
+
+        # Verify that a large uncompressed request is returned intact
+        res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test', json=large_json,
+                            headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 200)
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test')
+        self.assertEqual(res.status_code, 200)
+        self.assertDictEqual(json.loads(res.text), large_json)
+
+        # Verify that an unknown encoding is rejected
+        res = requests.post(f'{BRIDGE_URL}/queue_reply?channel=test&encoding=unknown', json=TEST_JSON,
+                            headers={'Content-Type': 'text/plain'})
+        self.assertEqual(res.status_code, 500)
+
+    @print_entry_exit
+    def test_framed_reply(self):
+        framed = b'200 OK\n' + json.dumps(TEST_JSON).encode('utf-8')
+
+        # Verify that a framed reply is returned as it was sent, with its content type, whether the sender gives its
+        # content type in the header or in the type argument
+        for url, content_type in [('queue_reply?channel=test', 'application/x-cytoscape-reply'),
+                                  ('queue_reply?channel=test&type=application/x-cytoscape-reply', 'text/plain')]:
+            res = requests.post(f'{BRIDGE_URL}/{url}', data=framed, headers={'Content-Type': content_type})
+            self.assertEqual(res.status_code, 200)
+            res = requests.get(f'{BRIDGE_URL}/dequeue_reply?channel=test')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.headers['Content-Type'], 'application/x-cytoscape-reply')
+            self.assertEqual(res.content, framed)
+
+        # Verify that a plain reply is still returned as JSON
+        res = requests.post(f'{BRIDGE_URL}/queue_reply?channel=test', json=TEST_JSON, headers={'Content-Type': 'text/plain'})
+        self.assertEqual(res.status_code, 200)
+        res = requests.get(f'{BRIDGE_URL}/dequeue_reply?channel=test')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Type'], 'application/json')
+
+        # Verify that a reply of any other content type is rejected
+        res = requests.post(f'{BRIDGE_URL}/queue_reply?channel=test', data=framed, headers={'Content-Type': 'application/octet-stream'})
+        self.assertEqual(res.status_code, 500)
+
+    @print_entry_exit
+    def test_streaming(self):
+        huge_json = {'rows': [{'name': f'node{i}', 'x': i} for i in range(300000)]} # Over the 8MB streaming threshold
+
+        # Verify that a streamed reply is returned intact, whether or not the reader accepts it compressed
+        for accept_encoding in ['gzip', 'identity']:
+            res = requests.post(f'{BRIDGE_URL}/queue_reply?channel=test', json=huge_json,
+                                headers={'Content-Type': 'text/plain'})
+            self.assertEqual(res.status_code, 200)
+            res = requests.get(f'{BRIDGE_URL}/dequeue_reply?channel=test', headers={'Accept-Encoding': accept_encoding})
+            self.assertEqual(res.status_code, 200)
+            self.assertDictEqual(json.loads(res.text), huge_json)
+
+    @print_entry_exit
+    def test_spooling(self):
+        # Random names don't compress much, so this stays over the 1MB spooling threshold (if the server spools)
+        large_json = {'rows': [{'name': os.urandom(16).hex(), 'x': i} for i in range(40000)]}
+
+        # Verify that a long request and reply are returned intact, whether or not the reader accepts them compressed
+        for accept_encoding in ['gzip', 'identity']:
+            res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test', json=large_json,
+                                headers={'Content-Type': 'application/json'})
+            self.assertEqual(res.status_code, 200)
+            res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test', headers={'Accept-Encoding': accept_encoding})
+            self.assertEqual(res.status_code, 200)
+            self.assertDictEqual(json.loads(res.text), large_json)
+
+            res = requests.post(f'{BRIDGE_URL}/queue_reply?channel=test', json=large_json,
+                                headers={'Content-Type': 'text/plain'})
+            self.assertEqual(res.status_code, 200)
+            res = requests.get(f'{BRIDGE_URL}/dequeue_reply?channel=test', headers={'Accept-Encoding': accept_encoding})
+            self.assertEqual(res.status_code, 200)
+            self.assertDictEqual(json.loads(res.text), large_json)
+
     @print_entry_exit
     def test_ping(self):
         res = requests.get(f'{BRIDGE_URL}/ping', headers={'Content-Type': 'text/plain'})
         self.assertEqual(res.status_code, 200)
         self.assertRegex(res.text, 'pong +\d.+\d.+\d')
 
+    @print_entry_exit
+    def test_stats(self):
+        # Verify that today's statistics are reported, and only when they're in the date range
+        res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test', json=TEST_JSON,
+                            headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 200)
+        today = time.strftime('%Y-%m-%d')
+        res = requests.get(f'{BRIDGE_URL}/stats?start={today}&end={today}')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.text.splitlines()[0], 'date,count(request),request bytes,count(reply),reply bytes')
+        self.assertRegex(res.text.splitlines()[1], f'{today},[1-9]')
+        res = requests.get(f'{BRIDGE_URL}/stats?start=2000-01-01&end=2000-01-31')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.text.splitlines()), 1)
+
+        # Verify that a bad date is rejected
+        res = requests.get(f'{BRIDGE_URL}/stats?start=2000-02-30')
+        self.assertEqual(res.status_code, 500)
+
+    @print_entry_exit
+    def test_metrics(self):
+        # Verify that a request's wait and its route's response are measured
+        res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test', json=TEST_JSON,
+                            headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 200)
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test')
+        self.assertEqual(res.status_code, 200)
+        time.sleep(2) # Give each process time to add its measurements to the totals
+
+        res = requests.get(f'{BRIDGE_URL}/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('# TYPE jupyter_bridge_route_seconds histogram', res.text)
+        self.assertRegex(res.text, r'jupyter_bridge_responses_total\{route="dequeue_request",status="200"\} [1-9]')
+        self.assertRegex(res.text, r'jupyter_bridge_queue_wait_seconds_count\{operation="request"\} [1-9]')
+        self.assertRegex(res.text, r'jupyter_bridge_waiters\{operation="request"\} \d')
+        self.assertRegex(res.text, r'jupyter_bridge_waiters\{operation="reply"\} \d')
+
+    @print_entry_exit
+    def test_channel_admin(self):
+        # Verify that the admin endpoints require the admin token
+        res = requests.get(f'{BRIDGE_URL}/admin/channels')
+        self.assertEqual(res.status_code, 403)
+        res = requests.post(f'{BRIDGE_URL}/admin/evict?channel=test:evict', headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(res.status_code, 403)
+
+        admin_token = os.environ.get('JUPYTER_ADMIN_TOKEN')
+        if not admin_token:
+            self.skipTest('JUPYTER_ADMIN_TOKEN is not set')
+        admin_headers = {'Authorization': f'Bearer {admin_token}'}
+
+        # Verify that a channel the notebook just used is listed as active
+        res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test:evict', json=TEST_JSON,
+                            headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 200)
+        res = requests.get(f'{BRIDGE_URL}/admin/channels?state=active', headers=admin_headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('test:evict', [channel['channel'] for channel in res.json()])
+
+        # Verify that an evicted channel's request is dropped, and its browser is told to stop polling
+        res = requests.post(f'{BRIDGE_URL}/admin/evict?channel=test:evict', headers=admin_headers)
+        self.assertEqual(res.status_code, 200)
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test:evict')
+        self.assertEqual(res.status_code, 429)
+
+    @print_entry_exit
+    def test_warm_restart(self):
+        # Verify that a reader whose claim has lapsed (e.g., its process died while waiting) doesn't lock out the
+        # next reader, but a reader whose claim is current does
+        res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test:lease', json=TEST_JSON,
+                            headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 200)
+        redis_db.hset('test:lease:request', mapping={'dequeue_busy': 'busy', 'busy_until': time.time() + 60})
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test:lease')
+        self.assertEqual(res.status_code, 429)
+        redis_db.hset('test:lease:request', mapping={'dequeue_busy': 'busy', 'busy_until': time.time() - 1})
+        res = requests.get(f'{BRIDGE_URL}/dequeue_request?channel=test:lease')
+        self.assertEqual(res.status_code, 200)
+        self.assertDictEqual(json.loads(res.text), TEST_JSON)
+
+        # Verify that draining requires the admin token, and that draining another node doesn't cut this one's waits short
+        res = requests.post(f'{BRIDGE_URL}/admin/drain?node=test-node', headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(res.status_code, 403)
+        admin_token = os.environ.get('JUPYTER_ADMIN_TOKEN')
+        if not admin_token:
+            self.skipTest('JUPYTER_ADMIN_TOKEN is not set')
+        res = requests.post(f'{BRIDGE_URL}/admin/drain?node=test-node', headers={'Authorization': f'Bearer {admin_token}'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.text, 'test-node')
+        start_time = time.monotonic()
+        res = requests.post(f'{BRIDGE_URL}/queue_request_and_dequeue_reply?channel=test:lease&timeout=3', json=TEST_JSON,
+                            headers={'Content-Type': 'application/json'})
+        self.assertEqual(res.status_code, 408)
+        self.assertGreaterEqual(time.monotonic() - start_time, 2.5)
+        redis_db.delete('drain:test-node')
+
+    @print_entry_exit
+    def test_rate_limit(self):
+        # Verify that a channel that calls faster than its limit is told when to retry ... the server's channel limit
+        # must be small enough to exhaust quickly but big enough for the other tests' bursts on a single channel
+        # (e.g., JUPYTER_RATE_CHANNEL_BURST=50 and JUPYTER_RATE_CHANNEL_PER_SEC=1)
+        burst = os.environ.get('JUPYTER_RATE_CHANNEL_BURST')
+        if not burst:
+            self.skipTest('JUPYTER_RATE_CHANNEL_BURST is not set')
+        for call in range(int(burst) + 1): # Only the first request is queued, but each call counts
+            res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test:rate', json=TEST_JSON,
+                                headers={'Content-Type': 'application/json'})
+            if res.status_code == 429:
+                break
+        self.assertEqual(res.status_code, 429)
+        self.assertGreaterEqual(int(res.headers['Retry-After']), 1)
+
+        # Verify that other channels are still admitted
+        res = requests.post(f'{BRIDGE_URL}/queue_request?channel=test:rate-other', json=TEST_JSON,
+                            headers={'Content-Type': 'application/json'})
+        self.assertNotEqual(res.status_code, 429)
+
     @print_entry_exit
     def test_requests(self):
         self._test_basic_protocol('request', 'application/json')
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+""" Test the message stores that Jupyter-bridge runs on.
+"""
+
+"""License:
+    Copyright 2020 The Cytoscape Consortium
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+    documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+    the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+    and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all copies or substantial portions
+    of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+    WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+    OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+    OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import unittest
+
+from server.test_utils import *
+import redis
+import os
+import threading
+import time
+import io
+import tempfile
+import unittest.mock
+
+# jupyter_bridge opens its message store when it's imported ... have it open a LocalStore, so that importing it doesn't
+# touch the redis server under test
+store_url = os.environ.get('JUPYTER_STORE_URL')
+os.environ['JUPYTER_STORE_URL'] = 'local'
+try:
+    import jupyter_bridge
+    import message_store
+finally:
+    if store_url is None:
+        del os.environ['JUPYTER_STORE_URL']
+    else:
+        os.environ['JUPYTER_STORE_URL'] = store_url
+
+SCRIPTS = {jupyter_bridge.ENQUEUE_SCRIPT: message_store.enqueue_script, jupyter_bridge.DEQUEUE_SCRIPT: message_store.dequeue_script,
+           jupyter_bridge.TOUCH_CHANNEL_SCRIPT: message_store.touch_channel_script,
+           jupyter_bridge.RATE_LIMIT_SCRIPT: message_store.rate_limit_script}
+
+
+def redis_store():
+    # The redis instance on this machine (as in test_jupyter_bridge), or else a fakeredis that runs the Lua scripts
+    store = redis.Redis('localhost')
+    try:
+        store.ping()
+        return store
+    except redis.exceptions.ConnectionError:
+        pass
+    try:
+        import fakeredis
+        store = fakeredis.FakeRedis()
+        store.register_script('return 1')()
+        return store
+    except Exception: # fakeredis or its Lua interpreter (lupa) isn't installed
+        return None
+
+STORES = {'local': message_store.LocalStore(SCRIPTS), 'redis': redis_store()}
+
+
+class MessageStoreTests(unittest.TestCase):
+    # Each test runs the same calls against each store, so a LocalStore's Python scripts are held to what the Lua
+    # scripts do
+
+    def setUp(self):
+        # Get rid of all of test keys
+        for store in STORES.values():
+            if store is not None:
+                for key in store.keys('test:*'):
+                    store.delete(key)
+
+    def tearDown(self):
+        pass
+
+    def on_each_store(self, check):
+        if STORES['redis'] is None:
+            print('No redis server or fakeredis ... testing LocalStore only')
+        for name, store in STORES.items():
+            if store is not None:
+                with self.subTest(store=name):
+                    check(store)
+
+    @print_entry_exit
+    def test_enqueue_dequeue(self):
+        self.on_each_store(self._check_enqueue_dequeue)
+
+    @print_entry_exit
+    def test_rate_limit(self):
+        self.on_each_store(self._check_rate_limit)
+
+    @print_entry_exit
+    def test_touch_channel(self):
+        self.on_each_store(self._check_touch_channel)
+
+    @print_entry_exit
+    def test_wakeups(self):
+        self.on_each_store(self._check_wakeups)
+
+    @print_entry_exit
+    def test_wakeup_fanout(self):
+        self.on_each_store(self._check_wakeup_fanout)
+
+    def _check_enqueue_dequeue(self, store):
+        enqueue_script = store.register_script(jupyter_bridge.ENQUEUE_SCRIPT)
+        dequeue_script = store.register_script(jupyter_bridge.DEQUEUE_SCRIPT)
+        def enqueue(msg, correlation_id):
+            params = jupyter_bridge._enqueue_params('test:store:request', jupyter_bridge.REQUEST, msg, correlation_id, None, 1, '')
+            params['keys'][1:3] = ['test:statistic', 'test:statistic_days'] # Leave the real statistics alone
+            return jupyter_bridge._enqueue_result('test:store:request', enqueue_script(**params))
+        def dequeue(correlation_id='', claim=True, release=True, ack=None, side='', held=''):
+            params = jupyter_bridge._dequeue_params('test:store:request', correlation_id, claim, False, release, 5, ack, side, held)
+            params['keys'][2:3] = ['test:channels'] # Leave the real channel index alone
+            return jupyter_bridge._dequeue_result('test:store:request', dequeue_script(**params))
+
+        # Verify that an empty queue returns nothing, and that messages are returned in order with their IDs
+        self.assertEqual(dequeue()[:4], (None, '', '', True))
+        enqueue(b'{"n": 1}', 'a1')
+        enqueue(b'{"n": 2}', 'a2')
+        enqueue(b'{"n": 3}', 'a3')
+        self.assertEqual(dequeue()[:4], (b'{"n": 1}', '', 'a1', True))
+        self.assertEqual(dequeue(correlation_id='a3')[:4], (b'{"n": 3}', '', 'a3', True))
+        self.assertEqual(dequeue()[:4], (b'{"n": 2}', '', 'a2', True))
+        self.assertIsNone(dequeue()[0])
+
+        # Verify that a message without an ID can't be queued behind an unprocessed one
+        enqueue(b'{"n": 4}', '')
+        with self.assertRaisesRegex(Exception, 'unprocessed message'):
+            enqueue(b'{"n": 5}', '')
+        self.assertEqual(dequeue()[0], b'{"n": 4}')
+
+        # Verify that a message is delivered again until it's acknowledged
+        enqueue(b'{"n": 6}', 'a6')
+        message, _, _, _, _, ack_id, _ = dequeue(ack='')
+        self.assertEqual((message, bool(ack_id)), (b'{"n": 6}', True))
+        self.assertEqual(dequeue(ack='')[5], ack_id)
+        self.assertIsNone(dequeue(ack=ack_id)[0])
+
+        # Verify that a message the reader holds isn't delivered again, and that a reply acknowledges the requests it
+        # names once it's stored (and records its sender's activity on the channel)
+        enqueue(b'{"n": 8}', 'a8')
+        enqueue(b'{"n": 9}', 'a9')
+        message, _, _, _, _, first, _ = dequeue(ack='')
+        self.assertEqual(message, b'{"n": 8}')
+        message, _, _, _, _, second, _ = dequeue(ack='', held=first)
+        self.assertEqual(message, b'{"n": 9}')
+        self.assertIsNone(dequeue(ack='', held=f'{first},{second}')[0])
+        params = jupyter_bridge._enqueue_params('test:store:reply', jupyter_bridge.REPLY, b'{"status": 200}', 'a8', None, 1, '', '', first,
+                                                jupyter_bridge.BROWSER)
+        params['keys'][1:3] = ['test:statistic', 'test:statistic_days']
+        params['keys'][4:5] = ['test:channels']
+        self.assertEqual(params['keys'][5], 'test:store:request')
+        jupyter_bridge._enqueue_result('test:store:reply', enqueue_script(**params))
+        self.assertIsNotNone(store.hget('test:store:liveness', jupyter_bridge.BROWSER))
+        self.assertEqual(store.zrangebyscore('test:channels', '-inf', '+inf'), [b'test:store'])
+        self.assertIsNone(dequeue(ack='', held=second)[0])
+        self.assertEqual(dequeue(ack='')[5], second)
+        self.assertIsNone(dequeue(ack=second)[0])
+
+        # Verify that a claim on behalf of a side touches the channel's liveness, with or without a message
+        self.assertIsNone(dequeue()[6])
+        liveness = dequeue(side=jupyter_bridge.BROWSER)[6]
+        self.assertEqual((liveness[jupyter_bridge.NOTEBOOK], liveness['evicted']), (None, False))
+        self.assertIsNotNone(liveness[jupyter_bridge.BROWSER])
+        enqueue(b'{"n": 7}', 'a7')
+        message, _, _, _, _, _, liveness = dequeue(side=jupyter_bridge.NOTEBOOK)
+        self.assertEqual(message, b'{"n": 7}')
+        self.assertIsNotNone(liveness[jupyter_bridge.NOTEBOOK])
+        self.assertEqual(store.zrangebyscore('test:channels', '-inf', '+inf'), [b'test:store'])
+
+        # Verify that a full queue is refused
+        for seq in range(jupyter_bridge.CHANNEL_QUEUE_DEPTH):
+            enqueue(b'{}', f'f{seq}')
+        with self.assertRaises(jupyter_bridge.ChannelFullException):
+            enqueue(b'{}', 'over')
+        for seq in range(jupyter_bridge.CHANNEL_QUEUE_DEPTH):
+            dequeue()
+
+        # Verify that a second reader can't claim the channel while the first one waits on it
+        self.assertEqual(dequeue(release=False)[:4], (None, '', '', True))
+        self.assertFalse(dequeue()[3])
+        dequeue(claim=False)
+        self.assertTrue(dequeue()[3])
+
+    def _check_rate_limit(self, store):
+        rate_limit_script = store.register_script(jupyter_bridge.RATE_LIMIT_SCRIPT)
+        def admission_wait(key):
+            return jupyter_bridge._admission_result(rate_limit_script(keys=[key], args=[time.time(), 1, 3]))
+
+        # Verify that a burst is admitted, the next call is told when to retry, and other keys are still admitted
+        for call in range(3):
+            self.assertEqual(admission_wait('test:rate'), 0)
+        self.assertGreater(admission_wait('test:rate'), 0)
+        self.assertLessEqual(admission_wait('test:rate'), 1)
+        self.assertEqual(admission_wait('test:rate-other'), 0)
+        self.assertGreater(store.ttl('test:rate'), 0)
+
+    def _check_touch_channel(self, store):
+        touch_channel_script = store.register_script(jupyter_bridge.TOUCH_CHANNEL_SCRIPT)
+        def touch(side, now):
+            return jupyter_bridge._liveness_result(touch_channel_script(keys=['test:touch:liveness', 'test:channels'],
+                                                                        args=[side, now, 60, 'test:touch']))
+
+        # Verify that each side's last call is kept, along with when the channel was first seen
+        now = time.time()
+        self.assertEqual(touch(jupyter_bridge.BROWSER, now),
+                         {jupyter_bridge.NOTEBOOK: None, jupyter_bridge.BROWSER: now, 'since': now, 'evicted': False})
+        self.assertEqual(touch(jupyter_bridge.NOTEBOOK, now + 1),
+                         {jupyter_bridge.NOTEBOOK: now + 1, jupyter_bridge.BROWSER: now, 'since': now, 'evicted': False})
+        self.assertEqual(store.zrangebyscore('test:channels', '-inf', '+inf'), [b'test:touch'])
+
+        # Verify that an evicted channel stays evicted, and that channels not seen recently are dropped from the index
+        store.hset('test:touch:liveness', 'evicted', '1')
+        self.assertTrue(touch(jupyter_bridge.BROWSER, now + 2)['evicted'])
+        store.zadd('test:channels', {'test:stale': now - 120})
+        touch(jupyter_bridge.BROWSER, now + 3)
+        self.assertEqual(store.zrangebyscore('test:channels', '-inf', '+inf'), [b'test:touch'])
+
+    def _check_wakeups(self, store):
+        # Verify that a subscriber is woken by a message published on its channel, but not by one on another channel
+        wakeup = store.pubsub()
+        wakeup.subscribe('test:wake')
+        self.assertEqual(wakeup.get_message(timeout=1)['type'], 'subscribe')
+        store.publish('test:other', 'message')
+        self.assertIsNone(wakeup.get_message(timeout=0.2))
+        threading.Timer(0.2, store.publish, args=['test:wake', 'message']).start()
+        start_time = time.monotonic()
+        message = wakeup.get_message(timeout=5)
+        self.assertEqual((message['type'], message['channel'], message['data']), ('message', b'test:wake', b'message'))
+        self.assertLess(time.monotonic() - start_time, 2)
+        wakeup.close()
+
+        # Verify that a pattern subscriber is woken by a message on any channel that matches its pattern
+        wakeup = store.pubsub()
+        wakeup.psubscribe('test:*:request')
+        self.assertEqual(wakeup.get_message(timeout=1)['type'], 'psubscribe')
+        store.publish('test:other:reply', 'message')
+        store.publish('test:wake:request', 'message')
+        message = wakeup.get_message(timeout=5)
+        self.assertEqual((message['type'], message['channel']), ('pmessage', b'test:wake:request'))
+        self.assertIsNone(wakeup.get_message(timeout=0.2))
+        wakeup.close()
+
+        # Verify that a blocked list reader is woken by a push to its list
+        threading.Timer(0.2, store.rpush, args=['test:list', b'chunk']).start()
+        self.assertEqual(store.blpop('test:list', timeout=5), (b'test:list', b'chunk'))
+        self.assertIsNone(store.blpop('test:list', timeout=0.2))
+
+
+    def _check_wakeup_fanout(self, store):
+        wakeups = jupyter_bridge._Wakeups()
+        def subscribers(key, expected):
+            # How many subscribers a wakeup on the key reaches, once an UNSUBSCRIBE just sent has had time to take effect
+            deadline = time.monotonic() + 1
+            while True:
+                received = store.publish(key, 'message')
+                if received == expected or time.monotonic() > deadline:
+                    return received
+                time.sleep(0.05)
+        with unittest.mock.patch.object(jupyter_bridge, 'channel_stores', message_store.ShardRing({'test': store})):
+            try:
+                # Verify that a waiter's key is subscribed to (and confirmed) by the time it's added, but other keys
+                # aren't subscribed to at all
+                self.assertTrue(wakeups.start())
+                event = wakeups.add('test:fan:request', store)
+                self.assertEqual(store.publish('test:fan:request', 'message'), 1)
+                self.assertEqual(store.publish('test:other:request', 'message'), 0)
+                self.assertTrue(event.wait(5))
+
+                # Verify that the key stays subscribed to until its last waiter is removed
+                other_event = wakeups.add('test:fan:request', store)
+                wakeups.remove('test:fan:request', event)
+                self.assertEqual(store.publish('test:fan:request', 'message'), 1)
+                wakeups.remove('test:fan:request', other_event)
+                self.assertEqual(subscribers('test:fan:request', 0), 0)
+                self.assertEqual(wakeups.waiters, {})
+            finally:
+                wakeups.generation += 1 # Its listener stops
+
+
+class ShardRingTests(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    @print_entry_exit
+    def test_assignment(self):
+        # Verify that a channel is always assigned to the same shard, whatever the order the shards are listed in
+        channels = [f'test:{seq}' for seq in range(10000)]
+        ring = message_store.ShardRing({'redis://a': 'a', 'redis://b': 'b', 'redis://c': 'c'})
+        same_ring = message_store.ShardRing({'redis://c': 'c', 'redis://a': 'a', 'redis://b': 'b'})
+        assignment = {channel: ring.name(channel) for channel in channels}
+        self.assertEqual(assignment, {channel: same_ring.name(channel) for channel in channels})
+        self.assertEqual(assignment, {channel: ring.name(channel) for channel in channels})
+        for name in ['redis://a', 'redis://b', 'redis://c']: # Spread roughly evenly
+            self.assertGreater(list(assignment.values()).count(name), len(channels) / 3 * 0.7)
+
+        # Verify that adding a shard moves only about a quarter of the channels, and only to the new shard
+        more_ring = message_store.ShardRing({'redis://a': 'a', 'redis://b': 'b', 'redis://c': 'c', 'redis://d': 'd'})
+        moved = [channel for channel in channels if more_ring.name(channel) != assignment[channel]]
+        self.assertGreater(len(moved), len(channels) / 4 * 0.7)
+        self.assertLess(len(moved), len(channels) / 4 * 1.3)
+        self.assertEqual({more_ring.name(channel) for channel in moved}, {'redis://d'})
+
+    @print_entry_exit
+    def test_channel_routing(self):
+        # Verify that a channel's queue (including a spooled message's metadata) and a streamed message's chunks are all
+        # kept in the channel's shard
+        try:
+            import fakeredis
+            shards = {'redis://s0': fakeredis.FakeRedis(server=fakeredis.FakeServer()),
+                      'redis://s1': fakeredis.FakeRedis(server=fakeredis.FakeServer())}
+            shards['redis://s0'].register_script('return 1')()
+        except Exception:
+            self.skipTest('fakeredis and lupa are needed to run scripts on several shards')
+        ring = message_store.ShardRing(shards)
+        channels = {ring.name(f'test:route{seq}'): f'test:route{seq}' for seq in range(20)}
+        self.assertEqual(len(channels), 2)
+
+        with tempfile.TemporaryDirectory() as spool_dir, \
+             unittest.mock.patch.multiple(jupyter_bridge, channel_stores=ring, SPOOL_DIR=spool_dir, SPOOL_MIN_BYTES=1024,
+                                          enqueue_script=shards['redis://s0'].register_script(jupyter_bridge.ENQUEUE_SCRIPT)):
+            for name, channel in channels.items():
+                jupyter_bridge._enqueue('test', jupyter_bridge.REQUEST, channel, b'x' * 2048, 'spooled')
+                message = jupyter_bridge.StreamedMessage(jupyter_bridge._stream_key(channel, jupyter_bridge.REPLY), channel)
+                jupyter_bridge._enqueue('test', jupyter_bridge.REPLY, channel, message, 'streamed')
+                jupyter_bridge._stream_message('test', jupyter_bridge.REPLY, message, io.BytesIO(b'{}'), False)
+
+                store, other_store = shards[name], [shards[other] for other in shards if other != name][0]
+                request_key, reply_key = f'{channel}:{jupyter_bridge.REQUEST}', f'{channel}:{jupyter_bridge.REPLY}'
+                self.assertEqual(store.hget(request_key, 'storage:1'), jupyter_bridge.SPOOL)
+                self.assertEqual(store.hget(reply_key, 'storage:1'), jupyter_bridge.STREAM)
+                self.assertEqual(store.llen(message.key), 2) # The body and the end tag
+                self.assertEqual(other_store.keys(f'{channel}:*'), [])
+
+
+class WaiterCountTests(unittest.TestCase):
+
+    def setUp(self):
+        jupyter_bridge.redis_db.delete(jupyter_bridge.WAITERS_KEY, 'metrics:waiter_processes:test:1', 'metrics:waiter_processes:test:2')
+
+    def tearDown(self):
+        jupyter_bridge.waiter_counts.clear()
+        self.setUp()
+
+    @print_entry_exit
+    def test_process_counts(self):
+        # Verify that both gauges are reported when nothing has waited
+        field = jupyter_bridge._waiters_field(jupyter_bridge.REQUEST).encode('utf-8')
+        reply_field = jupyter_bridge._waiters_field(jupyter_bridge.REPLY).encode('utf-8')
+        self.assertEqual(jupyter_bridge._waiter_samples(), {field: b'0', reply_field: b'0'})
+
+        # Verify that this process's waiters are added to those of other live processes
+        store = jupyter_bridge.redis_db
+        store.hset('metrics:waiter_processes:test:1', mapping={field: 2})
+        store.zadd(jupyter_bridge.WAITERS_KEY, {'metrics:waiter_processes:test:1': time.time()})
+        jupyter_bridge._count_waiter(jupyter_bridge.REQUEST, 1)
+        jupyter_bridge._flush_metrics()
+        self.assertEqual(jupyter_bridge._waiter_samples()[field], b'3')
+
+        # Verify that the waiters of a process that stopped flushing (e.g., it died) are dropped, along with the process
+        store.hset('metrics:waiter_processes:test:2', mapping={field: 5})
+        store.zadd(jupyter_bridge.WAITERS_KEY, {'metrics:waiter_processes:test:2': time.time() - jupyter_bridge.WAITERS_EXPIRE_SECS - 1})
+        self.assertEqual(jupyter_bridge._waiter_samples()[field], b'3')
+        self.assertEqual(len(store.zrangebyscore(jupyter_bridge.WAITERS_KEY, '-inf', '+inf')), 2)
+
+        jupyter_bridge._count_waiter(jupyter_bridge.REQUEST, -1)
+        jupyter_bridge._flush_metrics()
+        self.assertEqual(jupyter_bridge._waiter_samples()[field], b'2')
+
+if __name__ == '__main__':
+    unittest.main()
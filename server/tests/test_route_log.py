@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+""" Test how Jupyter-bridge logs its routes.
+"""
+
+"""License:
+    Copyright 2020 The Cytoscape Consortium
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+    documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+    the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software,
+    and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all copies or substantial portions
+    of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+    WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+    OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+    OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import unittest
+
+from server.test_utils import *
+import logging
+import os
+import time
+import unittest.mock
+
+# The routes run in this process, with their messages kept in this process, too (see test_message_store)
+store_url = os.environ.get('JUPYTER_STORE_URL')
+os.environ['JUPYTER_STORE_URL'] = 'local'
+try:
+    import jupyter_bridge
+finally:
+    if store_url is None:
+        del os.environ['JUPYTER_STORE_URL']
+    else:
+        os.environ['JUPYTER_STORE_URL'] = store_url
+
+TEST_JSON = b'{"command": "GET", "url": "http://somehost:9999/v1/version"}'
+
+
+class _Records(logging.Handler):
+    """Keeps the messages of the records that reach it"""
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class RouteLogTests(unittest.TestCase):
+
+    def setUp(self):
+        # Send the log to a handler that keeps its records, through a queue as the server does, and have each route's
+        # settings read again
+        self.records = _Records()
+        self.handlers = jupyter_bridge.logger.handlers
+        jupyter_bridge.logger.handlers = [jupyter_bridge._ProcessQueueHandler(self.records)]
+        jupyter_bridge.route_log_settings.clear()
+        self.client = jupyter_bridge.app.test_client()
+        self.sentinels = 0
+
+    def tearDown(self):
+        jupyter_bridge.logger.handlers = self.handlers
+        jupyter_bridge.route_log_settings.clear()
+
+    def logged(self):
+        # The messages logged so far ... a record logged outside of any route marks the end of the queue
+        self.sentinels += 1
+        sentinel = f'test sentinel {self.sentinels}'
+        jupyter_bridge.logger.info(sentinel)
+        deadline = time.monotonic() + 5
+        while sentinel not in self.records.messages and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIn(sentinel, self.records.messages)
+        return [message for message in self.records.messages if not message.startswith('test sentinel')]
+
+    def ping_logged(self):
+        del self.records.messages[:]
+        self.assertEqual(self.client.get('/ping').status_code, 200)
+        return [message for message in self.logged() if 'ping' in message]
+
+    @print_entry_exit
+    def test_sampling(self):
+        # Verify that a route is logged in full by default, and not at all if it isn't sampled
+        self.assertEqual(self.ping_logged(), ['into ping', 'out of ping'])
+        with unittest.mock.patch.dict(os.environ, {'JUPYTER_LOG_SAMPLE_PING': '0'}):
+            jupyter_bridge.route_log_settings.clear()
+            self.assertEqual(self.ping_logged(), [])
+
+            # Verify that other routes are still logged
+            del self.records.messages[:]
+            self.client.get('/stats?first=2000-01-01&last=2000-01-01')
+            self.assertIn('into stats', self.logged())
+
+        # Verify that a sample rate between 0 and 1 logs some transactions but not others
+        with unittest.mock.patch.dict(os.environ, {'JUPYTER_LOG_SAMPLE_PING': '0.5'}):
+            jupyter_bridge.route_log_settings.clear()
+            counts = [len(self.ping_logged()) for call in range(100)]
+            self.assertEqual(set(counts), {0, 2})
+            self.assertTrue(20 <= counts.count(2) <= 80)
+
+    @print_entry_exit
+    def test_levels(self):
+        # Verify that a route's records below its level are dropped, and that records outside of routes are kept
+        with unittest.mock.patch.dict(os.environ, {'JUPYTER_LOG_LEVEL_PING': 'INFO'}):
+            jupyter_bridge.route_log_settings.clear()
+            self.assertEqual(self.ping_logged(), [])
+            jupyter_bridge.logger.debug('test outside of a route')
+            self.assertIn('test outside of a route', self.logged())
+            self.assertIsNone(jupyter_bridge.route_log.get())
+
+    @print_entry_exit
+    def test_timeout_sampling(self):
+        # Verify that a dequeue transaction that times out isn't logged, but one that returns a message is
+        with unittest.mock.patch.object(jupyter_bridge, 'LOG_SAMPLE_TIMEOUT', 0):
+            del self.records.messages[:]
+            res = self.client.post('/queue_request_and_dequeue_reply?channel=test:log&id=t1&timeout=0.5', data=TEST_JSON,
+                                   content_type='application/json')
+            self.assertEqual(res.status_code, 408)
+            self.assertEqual([message for message in self.logged() if 'queue_request_and_dequeue_reply' in message], [])
+
+            res = self.client.post('/queue_reply?channel=test:log&id=t2', data=b'{"status": 200}', content_type='text/plain')
+            self.assertEqual(res.status_code, 200)
+            del self.records.messages[:]
+            res = self.client.post('/queue_request_and_dequeue_reply?channel=test:log&id=t2&timeout=5', data=TEST_JSON,
+                                   content_type='application/json')
+            self.assertEqual(res.status_code, 200)
+            logged = [message for message in self.logged() if 'queue_request_and_dequeue_reply' in message]
+            self.assertTrue(logged[0].startswith('into queue_request_and_dequeue_reply'))
+            self.assertTrue(logged[-1].startswith('out of queue_request_and_dequeue_reply'))
+
+
+if __name__ == '__main__':
+    unittest.main()